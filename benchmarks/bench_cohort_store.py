@@ -0,0 +1,72 @@
+"""
+Benchmark appending samples to a cohort store, and the per-position queries across the cohort
+
+Each sample is a synthetic pileup over the same positions, with a genotype base and sparse low-level alt counts.
+The queries read the counts through the memory map a chunk of positions at a time, so their peak RSS should stay
+well below the size of the store.
+
+Usage: python benchmarks/bench_cohort_store.py --samples 200 --positions 200000
+"""
+import json
+import os
+import tempfile
+import time
+
+import click
+import numpy as np
+import pandas as pd
+
+from common import measure
+from sequence_qc.cohort_store import STORE_COUNTS, CohortStore, append_sample, pileup_settings
+from sequence_qc.pileup import PILEUP_COUNT_COLUMNS
+
+
+def synthetic_sample(positions: int, rng) -> pd.DataFrame:
+    counts = rng.poisson(0.3, size=(positions, len(PILEUP_COUNT_COLUMNS))).astype(np.uint32)
+    counts[np.arange(positions), rng.integers(0, 4, positions)] += rng.poisson(1000, positions).astype(np.uint32)
+    pileup = pd.DataFrame(counts, columns=PILEUP_COUNT_COLUMNS)
+    pileup.insert(0, 'pos', np.arange(positions))
+    pileup.insert(0, 'chrom', '1')
+    return pileup
+
+
+def build(path: str, samples: int, positions: int) -> dict:
+    rng = np.random.default_rng(0)
+    intervals = [('1', 0, positions)]
+    elapsed = 0
+    for sample in range(samples):
+        pileup = synthetic_sample(positions, rng)
+        start = time.perf_counter()
+        append_sample(path, 'sample{}'.format(sample), pileup, intervals, pileup_settings())
+        elapsed += time.perf_counter() - start
+    return {'append_s_per_sample': elapsed / samples,
+            'store_size_mb': os.path.getsize(os.path.join(path, STORE_COUNTS)) / 1024 ** 2}
+
+
+def query(path: str, method: str) -> dict:
+    with CohortStore(path) as store:
+        start = time.perf_counter()
+        if method == 'median_noise':
+            store.median_noise(min_depth=100)
+        else:
+            store.site_outliers(store.samples[0], min_depth=100)
+    return {'query_s': time.perf_counter() - start}
+
+
+@click.command()
+@click.option("--samples", default=200, help="Number of samples in the store")
+@click.option("--positions", default=200000, help="Number of positions of each sample")
+def main(samples, positions):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'store')
+        results = [dict(measure(build, path, samples, positions), step='append')]
+        for method in ['median_noise', 'site_outliers']:
+            results.append(dict(measure(query, path, method), step=method))
+        for result in results:
+            result.update({'samples': samples, 'positions': positions})
+            click.echo(json.dumps(result), err=True)
+    click.echo(json.dumps({'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Benchmark classifying read pairs at noisy positions for the fragment size stage
+
+Read pairs with soft clips, insertions and deletions are simulated in memory, and each pair is classified at every
+noisy position it covers, as `get_fragment_size_for_positions` does. The CIGAR-aware `ReadPositionIndex` is built
+once per pair and reused across positions. The previous lookup, which indexed the read sequence by the distance from
+the alignment start, is kept below for comparison, along with the number of classifications where the two differ.
+
+Usage: python benchmarks/bench_fragment_sizes.py --pairs 20000 --positions_per_pair 20
+"""
+import json
+import time
+from collections import namedtuple
+
+import click
+import numpy as np
+import pysam
+
+from common import measure
+from sequence_qc.noise_by_tlen import ReadPositionIndex, _fragment_size_record
+
+
+NoisePosition = namedtuple('NoisePosition', ['chrom', 'pos', 'A', 'C', 'G', 'T'])
+
+
+def synthetic_pairs(pairs: int, read_length: int = 100, indels_per_read: int = 4, seed: int = 0) -> list:
+    """
+    Overlapping read pairs, each read with soft clips at both ends and `indels_per_read` alternating indels
+
+    :return: list - (read1, read2) tuples of pysam.AlignedSegment
+    """
+    rng = np.random.default_rng(seed)
+    header = pysam.AlignmentHeader.from_dict({'SQ': [{'SN': '1', 'LN': 100000}]})
+    result = []
+    for pair in range(pairs):
+        reads = []
+        for mate in range(2):
+            clips = rng.integers(1, 10, 2)
+            blocks = np.diff(np.sort(rng.choice(np.arange(1, read_length - clips.sum()), indels_per_read,
+                                                replace=False)), prepend=0, append=read_length - clips.sum())
+            cigar = [(4, int(clips[0]))]
+            for i, block in enumerate(blocks):
+                if i:
+                    cigar.append((1 if i % 2 else 2, int(rng.integers(1, 4))))
+                cigar.append((0, int(block)))
+            cigar.append((4, int(clips[1])))
+            read = pysam.AlignedSegment(header)
+            read.query_name = 'pair{}'.format(pair)
+            read.query_sequence = ''.join(rng.choice(list('ACGTN'), read_length, p=[.245, .245, .245, .245, .02]))
+            read.flag = 1 | 2 | (64 if mate == 0 else 128)
+            read.reference_id = 0
+            read.reference_start = 1000 + mate * 20
+            read.cigartuples = cigar
+            read.template_length = 150 if mate == 0 else -150
+            reads.append(read)
+        result.append(tuple(reads))
+    return result
+
+
+def legacy_fragment_size_record(read1, read2, noise_pos, mifs, mafs):
+    """
+    Classification that `ReadPositionIndex` replaced, indexing the read sequence by the distance from the alignment
+    start, which ignores soft clips and indels
+    """
+    base_counts = {'A': noise_pos.A, 'C': noise_pos.C, 'G': noise_pos.G, 'T': noise_pos.T}
+    genotype = max(base_counts, key=base_counts.get)
+    non_geno_bases = ['A', 'C', 'G', 'T']
+    non_geno_bases.remove(genotype)
+
+    try:
+        if not mifs <= abs(read1.tlen) <= mafs:
+            return None
+        position_is_within_read_1 = (read1.pos <= int(noise_pos.pos) <= read1.aend)
+        position_is_within_read_2 = (read2.pos <= int(noise_pos.pos) <= read2.aend)
+        read_1_base = read1.seq[int(noise_pos.pos) - read1.pos]
+        read_2_base = read2.seq[int(noise_pos.pos) - read2.pos]
+
+        if ((position_is_within_read_1 and read_1_base in non_geno_bases)
+                or (position_is_within_read_2 and read_2_base in non_geno_bases)):
+            sub_type = genotype + '>' + (read_1_base if position_is_within_read_1 else read_2_base)
+            return read1.qname, sub_type, abs(read1.tlen), 'not_' + genotype
+        elif ((position_is_within_read_1 and read_1_base == genotype)
+                or (position_is_within_read_2 and read_2_base == genotype)):
+            return read1.qname, "GENOTYPE", abs(read1.tlen), genotype
+        elif ((position_is_within_read_1 and read_1_base == 'N')
+                or (position_is_within_read_2 and read_2_base == 'N')):
+            return read1.qname, "N", abs(read1.tlen), genotype
+    except (IndexError, AttributeError, TypeError):
+        pass
+    return None
+
+
+def classify(method: str, read_pairs: list, positions: list) -> list:
+    records = []
+    for read1, read2 in read_pairs:
+        if method == 'cigar_index':
+            read_indexes = ReadPositionIndex(read1), ReadPositionIndex(read2)
+            for noise_pos in positions:
+                records.append(_fragment_size_record(read1, read2, noise_pos, 0, 1000, *read_indexes))
+        else:
+            for noise_pos in positions:
+                records.append(legacy_fragment_size_record(read1, read2, noise_pos, 0, 1000))
+    return records
+
+
+def run(method: str, pairs: int, positions_per_pair: int) -> dict:
+    read_pairs = synthetic_pairs(pairs)
+    positions = [NoisePosition('1', pos, 100, 1, 1, 1) for pos in range(1020, 1020 + positions_per_pair)]
+    start = time.perf_counter()
+    records = classify(method, read_pairs, positions)
+    elapsed = time.perf_counter() - start
+    result = {'stage_time_s': elapsed, 'classifications_per_s': len(records) / elapsed}
+    if method == 'legacy':
+        result['records_differing'] = sum(a != b for a, b in zip(records, classify('cigar_index', read_pairs, positions)))
+    return result
+
+
+@click.command()
+@click.option("--pairs", default=20000, help="Number of read pairs")
+@click.option("--positions_per_pair", default=20, help="Number of noisy positions covered by each pair")
+def main(pairs, positions_per_pair):
+    results = []
+    for method in ['cigar_index', 'legacy']:
+        result = measure(run, method, pairs, positions_per_pair)
+        result.update({'method': method, 'pairs': pairs, 'positions_per_pair': positions_per_pair})
+        results.append(result)
+        click.echo(json.dumps(result), err=True)
+    click.echo(json.dumps({'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
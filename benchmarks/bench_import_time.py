@@ -0,0 +1,82 @@
+"""
+Benchmark the import time of the sequence_qc modules and the startup time of the CLI
+
+Each target is run several times in a fresh interpreter, which reports its wall time and whether the plotting
+libraries were loaded. Use `python -X importtime -c "import sequence_qc.cli"` to break down a slow import.
+
+Usage: python benchmarks/bench_import_time.py --repeats 5 --output import_time.json
+"""
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+
+
+PLOTTING_MODULES = ['plotly', 'scipy']
+
+TARGETS = {
+    'import sequence_qc.cli': 'import sequence_qc.cli',
+    'import sequence_qc.noise': 'import sequence_qc.noise',
+    'import sequence_qc.plots': 'import sequence_qc.plots',
+    'calculate_noise --help': 'import sys; sys.argv = ["calculate_noise", "--help"]\n'
+                              'from sequence_qc.cli import calculate_noise\n'
+                              'try:\n'
+                              '    calculate_noise()\n'
+                              'except SystemExit:\n'
+                              '    pass',
+}
+
+
+def _script(code: str) -> str:
+    return '\n'.join([
+        'import json, sys, time',
+        'start = time.perf_counter()',
+        code,
+        'elapsed = time.perf_counter() - start',
+        'loaded = sorted(m for m in {} if m in sys.modules)'.format(PLOTTING_MODULES),
+        'print(json.dumps({"in_process_s": elapsed, "plotting_modules": loaded}), file=sys.stderr)',
+    ])
+
+
+def run(code: str) -> dict:
+    """
+    Run `code` in a fresh interpreter
+
+    :return: dict - wall time of the interpreter, time spent in `code`, and plotting modules that were loaded
+    """
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', _script(code)], capture_output=True, text=True, check=True)
+    wall_time = time.perf_counter() - start
+    return dict(json.loads(result.stderr.strip().splitlines()[-1]), wall_time_s=wall_time)
+
+
+@click.command()
+@click.option("--repeats", default=5, help="Number of fresh interpreters for each target")
+@click.option("--output", required=False, help="Write the results to this JSON file, instead of stdout")
+def main(repeats, output):
+    baseline = statistics.median(run('pass')['wall_time_s'] for _ in range(repeats))
+    results = []
+    for name, code in TARGETS.items():
+        runs = [run(code) for _ in range(repeats)]
+        result = {
+            'target': name,
+            'wall_time_s': statistics.median(r['wall_time_s'] for r in runs),
+            'in_process_s': statistics.median(r['in_process_s'] for r in runs),
+            'plotting_modules': runs[0]['plotting_modules'],
+        }
+        results.append(result)
+        click.echo(json.dumps(result), err=True)
+
+    report = json.dumps({'interpreter_startup_s': baseline, 'repeats': repeats, 'results': results}, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        click.echo(report)
+
+
+if __name__ == '__main__':
+    main()
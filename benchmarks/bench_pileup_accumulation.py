@@ -0,0 +1,72 @@
+"""
+Benchmark building the combined pileup data frame as the number of BED intervals grows
+
+Compares concatenating data frames inside the interval loop (the previous behaviour of `calculate_noise`)
+against `PileupAccumulator`, which concatenates the per-interval record arrays once.
+
+Usage: python benchmarks/bench_pileup_accumulation.py --intervals 500 --intervals 2000 --intervals 8000
+"""
+import json
+
+import click
+import numpy as np
+import pandas as pd
+from pysamstats import config
+
+from common import measure
+from sequence_qc.pileup import PileupAccumulator
+
+
+def synthetic_pileups(n_intervals: int, interval_size: int):
+    """
+    Generate `n_intervals` (variation, tlen) record arrays with the dtypes produced by pysamstats
+
+    :param n_intervals: int - number of intervals
+    :param interval_size: int - positions per interval
+    """
+    rng = np.random.default_rng(0)
+    variation_dtype = dict(config.dtype_variation, chrom='a2')
+    tlen_dtype = dict(config.dtype_tlen_strand, chrom='a2')
+    for i in range(n_intervals):
+        pileup = np.zeros(interval_size, dtype=list(variation_dtype.items()))
+        tlen = np.zeros(interval_size, dtype=list(tlen_dtype.items()))
+        for array in [pileup, tlen]:
+            array['chrom'] = b'1'
+            array['pos'] = np.arange(i * interval_size, (i + 1) * interval_size)
+        for base in ['A', 'C', 'G', 'T']:
+            pileup[base] = rng.integers(0, 20000, interval_size)
+        yield pileup.view(np.recarray), tlen.view(np.recarray)
+
+
+def concat_in_loop(n_intervals: int, interval_size: int) -> None:
+    pileup_df_all = pd.DataFrame()
+    tlen_df_all = pd.DataFrame()
+    for pileup, tlen in synthetic_pileups(n_intervals, interval_size):
+        pileup_df_all = pd.concat([pileup_df_all, pd.DataFrame(pileup)])
+        tlen_df_all = pd.concat([tlen_df_all, pd.DataFrame(tlen)])
+
+
+def accumulate(n_intervals: int, interval_size: int) -> None:
+    accumulator = PileupAccumulator()
+    for pileup, tlen in synthetic_pileups(n_intervals, interval_size):
+        accumulator.add(pileup, tlen)
+    accumulator.to_frames()
+
+
+@click.command()
+@click.option("--intervals", multiple=True, type=int, default=[250, 500, 1000, 2000],
+              help="Interval counts to benchmark (repeatable)")
+@click.option("--interval_size", default=150, help="Number of positions in each interval")
+def main(intervals, interval_size):
+    results = []
+    for n_intervals in intervals:
+        for name, func in [('concat_in_loop', concat_in_loop), ('accumulator', accumulate)]:
+            result = measure(func, n_intervals, interval_size)
+            result.update({'method': name, 'intervals': n_intervals, 'positions': n_intervals * interval_size})
+            results.append(result)
+            click.echo(json.dumps(result), err=True)
+    click.echo(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark each stage of the noise pipeline on synthetic datasets
+
+Datasets are generated by `synthetic.make_dataset` for every combination of depth, interval count and noisy site
+density, and reused across runs from `--data_dir`. Each dataset is run in a fresh interpreter, which reports the
+wall time, peak RSS so far and positions per second of each stage:
+
+    pileup, alt_and_geno, threshold_filter, substitution, fragment_sizes, plots
+
+Usage: python benchmarks/bench_pipeline.py --depth 200 --depth 1000 --intervals 50 --noisy_fraction 0.01 \
+    --output pipeline.json
+"""
+import itertools
+import json
+import os
+import tempfile
+import time
+
+import click
+
+from common import _peak_rss_mb, measure
+from synthetic import make_dataset
+from sequence_qc import noise, plots
+from sequence_qc.noise import ALT_COUNT, bed_intervals
+from sequence_qc.noise_by_tlen import get_fragment_size_for_sample
+from sequence_qc.pileup import ENGINES, PYSAMSTATS, PileupAccumulator, pileup_intervals
+
+
+def _timed(stages: dict, name: str, positions: int, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    stages[name] = {
+        'wall_time_s': elapsed,
+        'peak_rss_mb': _peak_rss_mb(),
+        'positions': positions,
+        'positions_per_s': positions / elapsed if elapsed else None,
+    }
+    return result
+
+
+def _pileup(dataset: dict, threads: int, engine: str):
+    accumulator = PileupAccumulator()
+    intervals = bed_intervals(dataset['bed'])
+    for pileup, tlen in pileup_intervals(dataset['fasta'], dataset['bam'], intervals, threads=threads, engine=engine):
+        accumulator.add(pileup, tlen)
+    return accumulator.to_frames()[0]
+
+
+def _threshold_filter(pileup, threshold: float):
+    below_thresh_positions = pileup[noise._threshold_mask(pileup, threshold)]
+    noisy_boolv = (below_thresh_positions[ALT_COUNT] > 0) | (below_thresh_positions['insertions'] > 0)
+    noisy_positions = below_thresh_positions[noisy_boolv].sort_values(ALT_COUNT, ascending=False)
+    below_thresh_positions_del = pileup[noise._deletion_threshold_mask(pileup, threshold)]
+    return below_thresh_positions, noisy_positions, below_thresh_positions_del
+
+
+def run(dataset: dict, threshold: float, threads: int, engine: str) -> dict:
+    stages = {}
+    positions = dataset['positions']
+    with tempfile.TemporaryDirectory() as output_dir:
+        os.chdir(output_dir)
+        pileup = _timed(stages, 'pileup', positions, _pileup, dataset, threads, engine)
+        pileup = _timed(stages, 'alt_and_geno', positions, noise._calculate_alt_and_geno, pileup)
+        below_thresh_positions, noisy_positions, _ = _timed(
+            stages, 'threshold_filter', positions, _threshold_filter, pileup, threshold)
+        st_df = _timed(stages, 'substitution', len(below_thresh_positions),
+                       noise._calculate_noise_by_substitution, below_thresh_positions, 'bench')
+        noisy_tlen_df = _timed(stages, 'fragment_sizes', len(noisy_positions), get_fragment_size_for_sample,
+                               'bench', dataset['bam'], 'bench', noisy_positions, 0, 500)
+        _timed(stages, 'plots', positions, plots.all_plots, pileup, noisy_positions, st_df, noisy_tlen_df, 'bench')
+    return {'positions': len(pileup), 'noisy_positions': len(noisy_positions), 'stages': stages}
+
+
+@click.command()
+@click.option("--depth", multiple=True, type=int, default=[200, 1000], help="Read depths to benchmark (repeatable)")
+@click.option("--intervals", multiple=True, type=int, default=[50], help="Interval counts to benchmark (repeatable)")
+@click.option("--noisy_fraction", multiple=True, type=float, default=[0.01],
+              help="Fractions of positions that are noisy sites (repeatable)")
+@click.option("--interval_length", default=150, help="Number of positions in each interval")
+@click.option("--threshold", default=0.02, help="Noise threshold")
+@click.option("--threads", default=1, help="Number of processes for the pileup")
+@click.option("--engine", default=PYSAMSTATS, type=click.Choice(ENGINES), help="Pileup engine")
+@click.option("--data_dir", default=os.path.join(tempfile.gettempdir(), 'sequence_qc_benchmarks'),
+              help="Directory for the generated datasets, which are reused by later runs")
+@click.option("--output", required=False, help="Write the results to this JSON file, instead of stdout")
+def main(depth, intervals, noisy_fraction, interval_length, threshold, threads, engine, data_dir, output):
+    results = []
+    for d, n, f in itertools.product(depth, intervals, noisy_fraction):
+        dataset = make_dataset(data_dir, n_intervals=n, depth=d, noisy_fraction=f, interval_length=interval_length)
+        result = measure(run, dataset, threshold, threads, engine)
+        result.update({'depth': d, 'intervals': n, 'noisy_fraction': f, 'interval_length': interval_length,
+                       'threshold': threshold, 'threads': threads, 'engine': engine})
+        results.append(result)
+        click.echo(json.dumps(result), err=True)
+
+    report = json.dumps({'results': results}, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        click.echo(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Benchmark the end-to-end wall time of `calculate_noise`, run sequentially and in pipelined mode
+
+Each run writes its outputs to a fresh directory, and the outputs of the pipelined runs are checked against the
+sequential run of the same dataset, which they must match byte for byte. The time of each stage is reported from
+the run metrics, including the time spent in background writes and the time the computation waited for them.
+
+Usage: python benchmarks/bench_pipelined.py --depth 500 --intervals 200 --threads 1 --threads 4
+"""
+import hashlib
+import itertools
+import json
+import os
+import tempfile
+
+import click
+
+from common import measure
+from synthetic import make_dataset
+from sequence_qc.metrics import Metrics
+from sequence_qc.noise import calculate_noise
+from sequence_qc.pipeline import PIPELINE_QUEUE_SIZE
+from sequence_qc.settings import NoiseSettings
+from sequence_qc.tables import OUTPUT_FORMATS, TSV
+
+
+def run(dataset: dict, threshold: float, threads: int, output_format: str, pipelined: bool, queue_size: int) -> dict:
+    metrics = Metrics()
+    with tempfile.TemporaryDirectory() as output_dir:
+        os.chdir(output_dir)
+        settings = NoiseSettings(threads=threads, output_format=output_format, make_plots=False,
+                                 pipelined=pipelined, queue_size=queue_size)
+        calculate_noise(dataset['fasta'], dataset['bam'], dataset['bed'], threshold, sample_id='bench',
+                        settings=settings, metrics=metrics)
+        digests = {}
+        for filename in sorted(os.listdir(output_dir)):
+            with open(filename, 'rb') as f:
+                digests[filename] = hashlib.sha256(f.read()).hexdigest()
+    return {'stages': metrics.stages, 'outputs': digests}
+
+
+@click.command()
+@click.option("--depth", multiple=True, type=int, default=[500], help="Read depths to benchmark (repeatable)")
+@click.option("--intervals", multiple=True, type=int, default=[200], help="Interval counts to benchmark (repeatable)")
+@click.option("--noisy_fraction", multiple=True, type=float, default=[0.01],
+              help="Fractions of positions that are noisy sites (repeatable)")
+@click.option("--interval_length", default=150, help="Number of positions in each interval")
+@click.option("--threshold", default=0.02, help="Noise threshold")
+@click.option("--threads", multiple=True, type=int, default=[1, 4], help="Numbers of pileup processes (repeatable)")
+@click.option("--output_format", default=TSV, type=click.Choice(OUTPUT_FORMATS), help="Format of the tables")
+@click.option("--queue_size", default=PIPELINE_QUEUE_SIZE, help="Queue size of the pipelined runs")
+@click.option("--data_dir", default=os.path.join(tempfile.gettempdir(), 'sequence_qc_benchmarks'),
+              help="Directory for the generated datasets, which are reused by later runs")
+def main(depth, intervals, noisy_fraction, interval_length, threshold, threads, output_format, queue_size, data_dir):
+    results = []
+    for d, n, f in itertools.product(depth, intervals, noisy_fraction):
+        dataset = make_dataset(data_dir, n_intervals=n, depth=d, noisy_fraction=f, interval_length=interval_length)
+        for t in threads:
+            sequential = None
+            for pipelined in [False, True]:
+                result = measure(run, dataset, threshold, t, output_format, pipelined, queue_size)
+                outputs = result.pop('outputs')
+                if sequential is None:
+                    sequential = result
+                    sequential_outputs = outputs
+                else:
+                    result['speedup'] = sequential['wall_time_s'] / result['wall_time_s']
+                    result['identical_outputs'] = outputs == sequential_outputs
+                result.update({'depth': d, 'intervals': n, 'noisy_fraction': f, 'interval_length': interval_length,
+                               'threads': t, 'output_format': output_format, 'pipelined': pipelined,
+                               'queue_size': queue_size})
+                results.append(result)
+                click.echo(json.dumps(result), err=True)
+    click.echo(json.dumps({'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Benchmark the accuracy and throughput of subsampling reads by hashed read name
+
+Each run calls `calculate_noise` on a synthetic dataset with a fixed `subsample_fraction`, or with a
+`target_precision` that chooses the fraction from a pilot pileup, and reports its wall time, the fraction used, and
+the acgt noise with its 95% confidence interval. Runs are compared with the run using every read, which is always
+included, by the relative error of the noise and whether the interval contains the noise of the full run.
+
+Usage: python benchmarks/bench_subsample.py --depth 4000 --fraction 0.25 --target_precision 0.05
+"""
+import json
+import os
+import tempfile
+
+import click
+import pandas as pd
+
+from common import measure
+from synthetic import make_dataset
+from sequence_qc.noise import NOISE_ACGT, calculate_noise
+from sequence_qc.settings import NoiseSettings
+
+
+def run(dataset: dict, threshold: float, subsample_kwargs: dict) -> dict:
+    with tempfile.TemporaryDirectory() as output_dir:
+        os.chdir(output_dir)
+        calculate_noise(dataset['fasta'], dataset['bam'], dataset['bed'], threshold, sample_id='bench',
+                        settings=NoiseSettings(make_plots=False, **subsample_kwargs))
+        acgt = pd.read_csv('bench' + NOISE_ACGT, sep='\t').drop(columns='sample_id')
+        return json.loads(acgt.to_json(orient='records'))[0]
+
+
+@click.command()
+@click.option("--depth", default=4000, help="Read depth of the dataset")
+@click.option("--intervals", default=40, help="Number of intervals of the dataset")
+@click.option("--noisy_fraction", default=0.01, help="Fraction of positions that are noisy sites")
+@click.option("--threshold", default=0.02, help="Noise threshold")
+@click.option("--fraction", multiple=True, type=float, default=[0.1, 0.25, 0.5],
+              help="Fixed subsampling fractions (repeatable)")
+@click.option("--target_precision", multiple=True, type=float, default=[0.05, 0.1],
+              help="Target precisions (repeatable)")
+@click.option("--data_dir", default=os.path.join(tempfile.gettempdir(), 'sequence_qc_benchmarks'),
+              help="Directory for the generated datasets, which are reused by later runs")
+def main(depth, intervals, noisy_fraction, threshold, fraction, target_precision, data_dir):
+    dataset = make_dataset(data_dir, n_intervals=intervals, depth=depth, noisy_fraction=noisy_fraction)
+    cases = [{}] + [{'subsample_fraction': f} for f in fraction] + [{'target_precision': p} for p in target_precision]
+    results = []
+    for subsample_kwargs in cases:
+        result = measure(run, dataset, threshold, subsample_kwargs)
+        result.update(subsample_kwargs, depth=depth, intervals=intervals, noisy_fraction=noisy_fraction)
+        if results:
+            full = results[0]
+            result['speedup'] = full['wall_time_s'] / result['wall_time_s']
+            result['relative_error'] = abs(result['noise_fraction'] / full['noise_fraction'] - 1)
+            result['contains_full_noise'] = bool(
+                result['noise_fraction_ci_lower'] <= full['noise_fraction'] <= result['noise_fraction_ci_upper'])
+        results.append(result)
+        click.echo(json.dumps(result), err=True)
+    click.echo(json.dumps({'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
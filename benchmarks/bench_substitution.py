@@ -0,0 +1,99 @@
+"""
+Benchmark `_calculate_noise_by_substitution` on a synthetic pileup
+
+The vectorized implementation runs on the full pileup. The previous row-by-row implementation is kept below
+for comparison; it is run on a smaller subset (it needs hours for 10M positions), its throughput is
+extrapolated, and its result is checked against the vectorized implementation on that subset.
+
+Usage: python benchmarks/bench_substitution.py --positions 10000000 --legacy_positions 100000
+"""
+import json
+import time
+
+import click
+import numpy as np
+import pandas as pd
+
+from common import measure
+from sequence_qc.noise import (
+    SUBSTITUTION_TYPES, ALT_COUNT, GENO_COUNT, CONTRIBUTING_SITES, NOISE_FRACTION, _calculate_noise_by_substitution
+)
+
+
+def synthetic_pileup(positions: int, depth: int = 20000, seed: int = 0) -> pd.DataFrame:
+    """
+    Below-threshold pileup where each position has a random genotype base and sparse low-level alt counts
+
+    :param positions: int - number of positions
+    :param depth: int - approximate depth of the genotype base
+    :param seed: int - seed for the random generator
+    :return: pd.DataFrame - columns A, C, G, T
+    """
+    rng = np.random.default_rng(seed)
+    counts = rng.poisson(0.5, size=(positions, 4)).astype(np.int32)
+    genotype = rng.integers(0, 4, positions)
+    counts[np.arange(positions), genotype] = rng.poisson(depth, positions)
+    return pd.DataFrame(counts, columns=['A', 'C', 'G', 'T'])
+
+
+def legacy_noise_by_substitution(below_thresh_positions: pd.DataFrame, sample_id: str) -> pd.DataFrame:
+    """
+    Row-by-row implementation that `_calculate_noise_by_substitution` replaced
+    """
+    st_alt_counts = {st: 0 for st in SUBSTITUTION_TYPES}
+    st_geno_counts = {st: 0 for st in SUBSTITUTION_TYPES}
+    st_contributing_sites = {st: 0 for st in SUBSTITUTION_TYPES}
+
+    for _, row in below_thresh_positions.iterrows():
+        alts = ['A', 'C', 'G', 'T']
+        base_counts = {'A': row['A'], 'C': row['C'], 'G': row['G'], 'T': row['T']}
+        genotype = max(base_counts, key=base_counts.get)
+        alts.remove(genotype)
+        geno_count = row[['A', 'C', 'G', 'T']].max()
+
+        for alt in alts:
+            st = genotype + '>' + alt
+            st_geno_counts[st] += geno_count
+            st_alt_counts[st] += row[alt]
+
+            if row[alt] > 0:
+                st_contributing_sites[st] += 1
+
+    st_df = pd.DataFrame.from_dict(st_alt_counts, orient='index', columns=[ALT_COUNT])
+    st_df[GENO_COUNT] = st_df.index.map(st_geno_counts)
+    st_df[CONTRIBUTING_SITES] = st_df.index.map(st_contributing_sites)
+    st_df[NOISE_FRACTION] = st_df[ALT_COUNT] / (st_df[ALT_COUNT] + st_df[GENO_COUNT])
+    st_df['sample_id'] = sample_id
+    return st_df
+
+
+def run(method: str, positions: int) -> dict:
+    pileup = synthetic_pileup(positions)
+    func = legacy_noise_by_substitution if method == 'iterrows' else _calculate_noise_by_substitution
+    start = time.perf_counter()
+    st_df = func(pileup, 'bench')
+    elapsed = time.perf_counter() - start
+    result = {'stage_time_s': elapsed, 'positions_per_s': positions / elapsed}
+    if method == 'iterrows':
+        vectorized_df = _calculate_noise_by_substitution(pileup, 'bench')
+        result['matches_vectorized'] = st_df.to_csv(sep='\t') == vectorized_df.to_csv(sep='\t')
+    return result
+
+
+@click.command()
+@click.option("--positions", default=10000000, help="Number of positions for the vectorized implementation")
+@click.option("--legacy_positions", default=100000, help="Number of positions for the row-by-row implementation")
+def main(positions, legacy_positions):
+    results = []
+    for method, n in [('bincount', positions), ('iterrows', legacy_positions)]:
+        result = measure(run, method, n)
+        result.update({'method': method, 'positions': n})
+        results.append(result)
+        click.echo(json.dumps(result), err=True)
+
+    speedup = results[0]['positions_per_s'] / results[1]['positions_per_s']
+    click.echo(json.dumps({'results': results, 'speedup': speedup}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
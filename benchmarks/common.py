@@ -0,0 +1,45 @@
+"""
+Helpers shared by the benchmark scripts
+"""
+import multiprocessing
+import resource
+import sys
+import time
+
+
+def _peak_rss_mb() -> float:
+    """
+    Peak resident set size of the current process, in MB
+
+    ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / 1024 ** 2
+    return peak / 1024
+
+
+def _run(func, args, queue):
+    start = time.perf_counter()
+    extra = func(*args)
+    wall_time = time.perf_counter() - start
+    result = {'wall_time_s': wall_time, 'peak_rss_mb': _peak_rss_mb()}
+    result.update(extra or {})
+    queue.put(result)
+
+
+def measure(func, *args) -> dict:
+    """
+    Run `func(*args)` in a freshly spawned interpreter, so that peak RSS is not polluted by earlier cases
+
+    :param func: module-level callable to benchmark, which may return a dict of extra fields to report
+    :param args: arguments for `func`
+    :return: dict - wall_time_s and peak_rss_mb of the run, updated with the fields returned by `func`
+    """
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run, args=(func, args, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
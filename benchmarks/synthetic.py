@@ -0,0 +1,122 @@
+"""
+Synthetic reference, BED and BAM files for the benchmarks
+
+Reads are simulated as proper pairs around evenly spaced target intervals, with background sequencing errors
+and a set of noisy sites where a fixed alt base is seen at a low allele frequency. Depth, the number of intervals
+and the density of noisy sites can be scaled independently.
+"""
+import os
+
+import numpy as np
+import pysam
+
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+
+def dataset_name(n_intervals: int, depth: int, noisy_fraction: float, interval_length: int, seed: int) -> str:
+    return 'synthetic_i{}_d{}_n{}_l{}_s{}'.format(n_intervals, depth, noisy_fraction, interval_length, seed)
+
+
+def make_dataset(directory: str, n_intervals: int = 50, depth: int = 500, noisy_fraction: float = 0.01,
+                 interval_length: int = 150, noisy_vaf: float = 0.005, error_rate: float = 0.001,
+                 read_length: int = 100, interval_gap: int = 1000, seed: int = 0, chrom: str = '1') -> dict:
+    """
+    Write a synthetic dataset to `directory`, or reuse it if it was already generated with the same parameters
+
+    :param directory: str - output directory
+    :param n_intervals: int - number of BED intervals
+    :param depth: int - approximate read depth over the intervals
+    :param noisy_fraction: float - fraction of interval positions that are noisy sites
+    :param interval_length: int - length of each BED interval
+    :param noisy_vaf: float - allele frequency of the alt base at noisy sites
+    :param error_rate: float - background rate of random base substitutions
+    :param read_length: int - length of each read
+    :param interval_gap: int - distance between consecutive intervals
+    :param seed: int - seed for the random generator
+    :param chrom: str - contig name
+    :return: dict - paths of the 'fasta', 'bed' and 'bam' files, and the number of 'positions' and 'noisy_sites'
+    """
+    prefix = os.path.join(directory, dataset_name(n_intervals, depth, noisy_fraction, interval_length, seed))
+    rng = np.random.default_rng(seed)
+    ref_length = n_intervals * (interval_length + interval_gap) + interval_gap
+    starts = interval_gap + np.arange(n_intervals) * (interval_length + interval_gap)
+    target = np.concatenate([np.arange(start, start + interval_length) for start in starts])
+    noisy_sites = rng.choice(target, size=int(len(target) * noisy_fraction), replace=False)
+    dataset = {
+        'fasta': prefix + '.fa',
+        'bed': prefix + '.bed',
+        'bam': prefix + '.bam',
+        'positions': len(target),
+        'noisy_sites': len(noisy_sites),
+    }
+    if all(os.path.exists(dataset[f]) for f in ['fasta', 'bed', 'bam']):
+        return dataset
+
+    os.makedirs(directory, exist_ok=True)
+    ref = BASES[rng.integers(0, 4, ref_length)]
+    # Each noisy site has a fixed alt base, different from the reference
+    noisy_alt = np.zeros(ref_length, dtype=np.uint8)
+    ref_index = np.searchsorted(BASES, ref[noisy_sites])
+    noisy_alt[noisy_sites] = BASES[(ref_index + rng.integers(1, 4, len(noisy_sites))) % 4]
+
+    _write_fasta(dataset['fasta'], chrom, ref)
+    with open(dataset['bed'], 'w') as f:
+        for start in starts:
+            f.write('{}\t{}\t{}\n'.format(chrom, start, start + interval_length))
+
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': chrom, 'LN': ref_length}]}
+    qualities = pysam.qualitystring_to_array('I' * read_length)
+    pairs_per_interval = int(depth * (interval_length + read_length) / (2 * read_length))
+    unsorted_path = prefix + '.unsorted.bam'
+    with pysam.AlignmentFile(unsorted_path, 'wb', header=header) as bam:
+        pair = 0
+        for start in starts:
+            fragment_starts = rng.integers(start - read_length, start + interval_length, pairs_per_interval)
+            fragment_lengths = np.clip(rng.normal(180, 40, pairs_per_interval).astype(int), read_length, 400)
+            for fragment_start, fragment_length in zip(fragment_starts, fragment_lengths):
+                mate_starts = [fragment_start, fragment_start + fragment_length - read_length]
+                for mate, read_start in enumerate(mate_starts):
+                    read = pysam.AlignedSegment()
+                    read.query_name = 'pair{}'.format(pair)
+                    read.query_sequence = _simulate_read(rng, ref, noisy_alt, read_start, read_length, noisy_vaf,
+                                                         error_rate)
+                    read.flag = 1 | 2 | (32 | 64 if mate == 0 else 16 | 128)
+                    read.reference_id = 0
+                    read.reference_start = int(read_start)
+                    read.mapping_quality = 60
+                    read.cigartuples = [(0, read_length)]
+                    read.next_reference_id = 0
+                    read.next_reference_start = int(mate_starts[1 - mate])
+                    read.template_length = int(fragment_length) if mate == 0 else -int(fragment_length)
+                    read.query_qualities = qualities
+                    bam.write(read)
+                pair += 1
+
+    pysam.sort('-o', dataset['bam'], unsorted_path)
+    pysam.index(dataset['bam'])
+    os.remove(unsorted_path)
+    return dataset
+
+
+def _simulate_read(rng, ref: np.ndarray, noisy_alt: np.ndarray, start: int, read_length: int, noisy_vaf: float,
+                   error_rate: float) -> str:
+    """
+    Bases of a read starting at `start`, with noisy site alts and random substitutions
+    """
+    seq = ref[start:start + read_length].copy()
+    alts = noisy_alt[start:start + read_length]
+    noisy = (alts > 0) & (rng.random(read_length) < noisy_vaf)
+    seq[noisy] = alts[noisy]
+    errors = rng.random(read_length) < error_rate
+    seq[errors] = BASES[rng.integers(0, 4, errors.sum())]
+    return seq.tobytes().decode('ascii')
+
+
+def _write_fasta(path: str, chrom: str, ref: np.ndarray, line_length: int = 60) -> None:
+    sequence = ref.tobytes().decode('ascii')
+    with open(path, 'w') as f:
+        f.write('>{}\n'.format(chrom))
+        for i in range(0, len(sequence), line_length):
+            f.write(sequence[i:i + line_length] + '\n')
+    pysam.faidx(path)
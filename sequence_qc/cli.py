@@ -1,32 +1,240 @@
 import click
+import os
 
-from sequence_qc import noise
+from sequence_qc import noise, report
+from sequence_qc.cohort_store import COHORT_NOISE, SITE_OUTLIERS, CohortStore
+from sequence_qc.metrics import NO_METRICS, Metrics, profiled
+from sequence_qc.pileup import ENGINES, PYSAMSTATS
+from sequence_qc.pipeline import PIPELINE_QUEUE_SIZE
+from sequence_qc.settings import NoiseSettings
+from sequence_qc.tables import OUTPUT_FORMATS, TSV
+
+
+def option_group(*decorators):
+    """
+    Apply a group of click options, which are listed in --help in the order they are given
+    """
+    def apply(f):
+        for decorator in reversed(decorators):
+            f = decorator(f)
+        return f
+    return apply
+
+
+# Options shared by the noise commands, each defined once so that their names, defaults and help stay the same
+ref_fasta_option = click.option("--ref_fasta", required=True,
+                                help="Path to reference fasta, containing all regions in bed_file")
+bam_file_option = click.option("--bam_file", required=True, help="Path to BAM file for calculating noise")
+bed_file_option = click.option("--bed_file", required=True,
+                               help="Path to BED file containing regions over which to calculate noise")
+pileup_filter_options = option_group(
+    click.option("--threshold", default=0.02,
+                 help="Alt allele frequency past which to ignore positions from the calculation"),
+    click.option("--truncate", default=1, help="Whether to exclude trailing bases from reads that only partially "
+                                               "overlap the bed file (0 or 1)"),
+    click.option("--min_mapq", default=1, help="Exclude reads with a lower mapping quality"),
+    click.option("--min_basq", default=1, help="Exclude bases with a lower base quality"),
+    click.option("--max_depth", default=30000, help="Maximum read depth for calculation"),
+)
+output_format_option = click.option("--output_format", default=TSV, type=click.Choice(OUTPUT_FORMATS),
+                                    help="Format of the pileup, tlen and noise positions tables")
+cache_checksum_option = click.option("--cache_checksum", is_flag=True,
+                                     help="Key the cached pileup by checksums of the BAM and reference instead of "
+                                          "their modification times")
+bed_padding_option = click.option("--bed_padding", default=0,
+                                  help="Number of bases added on either side of each region in bed_file, before "
+                                       "overlapping regions are merged")
+engine_option = click.option("--engine", default=PYSAMSTATS, type=click.Choice(ENGINES),
+                             help="Pileup with pysamstats, or only count bases with pysam, which is faster but "
+                                  "leaves the tlen table empty")
+no_plots_option = click.option("--no_plots", is_flag=True,
+                               help="Skip the HTML report and the import of the plotting libraries, only writing the "
+                                    "report data for render_report")
+pipeline_options = option_group(
+    click.option("--pipelined", is_flag=True, help="Overlap the pileup, the noise calculation and the writing of "
+                                                   "output files, with the same outputs"),
+    click.option("--queue_size", default=PIPELINE_QUEUE_SIZE,
+                 help="With --pipelined, number of pileup shards and of output writes that can wait for the next "
+                      "step"),
+)
+metrics_options = option_group(
+    click.option("--metrics_json", required=False, help="Write the time of each stage, and counts of intervals, "
+                                                        "positions, reads and bytes written, to this JSON file"),
+    click.option("--profile", required=False,
+                 help="Profile the run with cProfile, and write the stats to this file"),
+)
+subsample_options = option_group(
+    click.option("--subsample_fraction", default=1.0, help="Only use the reads whose hashed read name falls below "
+                                                           "this fraction, the same reads on every run"),
+    click.option("--target_precision", type=float, required=False,
+                 help="Subsample reads to the smallest fraction whose noise has a 95% confidence interval within "
+                      "this fraction of the noise, e.g. 0.1, estimated from a pilot pileup"),
+    click.option("--subsample_seed", default=0, help="Seed of the read name hash used for subsampling"),
+)
+
+
+def _noise_settings(min_mapq: int, min_basq: int, no_plots: bool, **settings) -> NoiseSettings:
+    """
+    Settings of the shared options of a noise command, whose other options have the names of the settings
+    """
+    return NoiseSettings(min_mapping_quality=min_mapq, min_base_quality=min_basq, make_plots=not no_plots, **settings)
 
 
 @click.command()
-@click.option("--ref_fasta", required=True, help="Path to reference fasta, containing all regions in bed_file")
-@click.option("--bam_file", required=True, help="Path to BAM file for calculating noise")
-@click.option("--bed_file", required=True, help="Path to BED file containing regions over which to calculate noise")
+@ref_fasta_option
+@bam_file_option
+@bed_file_option
 @click.option("--sample_id", required=False, help="Prefix to include in all output file names")
-@click.option("--threshold", default=0.02, help="Alt allele frequency past which to ignore positions from the calculation")
-@click.option("--truncate", default=1, help="Whether to exclude trailing bases from reads that only partially overlap "
-                                            "the bed file (0 or 1)")
-@click.option("--min_mapq", default=1, help="Exclude reads with a lower mapping quality")
-@click.option("--min_basq", default=1, help="Exclude bases with a lower base quality")
-@click.option("--max_depth", default=30000, help="Maximum read depth for calculation")
-def calculate_noise(ref_fasta, bam_file, bed_file, sample_id, threshold, truncate, min_mapq, min_basq, max_depth):
+@pileup_filter_options
+@click.option("--threads", default=1, help="Number of processes used to pileup the regions in bed_file")
+@click.option("--stream_output", is_flag=True, help="Write the pileup and tlen tables as each region is processed, "
+                                                    "instead of building the tlen table in memory")
+@output_format_option
+@click.option("--cache_pileup", is_flag=True, help="Save the pileup so that recompute_noise can reuse it")
+@cache_checksum_option
+@bed_padding_option
+@metrics_options
+@engine_option
+@no_plots_option
+@click.option("--cohort_store", required=False, help="Directory of a cohort store to add the base counts of the "
+                                                     "sample to, created if it does not exist")
+@pipeline_options
+@subsample_options
+@click.option("--shard", required=False, help="Only process the i-th of N shards of the regions, given as i/N, and "
+                                              "save its statistics for merge_noise instead of the noise outputs")
+def calculate_noise(ref_fasta, bam_file, bed_file, sample_id, threshold, metrics_json, profile, shard, **settings):
     """
     Calculate noise level of given bam file, across the given positions in `bed_file`.
     """
-    sample_level_noise = noise.calculate_noise(
-        ref_fasta=ref_fasta,
-        bam_path=bam_file,
-        bed_file_path=bed_file,
-        noise_threshold=threshold,
-        sample_id=sample_id,
-        truncate=truncate,
-        min_mapping_quality=min_mapq,
-        min_base_quality=min_basq,
-        max_depth=max_depth
-    )
+    settings = _noise_settings(**settings)
+    metrics = Metrics() if metrics_json else NO_METRICS
+    with profiled(profile):
+        if shard:
+            sample_level_noise = noise.calculate_noise_shard(ref_fasta, bam_file, bed_file, threshold, shard,
+                                                             sample_id=sample_id, settings=settings, metrics=metrics)
+        else:
+            sample_level_noise = noise.calculate_noise(ref_fasta, bam_file, bed_file, threshold, sample_id=sample_id,
+                                                       settings=settings, metrics=metrics)
+    if metrics_json:
+        metrics.write_json(metrics_json)
+    print(sample_level_noise)
+
+
+@click.command()
+@click.option("--shard_file", required=True, multiple=True,
+              help="Path to a <sample_id>_shard_<i>_of_<N>_noise_shard.json file written by calculate_noise --shard, "
+                   "one for each of the N shards (repeatable). Its parquet tables are read from the same directory")
+@click.option("--sample_id", required=False, help="Prefix to include in all output file names, by default the "
+                                                  "sample ID of the shards")
+@click.option("--output_format", default=TSV, type=click.Choice(OUTPUT_FORMATS),
+              help="Format of the noise positions table")
+@click.option("--metrics_json", required=False, help="Write the time of each stage to this JSON file")
+@no_plots_option
+def merge_noise(shard_file, sample_id, output_format, metrics_json, no_plots):
+    """
+    Write the noise outputs of a sample from the shards of calculate_noise --shard, as a single run would.
+    """
+    metrics = Metrics() if metrics_json else NO_METRICS
+    sample_level_noise = noise.merge_noise(list(shard_file), sample_id=sample_id, output_format=output_format,
+                                           metrics=metrics, make_plots=not no_plots)
+    if metrics_json:
+        metrics.write_json(metrics_json)
+    print(sample_level_noise)
+
+
+@click.command()
+@ref_fasta_option
+@bam_file_option
+@bed_file_option
+@click.option("--sample_id", required=False, default='', help="Prefix to include in all output file names")
+@pileup_filter_options
+@click.option("--threads", default=1, help="Number of processes used if the pileup has to be recalculated")
+@output_format_option
+@cache_checksum_option
+@click.option("--pileup_cache", required=False, help="Path to the cached pileup, defaults to the one saved by "
+                                                     "calculate_noise --cache_pileup for sample_id")
+@bed_padding_option
+@metrics_options
+@engine_option
+@no_plots_option
+def recompute_noise(ref_fasta, bam_file, bed_file, sample_id, threshold, pileup_cache, metrics_json, profile,
+                    **settings):
+    """
+    Recalculate noise from a cached pileup, only running the pileup again if its inputs have changed.
+    """
+    settings = _noise_settings(**settings)
+    metrics = Metrics() if metrics_json else NO_METRICS
+    with profiled(profile):
+        sample_level_noise = noise.recompute_noise(ref_fasta, bam_file, bed_file, threshold, sample_id=sample_id,
+                                                   settings=settings, cache_path=pileup_cache, metrics=metrics)
+    if metrics_json:
+        metrics.write_json(metrics_json)
     print(sample_level_noise)
+
+
+@click.command()
+@ref_fasta_option
+@click.option("--manifest", required=True, help="Tab-separated file with a header and columns sample_id and bam_file")
+@bed_file_option
+@pileup_filter_options
+@click.option("--workers", default=1, help="Number of samples processed in parallel")
+@output_format_option
+@click.option("--cohort_id", default='cohort', help="Prefix for the combined noise summary of all samples")
+@bed_padding_option
+@engine_option
+@no_plots_option
+@click.option("--cohort_store", required=False, help="Directory of a cohort store to add the base counts of "
+                                                     "every sample to, created if it does not exist")
+@pipeline_options
+@subsample_options
+def calculate_noise_batch(ref_fasta, manifest, bed_file, threshold, workers, cohort_id, **settings):
+    """
+    Calculate noise level of every bam file in `manifest`, across the given positions in `bed_file`.
+    """
+    noise.calculate_noise_batch(ref_fasta, manifest, bed_file, threshold, settings=_noise_settings(**settings),
+                                workers=workers, cohort_id=cohort_id)
+
+
+@click.command()
+@click.option("--report_data", multiple=True,
+              help="Path to a <sample_id>_report_data.json file written by calculate_noise (repeatable)")
+@click.option("--sample_id", multiple=True, help="Prefix of the output tables of a calculate_noise run, to compute "
+                                                 "the report of a sample without report data from (repeatable)")
+@click.option("--output_format", default=TSV, type=click.Choice(OUTPUT_FORMATS),
+              help="Format of the pileup and noise positions tables of sample_id")
+@click.option("--output_dir", default='.', help="Directory for the <sample_id>_noise.html report of each sample")
+@click.option("--combined", required=False, help="Write the reports of all samples to this single HTML file instead")
+def render_report(report_data, sample_id, output_format, output_dir, combined):
+    """
+    Render the HTML noise report of samples that were run with --no_plots.
+    """
+    if not report_data and not sample_id:
+        raise click.UsageError('Give at least one --report_data or --sample_id')
+    from sequence_qc import plots
+
+    reports = [report.read_report_data(path) for path in report_data]
+    reports += [noise.load_report_data(prefix, output_format) for prefix in sample_id]
+    if combined:
+        plots.render_report(reports, combined)
+        return
+    for data in reports:
+        plots.render_report([data], os.path.join(output_dir, data['sample_id'] + report.NOISE_REPORT))
+
+
+@click.command()
+@click.option("--cohort_store", required=True, help="Directory of a cohort store written by calculate_noise")
+@click.option("--cohort_id", default='cohort', help="Prefix for the per-position noise of the cohort")
+@click.option("--min_depth", default=100, help="Leave out samples with a lower A, C, G and T depth at a position")
+@click.option("--sample_id", required=False, help="Also write the positions where this sample of the store is much "
+                                                  "noisier than the rest of the cohort")
+@click.option("--min_score", default=5.0, help="Lowest score of the site outliers of sample_id, in scaled median "
+                                               "absolute deviations above the median noise of the other samples")
+def cohort_noise(cohort_store, cohort_id, min_depth, sample_id, min_score):
+    """
+    Summarize the noise of each position across the samples of a cohort store.
+    """
+    with CohortStore(cohort_store) as store:
+        store.median_noise(min_depth=min_depth).to_csv(cohort_id + COHORT_NOISE, sep='\t', index=False)
+        if sample_id:
+            outliers = store.site_outliers(sample_id, min_score=min_score, min_depth=min_depth)
+            outliers.to_csv(sample_id + SITE_OUTLIERS, sep='\t', index=False)
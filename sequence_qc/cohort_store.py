@@ -0,0 +1,331 @@
+import fcntl
+import json
+import mmap
+import os
+import warnings
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from sequence_qc.pileup import PILEUP_COUNT_COLUMNS
+
+
+# Files of a cohort store directory
+STORE_METADATA = 'store.json'
+STORE_COUNTS = 'counts.bin'
+STORE_LOCK = 'store.lock'
+# Bump when the layout of the counts changes, so that older stores are rejected instead of misread
+STORE_VERSION = 1
+COUNT_DTYPE = np.uint32
+
+# Output files of `cohort_noise`
+COHORT_NOISE = '_cohort_noise.tsv'
+SITE_OUTLIERS = '_site_outliers.tsv'
+
+# Number of (sample, position) values read from the counts at once by the cohort queries
+QUERY_CHUNK_VALUES = 1 << 20
+# Scales the median absolute deviation to the standard deviation of normally distributed noise
+MAD_SCALE = 1.4826
+
+
+def pileup_settings(truncate: bool = True, min_mapping_quality: int = 1, min_base_quality: int = 1,
+                    max_depth: int = 30000) -> dict:
+    """
+    Pileup filters that all samples of a cohort store must share, so that their counts are comparable
+
+    :return: dict
+    """
+    return {
+        'truncate': bool(truncate),
+        'min_mapping_quality': int(min_mapping_quality),
+        'min_base_quality': int(min_base_quality),
+        'max_depth': int(max_depth),
+    }
+
+
+class CohortStore:
+    """
+    Base counts of many samples over the same regions, in a memory-mapped array on disk
+
+    The store is a directory with `STORE_METADATA`, which holds the regions, pileup settings and sample IDs, and
+    `STORE_COUNTS`, which holds one slab per sample, in the order the samples were appended. Each slab has a row
+    for every position of the regions, in region order, so a position has the same offset in every slab, and a
+    column for each of `PILEUP_COUNT_COLUMNS`. Positions without a pileup column are counted as 0.
+
+    Samples are added with `append_sample`. Queries only read the counts of a chunk of positions at a time, so
+    they do not load the whole cohort into memory. The counts stay mapped until `close`, or the end of a `with`
+    block.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: str - directory of the store
+        """
+        self.path = path
+        self.metadata = _read_metadata(path)
+        self.intervals = [tuple(interval) for interval in self.metadata['intervals']]
+        self.samples = list(self.metadata['samples'])
+        self.columns = list(self.metadata['columns'])
+        self.n_positions = sum(stop - start for _, start, stop in self.intervals)
+
+        shape = (len(self.samples), self.n_positions, len(self.columns))
+        self._mmap = None
+        if len(self.samples) == 0 or self.n_positions == 0:
+            self.counts = np.zeros(shape, dtype=COUNT_DTYPE)
+        else:
+            with open(os.path.join(path, STORE_COUNTS), 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # Bytes past the last slab in the metadata are from an interrupted append, and are ignored
+            self.counts = np.frombuffer(self._mmap, dtype=COUNT_DTYPE, count=int(np.prod(shape))).reshape(shape)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        """
+        Unmap the counts, after which the store can not be queried
+        """
+        self.counts = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def positions(self) -> pd.DataFrame:
+        """
+        Chromosome and 0-based position of each offset of the slabs
+
+        :return: pd.DataFrame - with columns 'chrom' and 'pos'
+        """
+        chroms = [chrom for chrom, start, stop in self.intervals]
+        lengths = [stop - start for _, start, stop in self.intervals]
+        pos = np.concatenate([np.arange(start, stop) for _, start, stop in self.intervals] or [np.zeros(0, int)])
+        return pd.DataFrame({'chrom': pd.Categorical(np.repeat(chroms, lengths)), 'pos': pos})
+
+    def sample_counts(self, sample_id: str) -> pd.DataFrame:
+        """
+        Counts of one sample at every position of the store
+
+        :param sample_id: str
+        :return: pd.DataFrame - with columns 'chrom', 'pos' and `PILEUP_COUNT_COLUMNS`
+        """
+        # Copied, so that the frame stays valid once the store is closed
+        counts = pd.DataFrame(np.array(self.counts[self._sample_index(sample_id)]), columns=self.columns)
+        return pd.concat([self.positions(), counts], axis=1)
+
+    def iter_noise(self, min_depth: int = 1, chunk_values: int = QUERY_CHUNK_VALUES):
+        """
+        Noise of every sample at every position, a chunk of positions at a time
+
+        The noise of a position is the fraction of its A, C, G and T bases that are not the most common one, as
+        the 'noise_acgt' column of the noisy positions table. It is NaN where the depth is lower than `min_depth`.
+
+        :param min_depth: int - lowest A, C, G and T depth at which the noise of a position is used
+        :param chunk_values: int - number of (sample, position) values in each chunk
+        :return: iterator - (start offset, np.ndarray of shape (samples, chunk positions)) tuples
+        """
+        acgt = [self.columns.index(base) for base in 'ACGT']
+        chunk_positions = max(chunk_values // max(len(self.samples), 1), 1)
+        for start in range(0, self.n_positions, chunk_positions):
+            base_counts = np.asarray(self.counts[:, start:start + chunk_positions, :])[:, :, acgt].astype(np.int64)
+            depth = base_counts.sum(axis=2)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                noise = (depth - base_counts.max(axis=2)) / depth
+            noise[depth < max(min_depth, 1)] = np.nan
+            self._release_pages()
+            yield start, noise
+
+    def _release_pages(self) -> None:
+        """
+        Drop the pages of the counts that were read from this process, which would otherwise stay resident
+        until the whole store has been read. They stay in the page cache, and are read again when needed.
+        """
+        if self._mmap is not None and hasattr(mmap, 'MADV_DONTNEED'):
+            self._mmap.madvise(mmap.MADV_DONTNEED)
+
+    def median_noise(self, min_depth: int = 1, chunk_values: int = QUERY_CHUNK_VALUES) -> pd.DataFrame:
+        """
+        Median and median absolute deviation of the noise of each position across the cohort
+
+        :param min_depth: int - samples with a lower depth at a position are left out of its statistics
+        :param chunk_values: int - number of (sample, position) values read at once
+        :return: pd.DataFrame - with columns 'chrom', 'pos', 'samples' (number of samples with `min_depth`),
+            'median_noise' and 'mad_noise'
+        """
+        samples = np.zeros(self.n_positions, dtype=np.int64)
+        median = np.full(self.n_positions, np.nan)
+        mad = np.full(self.n_positions, np.nan)
+        for start, noise in self.iter_noise(min_depth, chunk_values):
+            stop = start + noise.shape[1]
+            samples[start:stop] = (~np.isnan(noise)).sum(axis=0)
+            median[start:stop], mad[start:stop] = _median_and_mad(noise)
+
+        positions = self.positions()
+        positions['samples'] = samples
+        positions['median_noise'] = median
+        positions['mad_noise'] = mad
+        return positions
+
+    def site_outliers(self, sample_id: str, min_score: float = 5.0, min_mad: float = 0.001, min_depth: int = 100,
+                      chunk_values: int = QUERY_CHUNK_VALUES) -> pd.DataFrame:
+        """
+        Positions where the noise of a sample is far above that of the rest of the cohort
+
+        The score of a position is the difference between the noise of the sample and the median noise of the
+        other samples, divided by their median absolute deviation (scaled by `MAD_SCALE`, and at least `min_mad`,
+        as most positions have no noise in most samples).
+
+        :param sample_id: str - sample of the store to compare with the others
+        :param min_score: float - lowest score of the positions returned
+        :param min_mad: float - lower bound of the scaled median absolute deviation
+        :param min_depth: int - positions, and samples at a position, with a lower depth are left out
+        :param chunk_values: int - number of (sample, position) values read at once
+        :return: pd.DataFrame - with columns 'chrom', 'pos', 'noise', 'cohort_median_noise', 'cohort_mad_noise'
+            and 'score', sorted by decreasing score
+        """
+        sample_index = self._sample_index(sample_id)
+        columns = ['offset', 'noise', 'cohort_median_noise', 'cohort_mad_noise', 'score']
+        chunks = []
+        for start, chunk_noise in self.iter_noise(min_depth, chunk_values):
+            sample_noise = chunk_noise[sample_index]
+            cohort_median, cohort_mad = _median_and_mad(np.delete(chunk_noise, sample_index, axis=0))
+            with np.errstate(invalid='ignore'):
+                score = (sample_noise - cohort_median) / np.maximum(MAD_SCALE * cohort_mad, min_mad)
+                is_outlier = score >= min_score
+            offsets = start + np.arange(len(score))
+            chunks.append(np.stack([offsets, sample_noise, cohort_median, cohort_mad, score])[:, is_outlier])
+
+        values = pd.DataFrame(np.concatenate(chunks, axis=1).T if chunks else np.zeros((0, 5)), columns=columns)
+        outliers = self.positions().iloc[values['offset'].to_numpy(dtype=np.int64)].reset_index(drop=True)
+        outliers = pd.concat([outliers, values.drop(columns='offset')], axis=1)
+        return outliers.sort_values('score', ascending=False, kind='stable').reset_index(drop=True)
+
+    def _sample_index(self, sample_id: str) -> int:
+        if sample_id not in self.samples:
+            raise ValueError('Sample {} is not in cohort store {}'.format(sample_id, self.path))
+        return self.samples.index(sample_id)
+
+
+def _read_metadata(path: str) -> dict:
+    """
+    Regions, pileup settings and sample IDs of the store at `path`
+
+    :return: dict - contents of `STORE_METADATA`
+    """
+    with open(os.path.join(path, STORE_METADATA)) as f:
+        metadata = json.load(f)
+    if metadata['version'] != STORE_VERSION:
+        raise ValueError('Cohort store {} has version {}, expected {}'.format(path, metadata['version'], STORE_VERSION))
+    return metadata
+
+
+def _median_and_mad(noise: np.ndarray) -> tuple:
+    """
+    Median and median absolute deviation over the samples (first axis) of `noise`, ignoring NaN
+
+    :return: tuple - two np.ndarray, NaN for positions without any value
+    """
+    with warnings.catch_warnings():
+        # Positions without any sample deep enough are expected, and are left as NaN
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        median = np.nanmedian(noise, axis=0)
+        mad = np.nanmedian(np.abs(noise - median), axis=0)
+    return median, mad
+
+
+def position_offsets(intervals: list, chroms: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """
+    Offset in the slabs of a cohort store of each position, or -1 for positions outside of `intervals`
+
+    :param intervals: list - sorted, non-overlapping (chrom, start, stop) tuples, from `bed_intervals`
+    :param chroms: np.ndarray - chromosome of each position
+    :param positions: np.ndarray - 0-based positions
+    :return: np.ndarray
+    """
+    offsets = np.full(len(positions), -1, dtype=np.int64)
+    positions = np.asarray(positions, dtype=np.int64)
+    chroms = np.asarray(chroms).astype(str)
+    lengths = np.array([stop - start for _, start, stop in intervals], dtype=np.int64)
+    interval_offsets = np.cumsum(lengths) - lengths
+
+    by_chrom = {}
+    for i, (chrom, start, stop) in enumerate(intervals):
+        by_chrom.setdefault(str(chrom), []).append(i)
+    for chrom, indexes in by_chrom.items():
+        indexes = np.array(indexes)
+        starts = np.array([intervals[i][1] for i in indexes], dtype=np.int64)
+        stops = np.array([intervals[i][2] for i in indexes], dtype=np.int64)
+        rows = np.flatnonzero(chroms == chrom)
+        interval = np.searchsorted(starts, positions[rows], side='right') - 1
+        inside = (interval >= 0) & (positions[rows] < stops[np.maximum(interval, 0)])
+        rows, interval = rows[inside], interval[inside]
+        offsets[rows] = interval_offsets[indexes[interval]] + positions[rows] - starts[interval]
+    return offsets
+
+
+@contextmanager
+def _locked(path: str):
+    """
+    Hold an exclusive lock on the store, so that samples of a batch can be appended from several processes
+    """
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, STORE_LOCK), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def append_sample(path: str, sample_id: str, pileup: pd.DataFrame, intervals: list, settings: dict) -> int:
+    """
+    Add the counts of a sample to the cohort store at `path`, creating the store if it does not exist
+
+    A new store takes the regions and pileup settings of its first sample, and later samples must have the same.
+
+    :param path: str - directory of the store
+    :param sample_id: str - sample ID, which must not already be in the store
+    :param pileup: pd.DataFrame - pileup with columns 'chrom', 'pos' and `PILEUP_COUNT_COLUMNS`
+    :param intervals: list - (chrom, start, stop) tuples the pileup was computed over, from `bed_intervals`
+    :param settings: dict - from `pileup_settings`
+    :return: int - number of samples in the store
+    """
+    if not sample_id:
+        raise ValueError('A sample ID is required to add a sample to cohort store {}'.format(path))
+    intervals = [[str(chrom), int(start), int(stop)] for chrom, start, stop in intervals]
+
+    with _locked(path):
+        metadata_path = os.path.join(path, STORE_METADATA)
+        if os.path.exists(metadata_path):
+            metadata = _read_metadata(path)
+        else:
+            metadata = {'version': STORE_VERSION, 'columns': PILEUP_COUNT_COLUMNS, 'dtype': np.dtype(COUNT_DTYPE).str,
+                        'intervals': intervals, 'pileup_settings': settings, 'samples': []}
+        if metadata['intervals'] != intervals:
+            raise ValueError('Regions of {} do not match those of cohort store {}'.format(sample_id, path))
+        if metadata['pileup_settings'] != settings:
+            raise ValueError('Pileup settings {} of {} do not match {} of cohort store {}'.format(
+                settings, sample_id, metadata['pileup_settings'], path))
+        if sample_id in metadata['samples']:
+            raise ValueError('Sample {} is already in cohort store {}'.format(sample_id, path))
+
+        n_positions = sum(stop - start for _, start, stop in intervals)
+        slab = np.zeros((n_positions, len(metadata['columns'])), dtype=COUNT_DTYPE)
+        offsets = position_offsets(intervals, pileup['chrom'].to_numpy(), pileup['pos'].to_numpy())
+        inside = offsets >= 0
+        slab[offsets[inside]] = pileup[metadata['columns']].to_numpy(dtype=COUNT_DTYPE)[inside]
+
+        counts_path = os.path.join(path, STORE_COUNTS)
+        with open(counts_path, 'ab') as f:
+            # Drop any partial slab left by an interrupted append
+            f.truncate(len(metadata['samples']) * slab.nbytes)
+            f.write(slab.tobytes())
+
+        metadata['samples'].append(sample_id)
+        with open(metadata_path + '.tmp', 'w') as f:
+            json.dump(metadata, f)
+        os.replace(metadata_path + '.tmp', metadata_path)
+    return len(metadata['samples'])
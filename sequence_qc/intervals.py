@@ -0,0 +1,50 @@
+# Intervals closer than this are piled up with a single fetch, skipping the columns in between
+FETCH_WINDOW_GAP = 300
+
+
+def merge_intervals(intervals: list, padding: int = 0) -> tuple:
+    """
+    Sort, pad and merge overlapping or abutting intervals, so that each position is only piled up once
+
+    Contigs are kept in the order they first appear, and intervals are sorted by start within each contig,
+    so a sorted bed file keeps its order.
+
+    :param intervals: list - (chrom, start, stop) tuples
+    :param padding: int - number of bases added on either side of each interval before merging
+    :return: tuple - (merged (chrom, start, stop) tuples, number of duplicate bases removed by merging)
+    """
+    by_chrom = {}
+    for chrom, start, stop in intervals:
+        by_chrom.setdefault(chrom, []).append((max(start - padding, 0), stop + padding))
+
+    merged = []
+    duplicate_bases = 0
+    for chrom, chrom_intervals in by_chrom.items():
+        chrom_merged = []
+        for start, stop in sorted(chrom_intervals):
+            duplicate_bases += stop - start
+            if chrom_merged and start <= chrom_merged[-1][1]:
+                chrom_merged[-1][1] = max(chrom_merged[-1][1], stop)
+            else:
+                chrom_merged.append([start, stop])
+        duplicate_bases -= sum(stop - start for start, stop in chrom_merged)
+        merged.extend((chrom, start, stop) for start, stop in chrom_merged)
+    return merged, duplicate_bases
+
+
+def fetch_windows(intervals: list, max_gap: int = FETCH_WINDOW_GAP) -> list:
+    """
+    Group consecutive intervals on the same contig into windows that can be piled up with a single fetch
+
+    :param intervals: list - sorted, non-overlapping (chrom, start, stop) tuples, from `merge_intervals`
+    :param max_gap: int - largest distance between two intervals of the same window
+    :return: list - (chrom, start, stop, [(start, stop), ...]) tuples, with the intervals covered by each window
+    """
+    windows = []
+    for chrom, start, stop in intervals:
+        if windows and windows[-1][0] == chrom and 0 <= start - windows[-1][2] <= max_gap:
+            window = windows[-1]
+            windows[-1] = (chrom, window[1], stop, window[3] + [(start, stop)])
+        else:
+            windows.append((chrom, start, stop, [(start, stop)]))
+    return windows
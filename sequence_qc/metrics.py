@@ -0,0 +1,91 @@
+import cProfile
+import json
+import os
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class Metrics:
+    """
+    Wall time of each stage of a run, along with counters such as the number of positions and reads
+
+    A disabled instance (see `NO_METRICS`) records nothing, so that instrumented code does not need to check
+    whether metrics were requested.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.stages = {}
+        self.counters = {}
+        self.files = {}
+
+    def stage(self, name: str):
+        """
+        Context manager adding the wall time of its body to stage `name`
+
+        :param name: str - stage name, times of repeated stages are summed
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start
+
+    def count(self, name: str, value: int = 1) -> None:
+        """
+        Add `value` to counter `name`
+        """
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def add_file(self, path: str) -> None:
+        """
+        Record the size of an output file, which counts towards bytes_written
+        """
+        if self.enabled and path is not None and os.path.exists(path):
+            self.files[path] = os.path.getsize(path)
+
+    def to_dict(self) -> dict:
+        return {
+            'stages': self.stages,
+            'counters': dict(self.counters, bytes_written=sum(self.files.values())),
+            'files': self.files,
+        }
+
+    def write_json(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write('\n')
+
+
+NO_METRICS = Metrics(enabled=False)
+
+
+def profiled(path: str = None):
+    """
+    Context manager that profiles its body with cProfile and writes the stats to `path`, if `path` is given
+
+    The stats can be read with `python -m pstats <path>` or snakeviz. Without `path` nothing is profiled.
+
+    :param path: str - output path for the profiler stats
+    """
+    if path is None:
+        return nullcontext()
+    return _profiled(path)
+
+
+@contextmanager
+def _profiled(path: str):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
@@ -1,11 +1,30 @@
 import logging
-import pysamstats
+import tempfile
+import numpy as np
 import pandas as pd
-from pysam import AlignmentFile
-from pybedtools import BedTool
-
-from sequence_qc import plots
-from sequence_qc.noise_by_tlen import get_fragment_size_for_sample
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import replace
+from pandas.api.types import union_categoricals
+
+from sequence_qc import report
+from sequence_qc.cohort_store import append_sample, pileup_settings
+from sequence_qc.intervals import merge_intervals
+from sequence_qc.metrics import NO_METRICS, Metrics
+from sequence_qc.pileup import (PILEUP_COUNT_COLUMNS, PYSAM, PileupAccumulator, StreamingPileupWriter,
+                                pileup_intervals, reference_scope, shard_intervals, worker_reference_scope)
+from sequence_qc.noise_by_tlen import (NOISE_BY_TLEN, FragmentSizeRecords, ReadPairStats, collect_fragment_sizes,
+                                       get_fragment_size_for_sample, read_fragment_sizes, write_fragment_sizes)
+from sequence_qc.noise_shards import (NOISE_SHARD_NAME, SHARD_COUNTS, SHARD_FRAGMENT_SIZES_NAME,
+                                      SHARD_POSITIONS_NAME, intervals_checksum, load_noise_shards, parse_shard,
+                                      save_noise_shard, shard_prefix)
+from sequence_qc.pileup_cache import (PILEUP_CACHE_NAME, load_pileup_cache, pileup_cache_key_path,
+                                      replace_pileup_cache, save_pileup_cache)
+from sequence_qc.pipeline import INLINE_WRITER, BackgroundWriter, InlineWriter
+from sequence_qc.settings import DEFAULT_SETTINGS, NoiseSettings
+from sequence_qc.subsample import (fraction_for_precision, pilot_intervals, subsample_bam, subsampled_bam_path,
+                                   wilson_interval)
+from sequence_qc.tables import PARQUET, TSV, check_output_format, load_table, table_path, write_table
 
 
 FORMAT = '%(asctime)-15s %(message)s'
@@ -24,6 +43,7 @@ NOISE_DEL = '_noise_del.tsv'
 NOISE_ACGT_INDEL = '_noise_acgt_indel.tsv'
 NOISE_N = '_noise_n.tsv'
 NOISE_BY_SUBSTITUTION = '_noise_by_substitution.tsv'
+NOISE_SUMMARY = '_noise_summary.tsv'
 # Headers for output files
 ALT_COUNT = 'minor_allele_count'
 GENO_COUNT = 'major_allele_count'
@@ -33,6 +53,9 @@ TOTAL_BASE_COUNT = 'total_base_count'
 SAMPLE_ID = 'sample_id'
 NOISE_FRACTION = 'noise_fraction'
 CONTRIBUTING_SITES = 'contributing_sites'
+NOISE_CI_LOWER = 'noise_fraction_ci_lower'
+NOISE_CI_UPPER = 'noise_fraction_ci_upper'
+SUBSAMPLE_FRACTION = 'subsample_fraction'
 
 output_columns = [
     'chrom',
@@ -64,60 +87,465 @@ SUBSTITUTION_TYPES = [
 ]
 
 
-def calculate_noise(ref_fasta: str, bam_path: str, bed_file_path: str, noise_threshold: float, truncate: bool = True,
-                    min_mapping_quality: int = 1, min_base_quality: int = 1, sample_id: str = '',
-                    max_depth=30000) -> float:
+def calculate_noise(ref_fasta: str, bam_path: str, bed_file_path: str, noise_threshold: float, sample_id: str = '',
+                    settings: NoiseSettings = DEFAULT_SETTINGS, intervals: list = None,
+                    metrics: Metrics = NO_METRICS) -> float:
     """
     Create file of noise across specified regions in `bed_file` using pybedtools and pysamstats
 
+    In pipelined mode, the pileup runs in worker processes while the regions already piled up are reduced, and
+    output files are written by a background thread while the noise is calculated. The outputs are identical.
+
+    With `subsample_fraction` or `target_precision`, only a fraction of the reads is used, see `_subsampled_reads`.
+    The interval and the fraction used are written to `NOISE_ACGT`.
+
     :param ref_fasta: string - path to reference fastq
     :param bam_path: string - path to bam
     :param bed_file_path: string - path to bed file
-    :param sample_id: string - prefix for output files
     :param noise_threshold: float - threshold past which to exclude positions from noise calculation
-    :param truncate: int - 0 or 1, whether to exclude reads that only partially overlap the bedfile
-    :param min_mapping_quality: int - exclude reads with mapping qualities less than this threshold
-    :param min_base_quality: int - exclude bases with less than this base quality
-    :param max_depth: int - Maximum read depth for calculation
-    :return:
+    :param sample_id: string - prefix for output files
+    :param settings: NoiseSettings - pileup filters and run options
+    :param intervals: list - (chrom, start, stop) tuples from `bed_intervals`, to skip parsing `bed_file_path` again
+    :param metrics: Metrics - records the time of each stage, and counts of intervals, positions, reads and bytes
+    :return: float - noise of the sample
     """
-    bed_file = BedTool(bed_file_path)
-    bam = AlignmentFile(bam_path)
-    pileup_df_all = pd.DataFrame()
-    tlen_df_all = pd.DataFrame()
+    if settings.cache_pileup:
+        # Key the inputs before the pileup, so that files modified during the run invalidate the cache
+        cache_key = settings.pileup_cache_key(ref_fasta, bam_path, bed_file_path)
+    if intervals is None:
+        with metrics.stage('bed_intervals'):
+            intervals = bed_intervals(bed_file_path, settings.bed_padding)
+    metrics.count('intervals', len(intervals))
+
+    writer = _run_writer(settings, metrics)
+    with writer, reference_scope(), _subsampled_reads(ref_fasta, bam_path, intervals, noise_threshold, sample_id,
+                                                      settings, metrics) as (reads_path, subsample_fraction):
+        pileup_df_all = _pileup_sample(ref_fasta, reads_path, intervals, sample_id, settings, metrics, writer)
+
+        if settings.cache_pileup:
+            with metrics.stage('write_tables'):
+                # The noise calculation adds columns to pileup_df_all, so the writer gets its own frame
+                writer.submit(save_pileup_cache, sample_id + PILEUP_CACHE_NAME, cache_key,
+                              pileup_df_all.copy(deep=False))
+
+        if settings.cohort_store:
+            writer.submit(_append_to_cohort_store, settings.cohort_store, sample_id,
+                          pileup_df_all[['chrom', 'pos'] + PILEUP_COUNT_COLUMNS], intervals,
+                          pileup_settings(**settings.pileup_filters()), metrics)
+
+        # Continue with calculation
+        noise = _calculate_noise_from_pileup(pileup_df_all, sample_id, noise_threshold, reads_path,
+                                             settings.output_format, metrics, settings.make_plots, writer,
+                                             subsample_fraction)
+
+    _add_pileup_files(sample_id, settings, metrics)
+    if settings.cache_pileup:
+        metrics.add_file(sample_id + PILEUP_CACHE_NAME)
+        metrics.add_file(pileup_cache_key_path(sample_id + PILEUP_CACHE_NAME))
+    return noise
+
+
+def calculate_noise_shard(ref_fasta: str, bam_path: str, bed_file_path: str, noise_threshold: float, shard: str,
+                          sample_id: str = '', settings: NoiseSettings = DEFAULT_SETTINGS, intervals: list = None,
+                          metrics: Metrics = NO_METRICS) -> float:
+    """
+    Pileup only a part of the intervals, and save its statistics for `merge_noise` instead of the noise outputs
+
+    The statistics are saved to `<sample_id>_shard_<i>_of_<N>` + NOISE_SHARD_NAME and the parquet tables it refers
+    to, along with the pileup and tlen tables of the shard. The noise outputs of the sample are then written by
+    `merge_noise` from the json files of all N shards.
+
+    :param shard: str - 'i/N' to only process the i-th of N shards of the intervals, counting from 1
+    :return: float - noise of the shard
+
+    See `calculate_noise` for the other parameters
+    """
+    if settings.cache_pileup or settings.cohort_store or settings.target_precision is not None:
+        raise ValueError('cache_pileup, cohort_store and target_precision are not supported with shard, as they '
+                         'need the pileup of all intervals')
+    shard_index, n_shards = parse_shard(shard)
+    # The noisy positions and fragment sizes of a shard are saved as parquet tables
+    check_output_format(PARQUET)
+    if intervals is None:
+        with metrics.stage('bed_intervals'):
+            intervals = bed_intervals(bed_file_path, settings.bed_padding)
+
+    run_settings = {
+        'sample_id': sample_id, 'noise_threshold': noise_threshold, 'truncate': bool(settings.truncate),
+        'min_mapping_quality': settings.min_mapping_quality, 'min_base_quality': settings.min_base_quality,
+        'max_depth': settings.max_depth, 'engine': settings.engine, 'subsample_fraction': settings.subsample_fraction,
+        'subsample_seed': settings.subsample_seed, 'intervals': intervals_checksum(intervals),
+    }
+    # Shards are split as for the pileup processes, which gives the same pileup as a single run
+    shards = shard_intervals(intervals, n_shards)
+    intervals = shards[shard_index - 1] if shard_index <= len(shards) else []
+    output_id = shard_prefix(sample_id, shard_index, n_shards)
+    metrics.count('intervals', len(intervals))
+
+    writer = _run_writer(settings, metrics)
+    with writer, reference_scope(), _subsampled_reads(ref_fasta, bam_path, intervals, noise_threshold, sample_id,
+                                                      settings, metrics) as (reads_path, _):
+        pileup_df_all = _pileup_sample(ref_fasta, reads_path, intervals, output_id, settings, metrics, writer)
+        noise = _save_noise_shard(pileup_df_all, output_id, noise_threshold, reads_path, shard_index, n_shards,
+                                  run_settings, metrics, writer)
+
+    _add_pileup_files(output_id, settings, metrics)
+    return noise
+
+
+def _run_writer(settings: NoiseSettings, metrics: Metrics = NO_METRICS) -> InlineWriter:
+    """
+    Writer of the output files of a run, which writes in a background thread in pipelined mode
+    """
+    if settings.pipelined:
+        return BackgroundWriter(settings.queue_size, metrics)
+    return INLINE_WRITER
+
+
+@contextmanager
+def _subsampled_reads(ref_fasta: str, bam_path: str, intervals: list, noise_threshold: float, sample_id: str,
+                      settings: NoiseSettings, metrics: Metrics = NO_METRICS):
+    """
+    Bam of the reads used by a run, and the fraction of read names they were kept from
+
+    When subsampling, only the reads whose hashed query name falls below a fraction are kept, see `subsample_bam`,
+    in a temporary bam that is removed on exit. With `target_precision`, the fraction is chosen from a pilot pileup
+    of a subset of the intervals, as the smallest fraction whose acgt noise has a 95% confidence interval within
+    `target_precision` of the noise.
+
+    :return: tuple - (path to bam, fraction of read names kept)
+    """
+    subsample_fraction = settings.subsample_fraction
+    if settings.target_precision is not None:
+        with metrics.stage('subsample'):
+            subsample_fraction = _fraction_for_precision(ref_fasta, bam_path, intervals, noise_threshold,
+                                                         settings.target_precision, settings.threads,
+                                                         **settings.pileup_filters())
+        logger.info('Using {} of the reads of {} for a noise precision of {}'.format(
+            subsample_fraction, sample_id, settings.target_precision))
+    # Without intervals, e.g. in an empty shard, no reads are needed, and samtools would keep all of them
+    if subsample_fraction == 1 or not intervals:
+        yield bam_path, subsample_fraction
+        return
+
+    with tempfile.TemporaryDirectory() as subsample_dir:
+        with metrics.stage('subsample'):
+            subsampled_path = subsample_bam(bam_path,
+                                            subsampled_bam_path(subsample_dir, subsample_fraction,
+                                                                settings.subsample_seed),
+                                            subsample_fraction, intervals, settings.subsample_seed)
+        yield subsampled_path, subsample_fraction
+
+
+def _pileup_sample(ref_fasta: str, bam_path: str, intervals: list, output_id: str, settings: NoiseSettings,
+                   metrics: Metrics = NO_METRICS, writer: InlineWriter = INLINE_WRITER) -> pd.DataFrame:
+    """
+    Pileup all `intervals`, writing the pileup and tlen tables to `output_id` + OUTPUT_PILEUP_NAME and
+    OUTPUT_TLEN_NAME
+
+    :return: pd.DataFrame - the compact columns of the pileup, see `PileupAccumulator`
+    """
+    if settings.streams_output:
+        accumulator = StreamingPileupWriter(output_id + OUTPUT_PILEUP_NAME, output_id + OUTPUT_TLEN_NAME,
+                                            output_columns, writer)
+    else:
+        accumulator = PileupAccumulator()
 
     # Build data frame of all positions in bed file
-    for region in bed_file.intervals:
-        chrom = region.chrom.replace('chr', '')
-        start = region.start
-        stop = region.stop
+    region_pileups = pileup_intervals(ref_fasta, bam_path, intervals, threads=settings.threads, engine=settings.engine,
+                                      max_pending_shards=settings.queue_size if settings.pipelined else None,
+                                      **settings.pileup_filters())
+    with metrics.stage('pileup'):
+        for pileup, tlen in region_pileups:
+            accumulator.add(pileup, tlen)
+        pileup_df_all, tlen_df_all = accumulator.to_frames()
+    metrics.count('positions', len(pileup_df_all))
+
+    if not settings.streams_output:
+        # Save the complete pileup and tlen info
+        with metrics.stage('write_tables'):
+            writer.submit(write_table, pileup_df_all[output_columns], output_id, OUTPUT_PILEUP_NAME,
+                          settings.output_format)
+            writer.submit(write_table, tlen_df_all, output_id, OUTPUT_TLEN_NAME, settings.output_format)
+    return pileup_df_all
+
+
+def _add_pileup_files(output_id: str, settings: NoiseSettings, metrics: Metrics = NO_METRICS) -> None:
+    metrics.add_file(table_path(output_id, OUTPUT_PILEUP_NAME, settings.output_format))
+    metrics.add_file(table_path(output_id, OUTPUT_TLEN_NAME, settings.output_format))
+
+
+def _fraction_for_precision(ref_fasta: str, bam_path: str, intervals: list, noise_threshold: float,
+                            target_precision: float, threads: int = 1, **pileup_kwargs) -> float:
+    """
+    Estimate the noise and depth from a pilot pileup of a subset of the intervals, and the fraction of reads needed
+    to reach `target_precision`, see `fraction_for_precision`
+
+    The pilot keeps every read, and only counts bases, with the pysam engine.
+
+    :param pileup_kwargs: dict - filtering arguments passed through to `pileup_intervals`
+    :return: float - fraction of read names to keep
+    """
+    pilot, counted_fraction = pilot_intervals(intervals)
+    accumulator = PileupAccumulator()
+    for pileup, tlen in pileup_intervals(ref_fasta, bam_path, pilot, threads=threads, engine=PYSAM, **pileup_kwargs):
+        accumulator.add(pileup, tlen)
+    pileup = _calculate_alt_and_geno(accumulator.to_frames()[0])
+    below_thresh_positions = pileup[_threshold_mask(pileup, noise_threshold)]
+    alt_count_total = int(below_thresh_positions[ALT_COUNT].sum())
+    geno_count_total = int(below_thresh_positions[GENO_COUNT].sum())
+    return fraction_for_precision(alt_count_total, alt_count_total + geno_count_total, len(below_thresh_positions),
+                                  counted_fraction, target_precision)
+
+
+def _save_noise_shard(pileup: pd.DataFrame, output_id: str, noise_threshold: float, bam_path: str, index: int,
+                      n_shards: int, settings: dict, metrics: Metrics = NO_METRICS,
+                      writer: InlineWriter = INLINE_WRITER) -> float:
+    """
+    Save the statistics of the pileup of a shard, and the fragment sizes of its noisy positions, for `merge_noise`
+
+    :param output_id: str - prefix of the shard file, from `shard_prefix`
+    :param settings: dict - settings of the run, which must be the same for all shards that are merged
+    :return: float - noise of the shard
+    """
+    statistics = _noise_statistics(pileup, noise_threshold, metrics)
+    noisy_positions = statistics['noisy_positions']
+    records = FragmentSizeRecords()
+    if len(noisy_positions):
+        read_pair_stats = ReadPairStats()
+        with metrics.stage('fragment_sizes'):
+            records = collect_fragment_sizes(bam_path, noisy_positions, 0, 500, stats=read_pair_stats)
+        metrics.count('reads_fetched', read_pair_stats.reads_fetched)
+        metrics.count('pairs_emitted', read_pair_stats.pairs_emitted)
+        metrics.count('orphans_evicted', read_pair_stats.orphans_evicted)
+    statistics['fragment_sizes'] = records
+
+    writer.submit(save_noise_shard, output_id, index, n_shards, settings, statistics)
+    for path in [table_path(output_id, SHARD_POSITIONS_NAME, PARQUET),
+                 table_path(output_id, SHARD_FRAGMENT_SIZES_NAME, PARQUET), output_id + NOISE_SHARD_NAME]:
+        metrics.add_file(path)
+    return statistics['alt_count'] / (statistics['alt_count'] + statistics['geno_count'] + EPSILON)
+
+
+def merge_noise(shard_paths: list, sample_id: str = None, output_format: str = TSV, metrics: Metrics = NO_METRICS,
+                make_plots: bool = True) -> float:
+    """
+    Write the noise outputs of a sample from the files of all shards of `calculate_noise_shard`
+
+    The outputs and the noise are the same as those of a single `calculate_noise` run over all intervals.
+
+    :param shard_paths: list - paths of the shard files, one for each of the N shards, in any order
+    :param sample_id: str - prefix for output files, by default the sample ID of the shards
+    :param output_format: str - 'tsv', 'parquet' or 'feather', format of the noisy positions table
+    :param metrics: Metrics - records the time of each stage, and the written files
+    :param make_plots: bool - Write the HTML report, otherwise only its aggregates are written for `render_report`
+    :return: float - Single noise value for this sample
+    """
+    check_output_format(output_format)
+    with metrics.stage('load_shards'):
+        settings, shards = load_noise_shards(shard_paths)
+    if sample_id is None:
+        sample_id = settings['sample_id']
+    statistics = _combine_statistics(shards)
+    # The noisy positions are in the order of a single run, so sorting them gives the same order
+    noisy_positions = statistics['noisy_positions'].sort_values(ALT_COUNT, ascending=False)
+    metrics.count('noisy_positions', len(noisy_positions))
+
+    noisy_tlen_df = None
+    if len(noisy_positions):
+        # Renumber the noisy positions of each shard by their index in the sorted noisy positions of the sample
+        sorted_index = np.empty(len(noisy_positions), dtype=np.int64)
+        sorted_index[noisy_positions.index.to_numpy()] = np.arange(len(noisy_positions))
+        records = FragmentSizeRecords()
+        offset = 0
+        for shard in shards:
+            n_positions = len(shard['noisy_positions'])
+            records.extend(shard['fragment_sizes'], sorted_index[offset:offset + n_positions])
+            offset += n_positions
+        noisy_tlen_df = records.to_frame(sample_id, sample_id)
+    write_fragment_sizes(sample_id, noisy_tlen_df)
+
+    return _write_noise_outputs(statistics, noisy_positions, noisy_tlen_df, sample_id, output_format, metrics,
+                                make_plots, subsample_fraction=settings['subsample_fraction'])
+
+
+def _combine_statistics(shards: list) -> dict:
+    """
+    Statistics of consecutive parts of a pileup, from `_noise_statistics`, combined into those of the whole pileup
+
+    :param shards: list - statistics of each part, in pileup order
+    :return: dict - the combined statistics, with the noisy positions of all parts in a new `RangeIndex`
+    """
+    combined = {key: sum(shard[key] for shard in shards) for key in SHARD_COUNTS}
+    combined['substitution'] = sum(shard['substitution'] for shard in shards)
+    combined['n_counts'] = {
+        'counts': np.sum([shard['n_counts']['counts'] for shard in shards], axis=0).tolist(),
+        'above_max': sum(shard['n_counts']['above_max'] for shard in shards),
+    }
+
+    # Empty parts may have other column types, which would change the types of the concatenated columns
+    frames = [shard['noisy_positions'] for shard in shards if len(shard['noisy_positions'])]
+    frames = frames or [shards[0]['noisy_positions']]
+    columns = {}
+    for column in frames[0].columns:
+        if isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+            # As in `PileupAccumulator`, chrom categories are in order of appearance and ref categories are sorted
+            columns[column] = union_categoricals([frame[column] for frame in frames], sort_categories=column == 'ref')
+        else:
+            columns[column] = np.concatenate([frame[column].to_numpy() for frame in frames])
+    combined['noisy_positions'] = pd.DataFrame(columns)
+    return combined
+
+
+def _append_to_cohort_store(cohort_store: str, sample_id: str, pileup: pd.DataFrame, intervals: list,
+                            settings: dict, metrics: Metrics = NO_METRICS) -> None:
+    with metrics.stage('cohort_store'):
+        n_samples = append_sample(cohort_store, sample_id, pileup, intervals, settings)
+    logger.info('Added {} to cohort store {}, which now has {} samples'.format(sample_id, cohort_store, n_samples))
+
+
+def bed_intervals(bed_file_path: str, padding: int = 0) -> list:
+    """
+    Regions of the bed file as (chrom, start, stop) tuples, with contig names as they appear in the bam
+
+    Regions are sorted, padded and merged, so that positions covered by several regions are only counted once.
+
+    :param bed_file_path: str - path to bed file
+    :param padding: int - number of bases added on either side of each region
+    :return: list
+    """
+    # pybedtools is only needed when the bed file is parsed
+    from pybedtools import BedTool
+
+    bed_file = BedTool(bed_file_path)
+    intervals = [(region.chrom.replace('chr', ''), region.start, region.stop) for region in bed_file.intervals]
+    merged, duplicate_bases = merge_intervals(intervals, padding)
+    logger.info('Merged {} regions from {} into {}, removing {} duplicate bases'.format(
+        len(intervals), bed_file_path, len(merged), duplicate_bases))
+    return merged
+
+
+def calculate_noise_batch(ref_fasta: str, manifest_path: str, bed_file_path: str, noise_threshold: float,
+                          settings: NoiseSettings = DEFAULT_SETTINGS, workers: int = 1,
+                          cohort_id: str = 'cohort') -> pd.DataFrame:
+    """
+    Calculate noise for every sample of a manifest, sharing the bed file and reference between samples
+
+    The bed file is parsed once, and each worker process opens the reference once for all of its samples, until the
+    end of the batch.
+    Per-sample outputs are the same as from `calculate_noise`, prefixed with each sample ID, and the acgt, del and N
+    noise of all samples is combined in `cohort_id` + NOISE_SUMMARY.
+
+    :param ref_fasta: str - path to reference fasta
+    :param manifest_path: str - path to tab-separated manifest with columns 'sample_id' and 'bam_file'
+    :param bed_file_path: str - path to bed file
+    :param noise_threshold: float - threshold past which to exclude positions from noise calculation
+    :param settings: NoiseSettings - pileup filters and run options of every sample, e.g. its `cohort_store`
+    :param workers: int - Number of samples processed in parallel
+    :param cohort_id: str - prefix for the cohort summary file
+    :return: pd.DataFrame - cohort summary, one row per sample in manifest order
+    """
+    manifest = read_manifest(manifest_path)
+    intervals = bed_intervals(bed_file_path, settings.bed_padding)
+    sample_kwargs = dict(ref_fasta=ref_fasta, bed_file_path=bed_file_path, noise_threshold=noise_threshold,
+                         settings=settings, intervals=intervals)
+    samples = list(zip(manifest['sample_id'], manifest['bam_file']))
+
+    if workers <= 1 or len(samples) <= 1:
+        with reference_scope():
+            rows = [_batch_sample(sample_id, bam_path, sample_kwargs) for sample_id, bam_path in samples]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=worker_reference_scope) as executor:
+            futures = [executor.submit(_batch_sample, sample_id, bam_path, sample_kwargs)
+                       for sample_id, bam_path in samples]
+            rows = [future.result() for future in futures]
+
+    summary = pd.concat(rows, ignore_index=True)
+    summary.to_csv(cohort_id + NOISE_SUMMARY, sep='\t', index=False)
+    return summary
+
+
+def read_manifest(manifest_path: str) -> pd.DataFrame:
+    """
+    Read a batch manifest of sample IDs and bam paths
+
+    :param manifest_path: str - path to tab-separated file with columns 'sample_id' and 'bam_file'
+    :return: pd.DataFrame
+    """
+    manifest = pd.read_csv(manifest_path, sep='\t', dtype=str)
+    missing = {'sample_id', 'bam_file'} - set(manifest.columns)
+    if missing:
+        raise ValueError('Manifest {} is missing columns: {}'.format(manifest_path, ', '.join(sorted(missing))))
+    duplicated = manifest['sample_id'][manifest['sample_id'].duplicated()]
+    if not duplicated.empty:
+        raise ValueError('Manifest {} has duplicate sample IDs: {}'.format(manifest_path, ', '.join(duplicated)))
+    return manifest
+
+
+def _batch_sample(sample_id: str, bam_path: str, sample_kwargs: dict) -> pd.DataFrame:
+    """
+    Run `calculate_noise` for one sample of a batch, and collect its acgt, del and N noise into a single row
+
+    :param sample_id: str - sample ID, used as prefix for output files
+    :param bam_path: str - path to bam
+    :param sample_kwargs: dict - arguments shared by all samples, passed to `calculate_noise`
+    :return: pd.DataFrame - one row, with columns prefixed by the noise type
+    """
+    logger.info('Calculating noise for {}'.format(sample_id))
+    calculate_noise(bam_path=bam_path, sample_id=sample_id, **sample_kwargs)
 
-        pileup = pysamstats.load_pileup('variation', bam, chrom=chrom, start=start, end=stop, fafile=ref_fasta,
-                                        truncate=truncate, max_depth=max_depth, min_baseq=min_base_quality,
-                                        min_mapq=min_mapping_quality, stepper='nofilter')
+    row = pd.DataFrame({SAMPLE_ID: [sample_id]})
+    for noise_type, filename in [('acgt', NOISE_ACGT), ('del', NOISE_DEL), ('n', NOISE_N)]:
+        noise_df = pd.read_csv(sample_id + filename, sep='\t').drop(columns=SAMPLE_ID)
+        noise_df.columns = [noise_type + '_' + column for column in noise_df.columns]
+        row = pd.concat([row, noise_df], axis=1)
+    return row
 
-        tlen = pysamstats.load_pileup('tlen_strand', bam, chrom=chrom, start=start, end=stop, fafile=ref_fasta,
-                                        truncate=truncate, max_depth=max_depth, min_baseq=min_base_quality,
-                                        min_mapq=min_mapping_quality, stepper='nofilter')
 
-        pileup_df_all = pd.concat([pileup_df_all, pd.DataFrame(pileup)])
-        tlen_df_all = pd.concat([tlen_df_all, pd.DataFrame(tlen)])
+def recompute_noise(ref_fasta: str, bam_path: str, bed_file_path: str, noise_threshold: float, sample_id: str = '',
+                    settings: NoiseSettings = DEFAULT_SETTINGS, cache_path: str = None,
+                    metrics: Metrics = NO_METRICS) -> float:
+    """
+    Recalculate noise from the pileup cached by an earlier `calculate_noise` run with `cache_pileup`
 
-    # Convert bytes objects to strings so output tsv is formatted correctly
-    for field in ['chrom', 'ref']:
-        pileup_df_all.loc[:, field] = pileup_df_all[field].apply(lambda s: s.decode('utf-8'))
-    tlen_df_all.loc[:, 'chrom'] = tlen_df_all['chrom'].apply(lambda s: s.decode('utf-8'))
+    The cached pileup is only used if it was computed from the same bam, bed file, reference and pileup filters.
+    Otherwise the artifact is deleted, and the full calculation is run again, saving a new cache. The pileup and
+    tlen tables do not depend on `noise_threshold`, and are not rewritten when the cache is used.
 
-    # Save the complete pileup and tlen info
-    pileup_df_all[output_columns].to_csv(sample_id + OUTPUT_PILEUP_NAME, sep='\t', index=False)
-    tlen_df_all.to_csv(sample_id + OUTPUT_TLEN_NAME, sep='\t', index=False)
+    :param cache_path: str - path of the cached pileup, defaults to `sample_id` + PILEUP_CACHE_NAME
+    :param metrics: Metrics - records the time of each stage, including `load_pileup_cache`, and the written files
+    :return: float - Single noise value for this sample
 
-    # Continue with calculation
-    noise = _calculate_noise_from_pileup(pileup_df_all, sample_id, noise_threshold, bam_path)
+    See `calculate_noise` for the other parameters
+    """
+    check_output_format(PARQUET)
+    if cache_path is None:
+        cache_path = sample_id + PILEUP_CACHE_NAME
+
+    cache_key = settings.pileup_cache_key(ref_fasta, bam_path, bed_file_path)
+    with metrics.stage('load_pileup_cache'):
+        pileup, mismatched = load_pileup_cache(cache_path, cache_key)
+    if pileup is not None:
+        logger.info('Using cached pileup {}'.format(cache_path))
+        metrics.count('positions', len(pileup))
+        return _calculate_noise_from_pileup(pileup, sample_id, noise_threshold, bam_path, settings.output_format,
+                                            metrics, settings.make_plots)
+
+    if mismatched:
+        logger.info('Invalidated stale pileup cache {}, changed: {}'.format(cache_path, ', '.join(mismatched)))
+    else:
+        logger.info('No pileup cache found at {}'.format(cache_path))
+    noise = calculate_noise(ref_fasta, bam_path, bed_file_path, noise_threshold, sample_id,
+                            replace(settings, cache_pileup=True), metrics=metrics)
+    if cache_path != sample_id + PILEUP_CACHE_NAME:
+        replace_pileup_cache(sample_id + PILEUP_CACHE_NAME, cache_path)
     return noise
 
 
-def _calculate_noise_from_pileup(pileup: pd.DataFrame, sample_id: str, noise_threshold: float, bam_path: str) -> float:
+def _calculate_noise_from_pileup(pileup: pd.DataFrame, sample_id: str, noise_threshold: float, bam_path: str,
+                                 output_format: str = TSV, metrics: Metrics = NO_METRICS,
+                                 make_plots: bool = True, writer: InlineWriter = INLINE_WRITER,
+                                 subsample_fraction: float = 1.0) -> float:
     """
     Use the pileup to determine average noise, and create noise output files
 
@@ -128,98 +556,223 @@ def _calculate_noise_from_pileup(pileup: pd.DataFrame, sample_id: str, noise_thr
     :param pileup: pd.DataFrame - pileup of all positions and base counts from pysamstats
     :param sample_id: str - sample ID for naming outputs
     :param noise_threshold: float - Threshold past which to exclude positions from noise calculation
+    :param bam_path: str - path to bam, for the fragment sizes of noisy positions
+    :param output_format: str - format of the noisy positions table
+    :param metrics: Metrics - records the time of each stage, and counts of positions, reads and bytes
+    :param make_plots: bool - Write the HTML report, otherwise only its aggregates are written for `render_report`
+    :param writer: InlineWriter - writes the output files, in the background with a `BackgroundWriter`
+    :param subsample_fraction: float - fraction of read names the pileup was computed from, reported in NOISE_ACGT
     :return: float - Single noise value for this sample
     """
-    pileup_df_all = _calculate_alt_and_geno(pileup)
+    statistics = _noise_statistics(pileup, noise_threshold, metrics)
+    noisy_positions = statistics['noisy_positions'].sort_values(ALT_COUNT, ascending=False)
+
+    # Noise vs genotype insert size calculation
+    read_pair_stats = ReadPairStats()
+    with metrics.stage('fragment_sizes'):
+        noisy_tlen_df = get_fragment_size_for_sample(sample_id, bam_path, sample_id, noisy_positions, 0, 500,
+                                                     stats=read_pair_stats, writer=writer)
+    metrics.count('reads_fetched', read_pair_stats.reads_fetched)
+    metrics.count('pairs_emitted', read_pair_stats.pairs_emitted)
+    metrics.count('orphans_evicted', read_pair_stats.orphans_evicted)
+
+    return _write_noise_outputs(statistics, noisy_positions, noisy_tlen_df, sample_id, output_format, metrics,
+                                make_plots, writer, subsample_fraction)
+
+
+def _noise_statistics(pileup: pd.DataFrame, noise_threshold: float, metrics: Metrics = NO_METRICS) -> dict:
+    """
+    Totals of the pileup from which every noise output is written, which can be added up over regions
+
+    Counts are summed over positions, and the noisy positions are kept in pileup order, so the statistics of
+    consecutive parts of the pileup combine with `_combine_statistics` into the statistics of the whole pileup.
+
+    :param pileup: pd.DataFrame - pileup of all positions and base counts, to which the genotype and alt counts
+        are added
+    :param noise_threshold: float - Threshold past which to exclude positions from noise calculation
+    :param metrics: Metrics - records the time of each stage, and the number of noisy positions
+    :return: dict - counts of the acgt, del and N noise, `substitution` counts, `noisy_positions` and the
+        `n_counts` histogram of the report
+    """
+    with metrics.stage('alt_and_geno'):
+        pileup_df_all = _calculate_alt_and_geno(pileup)
 
     # Calculate sample noise and contributing sites for SNV / insertions
     #
     # Filter to only positions below noise threshold
-    thresh_boolv = pileup_df_all.apply(_apply_threshold, axis=1, thresh=noise_threshold)
-    below_thresh_positions = pileup_df_all[thresh_boolv]
-    noisy_boolv = (below_thresh_positions[ALT_COUNT] > 0) | (below_thresh_positions['insertions'] > 0)
-    noisy_positions = below_thresh_positions[noisy_boolv]
-    noisy_positions = noisy_positions.sort_values(ALT_COUNT, ascending=False)
+    with metrics.stage('threshold_filter'):
+        thresh_boolv = _threshold_mask(pileup_df_all, noise_threshold)
+        below_thresh_positions = pileup_df_all[thresh_boolv]
+        noisy_boolv = (below_thresh_positions[ALT_COUNT] > 0) | (below_thresh_positions['insertions'] > 0)
+        noisy_positions = below_thresh_positions[noisy_boolv]
+    metrics.count('noisy_positions', len(noisy_positions))
+
+    # For noise from Deletions
+    thresh_boolv_del = _deletion_threshold_mask(pileup_df_all, noise_threshold)
+    below_thresh_positions_del = pileup_df_all[thresh_boolv_del]
+    alt_count_total_del = below_thresh_positions_del['deletions'].to_numpy(dtype=np.int64).sum()
+
+    # For N's
+    noisy_positions_n = pileup_df_all[pileup_df_all['N'] > 0]
+
+    # By Substitution Type
+    with metrics.stage('substitution'):
+        substitution = _substitution_counts(below_thresh_positions)
+
+    return {
+        'alt_count': below_thresh_positions[ALT_COUNT].sum(),
+        'geno_count': below_thresh_positions[GENO_COUNT].sum(),
+        'del_count': alt_count_total_del,
+        'del_total': alt_count_total_del + below_thresh_positions_del['total_acgt'].sum(),
+        'del_sites': int((below_thresh_positions_del['deletions'] > 0).sum()),
+        'n_count': noisy_positions_n['N'].to_numpy(dtype=np.int64).sum(),
+        'acgt_total': pileup_df_all['total_acgt'].sum(),
+        'n_sites': len(noisy_positions_n),
+        'substitution': substitution,
+        'noisy_positions': noisy_positions,
+        'n_counts': report.summarize_n_counts(pileup_df_all),
+    }
+
+
+def _write_noise_outputs(statistics: dict, noisy_positions: pd.DataFrame, noisy_tlen_df: pd.DataFrame,
+                         sample_id: str, output_format: str = TSV, metrics: Metrics = NO_METRICS,
+                         make_plots: bool = True, writer: InlineWriter = INLINE_WRITER,
+                         subsample_fraction: float = 1.0) -> float:
+    """
+    Write the noise outputs and report from the statistics of `_noise_statistics`
+
+    :param statistics: dict - from `_noise_statistics` or `_combine_statistics`
+    :param noisy_positions: pd.DataFrame - noisy positions of `statistics`, sorted by decreasing alt count
+    :param noisy_tlen_df: pd.DataFrame - fragment sizes of `noisy_positions`, or None if there are none
+    :return: float - Single noise value for this sample
 
-    noisy_positions.to_csv(sample_id + OUTPUT_NOISE_FILENAME, sep='\t', index=False)
+    See `_calculate_noise_from_pileup` for the other parameters
+    """
+    with metrics.stage('write_tables'):
+        writer.submit(write_table, noisy_positions, sample_id, OUTPUT_NOISE_FILENAME, output_format)
     contributing_sites = noisy_positions.shape[0]
-    alt_count_total = below_thresh_positions[ALT_COUNT].sum()
-    geno_count_total = below_thresh_positions[GENO_COUNT].sum()
+    alt_count_total = statistics['alt_count']
+    geno_count_total = statistics['geno_count']
     noise = alt_count_total / (alt_count_total + geno_count_total + EPSILON)
+    noise_ci_lower, noise_ci_upper = wilson_interval(int(alt_count_total), int(alt_count_total + geno_count_total))
 
-    pd.DataFrame({
+    writer.submit(pd.DataFrame({
         SAMPLE_ID: [sample_id],
         ALT_COUNT: [alt_count_total],
         GENO_COUNT: [geno_count_total],
         NOISE_FRACTION: [noise],
-        CONTRIBUTING_SITES: [contributing_sites]
-    }).to_csv(sample_id + NOISE_ACGT, sep='\t', index=False)
+        CONTRIBUTING_SITES: [contributing_sites],
+        NOISE_CI_LOWER: [noise_ci_lower],
+        NOISE_CI_UPPER: [noise_ci_upper],
+        SUBSAMPLE_FRACTION: [subsample_fraction],
+    }).to_csv, sample_id + NOISE_ACGT, sep='\t', index=False)
 
     # For noise from Deletions
-    thresh_lambda = lambda row: (row['deletions'] / (row['total_acgt'] + row['deletions'] + EPSILON)) < noise_threshold
-    thresh_boolv_del = pileup_df_all.apply(thresh_lambda, axis=1)
-    below_thresh_positions_del = pileup_df_all[thresh_boolv_del]
-    noisy_positions_del = below_thresh_positions_del[below_thresh_positions_del['deletions'] > 0]
-    contributing_sites_del = noisy_positions_del.shape[0]
-    alt_count_total_del = below_thresh_positions_del['deletions'].sum()
-    total_count_del = alt_count_total_del + below_thresh_positions_del['total_acgt'].sum()
+    alt_count_total_del = statistics['del_count']
+    total_count_del = statistics['del_total']
     noise_del = alt_count_total_del / (total_count_del + EPSILON)
 
-    pd.DataFrame({
+    writer.submit(pd.DataFrame({
         SAMPLE_ID: [sample_id],
         DEL_COUNT: [alt_count_total_del],
         TOTAL_BASE_COUNT: [total_count_del],
         NOISE_FRACTION: [noise_del],
-        CONTRIBUTING_SITES: [contributing_sites_del]
-    }).to_csv(sample_id + NOISE_DEL, sep='\t', index=False)
+        CONTRIBUTING_SITES: [statistics['del_sites']]
+    }).to_csv, sample_id + NOISE_DEL, sep='\t', index=False)
 
     # For N's
-    noisy_positions_n = pileup_df_all[pileup_df_all['N'] > 0]
-    contributing_sites_n = noisy_positions_n.shape[0]
-    total_n = noisy_positions_n['N'].sum()
-    total_acgt = pileup_df_all['total_acgt'].sum()
+    total_n = statistics['n_count']
+    total_acgt = statistics['acgt_total']
     noise_n = total_n / (total_n + total_acgt + EPSILON)
 
     # By Substitution Type
-    st_df = _calculate_noise_by_substitution(below_thresh_positions, sample_id)
-    st_df.to_csv(sample_id + NOISE_BY_SUBSTITUTION, sep='\t')
-
-    # Noise vs genotype insert size calculation
-    noisy_tlen_df = get_fragment_size_for_sample(sample_id, bam_path, sample_id, noisy_positions, 0, 500)
-
-    # Make plots
-    plots.all_plots(pileup_df_all, noisy_positions, st_df, noisy_tlen_df, sample_id)
-
-    pd.DataFrame({
+    st_df = _substitution_frame(statistics['substitution'], sample_id)
+    writer.submit(st_df.to_csv, sample_id + NOISE_BY_SUBSTITUTION, sep='\t')
+
+    # Aggregates for the report, which can also be rendered later by render_report
+    with metrics.stage('report_data'):
+        data = report.report_data(None, noisy_positions, st_df, noisy_tlen_df, sample_id,
+                                  n_counts=statistics['n_counts'])
+        writer.submit(report.write_report_data, data, sample_id)
+
+    # Make plots, only importing the plotting libraries when a report is requested
+    if make_plots:
+        with metrics.stage('plots'):
+            from sequence_qc import plots
+            plots.render_report([data], sample_id + report.NOISE_REPORT, metrics=metrics)
+
+    writer.submit(pd.DataFrame({
         SAMPLE_ID: [sample_id],
         N_COUNT: [total_n],
         TOTAL_BASE_COUNT: [total_acgt],
         NOISE_FRACTION: [noise_n],
-        CONTRIBUTING_SITES: [contributing_sites_n]
-    }).to_csv(sample_id + NOISE_N, sep='\t', index=False)
-
+        CONTRIBUTING_SITES: [statistics['n_sites']]
+    }).to_csv, sample_id + NOISE_N, sep='\t', index=False)
+
+    writer.flush()
+    metrics.add_file(table_path(sample_id, OUTPUT_NOISE_FILENAME, output_format))
+    for filename in [NOISE_ACGT, NOISE_DEL, NOISE_N, NOISE_BY_SUBSTITUTION, NOISE_BY_TLEN, report.REPORT_DATA,
+                     report.NOISE_REPORT]:
+        metrics.add_file(sample_id + filename)
     return noise
 
 
-def _apply_threshold(row: pd.Series, thresh: float) -> bool:
+def load_report_data(sample_id: str, output_format: str = TSV) -> dict:
     """
-    Returns False if any alt allele crosses `thresh` for the given row of the pileup, True otherwise
+    Report aggregates of a sample, computed from the output tables of a `calculate_noise` run
 
-    :param row: pandas.Series - row that represents single pileup position
-    :param thresh: float - threshold past which alt allele fraction should return false
+    For runs whose `report.REPORT_DATA` file is missing, e.g. as it was deleted, the report can still be rendered
+    from the pileup, noisy positions, substitution and fragment size outputs.
+
+    :param sample_id: str - prefix of the output files
+    :param output_format: str - format of the pileup and noisy positions tables
+    :return: dict - as written to `report.REPORT_DATA`
+    """
+    pileup = load_table(sample_id, OUTPUT_PILEUP_NAME, output_format)
+    noisy_positions = load_table(sample_id, OUTPUT_NOISE_FILENAME, output_format)
+    st_df = pd.read_csv(sample_id + NOISE_BY_SUBSTITUTION, sep='\t', index_col=0, float_precision='round_trip')
+    return report.report_data(pileup, noisy_positions, st_df, read_fragment_sizes(sample_id), sample_id)
+
+
+def _genotype_index(pileup: pd.DataFrame) -> np.ndarray:
+    """
+    Index of the genotype base in A, C, G, T order for each position of the pileup
+
+    Ties are broken in favour of the first base in A, C, G, T order, as `max` does over a dict of base counts.
+
+    :param pileup: pd.DataFrame - pileup with columns 'A', 'C', 'G' and 'T'
+    :return: np.ndarray - integers 0-3
+    """
+    return np.argmax(pileup[['A', 'C', 'G', 'T']].to_numpy(), axis=1)
+
+
+def _threshold_mask(pileup: pd.DataFrame, thresh: float) -> np.ndarray:
     """
-    base_counts = {'A': row['A'], 'C': row['C'], 'G': row['G'], 'T': row['T']}
-    genotype = max(base_counts, key=base_counts.get)
+    Returns False for positions where any alt allele crosses `thresh`, True otherwise
 
-    non_geno_bases = ['A', 'C', 'G', 'T']
-    non_geno_bases.remove(genotype)
+    :param pileup: pd.DataFrame - pileup with columns 'A', 'C', 'G' and 'T'
+    :param thresh: float - threshold past which alt allele fraction should return false
+    :return: np.ndarray - boolean mask over the rows of `pileup`
+    """
+    base_counts = pileup[['A', 'C', 'G', 'T']].to_numpy(dtype=np.int64)
+    tot = base_counts.sum(axis=1)
+    alt_fractions = base_counts / (tot + EPSILON)[:, np.newaxis]
+    is_alt = np.ones(base_counts.shape, dtype=bool)
+    is_alt[np.arange(len(base_counts)), _genotype_index(pileup)] = False
+    return ~((alt_fractions > thresh) & is_alt).any(axis=1)
 
-    tot = row['A'] + row['C'] + row['G'] + row['T']
 
-    if any([row[r] / (tot + EPSILON) > thresh for r in non_geno_bases]):
-        return False
+def _deletion_threshold_mask(pileup: pd.DataFrame, thresh: float) -> np.ndarray:
+    """
+    Returns False for positions where the deletion fraction crosses `thresh`, True otherwise
 
-    return True
+    :param pileup: pd.DataFrame - pileup with columns 'deletions' and 'total_acgt'
+    :param thresh: float - threshold past which deletion fraction should return false
+    :return: np.ndarray - boolean mask over the rows of `pileup`
+    """
+    deletions = pileup['deletions'].to_numpy(dtype=np.int64)
+    total_acgt = pileup['total_acgt'].to_numpy(dtype=np.int64)
+    return deletions / (total_acgt + deletions + EPSILON) < thresh
 
 
 def _calculate_alt_and_geno(noise_df: pd.DataFrame) -> pd.DataFrame:
@@ -229,8 +782,10 @@ def _calculate_alt_and_geno(noise_df: pd.DataFrame) -> pd.DataFrame:
     :param noise_df: pd.DataFrame
     :return: pd.DataFrame
     """
-    noise_df['total_acgt'] = noise_df['A'] + noise_df['C'] + noise_df['G'] + noise_df['T']
-    noise_df[GENO_COUNT] = noise_df[['A', 'C', 'G', 'T']].max(axis=1)
+    # Sum as int64, as the base counts may be stored in narrower types
+    base_counts = noise_df[['A', 'C', 'G', 'T']].to_numpy(dtype=np.int64)
+    noise_df['total_acgt'] = base_counts.sum(axis=1)
+    noise_df[GENO_COUNT] = base_counts.max(axis=1)
     noise_df[ALT_COUNT] = noise_df['total_acgt'] - noise_df[GENO_COUNT]
     noise_df['noise_acgt'] = noise_df[ALT_COUNT] / noise_df['total_acgt']
     return noise_df
@@ -244,39 +799,49 @@ def _calculate_noise_by_substitution(below_thresh_positions: pd.DataFrame, sampl
     :param sample_id: str - sample ID for first column
     :return: pd.DataFrame
     """
-    # Alt counts for each substitution type
-    st_alt_counts = {}
-    for st in SUBSTITUTION_TYPES:
-        st_alt_counts[st] = 0
-
-    # Genotype counts for each substitution type
-    st_geno_counts = {}
-    for st in SUBSTITUTION_TYPES:
-        st_geno_counts[st] = 0
-
-    # Contributing sites counts for each substitution type
-    st_contributing_sites = {}
-    for st in SUBSTITUTION_TYPES:
-        st_contributing_sites[st] = 0
-
-    for _, row in below_thresh_positions.iterrows():
-        alts = ['A', 'C', 'G', 'T']
-        base_counts = {'A': row['A'], 'C': row['C'], 'G': row['G'], 'T': row['T']}
-        genotype = max(base_counts, key=base_counts.get)
-        alts.remove(genotype)
-        geno_count = row[['A', 'C', 'G', 'T']].max()
-
-        for alt in alts:
-            st = genotype + '>' + alt
-            st_geno_counts[st] += geno_count
-            st_alt_counts[st] += row[alt]
-
-            if row[alt] > 0:
-                st_contributing_sites[st] += 1
-
-    st_df = pd.DataFrame.from_dict(st_alt_counts, orient='index', columns=[ALT_COUNT])
-    st_df[GENO_COUNT] = st_df.index.map(st_geno_counts)
-    st_df[CONTRIBUTING_SITES] = st_df.index.map(st_contributing_sites)
+    return _substitution_frame(_substitution_counts(below_thresh_positions), sample_id)
+
+
+def _substitution_counts(below_thresh_positions: pd.DataFrame) -> pd.DataFrame:
+    """
+    Alt and genotype counts, and contributing sites, of each substitution type
+
+    :param below_thresh_positions: pd.DataFrame
+    :return: pd.DataFrame - int64 counts indexed by `SUBSTITUTION_TYPES`, which can be added up over regions
+    """
+    base_counts = below_thresh_positions[['A', 'C', 'G', 'T']].to_numpy(dtype=np.int64)
+    genotype = _genotype_index(below_thresh_positions)
+    geno_count = base_counts.max(axis=1)
+
+    n_types = len(SUBSTITUTION_TYPES)
+    st_alt_counts = np.zeros(n_types, dtype=np.int64)
+    st_geno_counts = np.zeros(n_types, dtype=np.int64)
+    st_contributing_sites = np.zeros(n_types, dtype=np.int64)
+
+    for alt in range(4):
+        is_alt = genotype != alt
+        alt_geno = genotype[is_alt]
+        alt_count = base_counts[is_alt, alt]
+        # SUBSTITUTION_TYPES holds the three alts of each genotype in A, C, G, T order
+        st_index = alt_geno * 3 + alt - (alt > alt_geno)
+
+        st_alt_counts += np.bincount(st_index, weights=alt_count, minlength=n_types).astype(np.int64)
+        st_geno_counts += np.bincount(st_index, weights=geno_count[is_alt], minlength=n_types).astype(np.int64)
+        st_contributing_sites += np.bincount(st_index[alt_count > 0], minlength=n_types)
+
+    counts = pd.DataFrame({ALT_COUNT: st_alt_counts}, index=SUBSTITUTION_TYPES)
+    counts[GENO_COUNT] = st_geno_counts
+    counts[CONTRIBUTING_SITES] = st_contributing_sites
+    return counts
+
+
+def _substitution_frame(counts: pd.DataFrame, sample_id: str) -> pd.DataFrame:
+    """
+    Noise of each substitution type, from the counts of `_substitution_counts`
+
+    :return: pd.DataFrame
+    """
+    st_df = counts.copy()
     st_df[NOISE_FRACTION] = st_df[ALT_COUNT] / (st_df[ALT_COUNT] + st_df[GENO_COUNT])
     st_df['sample_id'] = sample_id
     return st_df
@@ -1,39 +1,266 @@
+import bisect
+import heapq
+import os
+import numpy as np
 import pysam
 import pandas as pd
 
+from array import array
 from collections import defaultdict
 
+from sequence_qc.pipeline import INLINE_WRITER
 
-def read_pair_generator(bam, region_string=None):
+
+# Reads are fetched within this many bases of each noisy position
+WINDOW_PADDING = 300
+# Mate positions can be slightly stale (e.g. after local realignment), so unpaired reads are only evicted
+# once the fetch is this many bases past the expected start of their mate
+MATE_POSITION_TOLERANCE = 1000
+
+# Output file of the fragment sizes of noisy positions
+NOISE_BY_TLEN = '_noise_by_tlen.tsv'
+# Columns of the `<sample_id>_noise_by_tlen.tsv` file, which is written without a header
+TLEN_COLUMNS = ["Sample", "Type", "read_id", "Var", "Size", "Chr", "Pos", "geno_not_geno"]
+# Columns of `FragmentSizeRecords.to_table`, which keeps the index of each record's noisy position
+FRAGMENT_SIZE_TABLE_COLUMNS = ["read_id", "Var", "Size", "Chr", "Pos", "geno_not_geno", "position_index"]
+
+# CIGAR operations that align a query base to a reference base (M, = and X), that only consume the reference
+# (D and N), and that only consume the query (I and S)
+_ALIGNED_OPS = frozenset([0, 7, 8])
+_REFERENCE_ONLY_OPS = frozenset([2, 3])
+_QUERY_ONLY_OPS = frozenset([1, 4])
+_NON_GENOTYPE_BASES = {genotype: {base for base in 'ACGT' if base != genotype} for genotype in 'ACGT'}
+
+
+class FragmentSizeRecords:
+    """
+    Column buffers for the classified read pairs of noisy positions
+
+    Sizes and positions are kept as integers and the other fields as strings, in the order the pairs are added,
+    along with the index of their noisy position so that `to_frame` can return them in the order of the positions.
+    """
+
+    def __init__(self):
+        self.read_ids = []
+        self.variants = []
+        self.sizes = array('q')
+        self.chroms = []
+        self.positions = array('q')
+        self.alleles = []
+        self.position_index = array('q')
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def add(self, index: int, noise_pos, record: tuple) -> None:
+        """
+        Add a read pair of the noisy position `noise_pos`
+
+        :param index: int - index of `noise_pos` in the noisy positions
+        :param noise_pos: namedtuple - noisy position, with 'chrom' and 'pos'
+        :param record: tuple - (read_id, variant, size, allele) from `_fragment_size_record`
+        """
+        read_id, variant, size, allele = record
+        self.read_ids.append(read_id)
+        self.variants.append(variant)
+        self.sizes.append(size)
+        self.chroms.append(str(noise_pos.chrom))
+        self.positions.append(int(noise_pos.pos))
+        self.alleles.append(allele)
+        self.position_index.append(index)
+
+    def to_frame(self, sample_id: str, tag: str) -> pd.DataFrame:
+        """
+        Records sorted by the index of their noisy position, keeping the order of each position's pairs
+
+        :return: pd.DataFrame - with `TLEN_COLUMNS`, integer Size and Pos, and categorical Var, Chr and geno_not_geno
+        """
+        order = np.argsort(np.frombuffer(self.position_index, dtype=np.int64), kind='stable')
+        n = len(order)
+        return pd.DataFrame({
+            'Sample': pd.Categorical([sample_id] * n),
+            'Type': pd.Categorical([tag] * n),
+            'read_id': np.array(self.read_ids, dtype=object)[order],
+            'Var': pd.Categorical(np.array(self.variants, dtype=object)[order]),
+            'Size': np.frombuffer(self.sizes, dtype=np.int64)[order],
+            'Chr': pd.Categorical(np.array(self.chroms, dtype=object)[order]),
+            'Pos': np.frombuffer(self.positions, dtype=np.int64)[order],
+            'geno_not_geno': pd.Categorical(np.array(self.alleles, dtype=object)[order]),
+        }, columns=TLEN_COLUMNS)
+
+    def to_table(self) -> pd.DataFrame:
+        """
+        Records in the order they were added, with the index of their noisy position, for `from_table`
+
+        :return: pd.DataFrame - with `FRAGMENT_SIZE_TABLE_COLUMNS`
+        """
+        return pd.DataFrame({
+            'read_id': np.array(self.read_ids, dtype=object),
+            'Var': np.array(self.variants, dtype=object),
+            'Size': np.frombuffer(self.sizes, dtype=np.int64),
+            'Chr': np.array(self.chroms, dtype=object),
+            'Pos': np.frombuffer(self.positions, dtype=np.int64),
+            'geno_not_geno': np.array(self.alleles, dtype=object),
+            'position_index': np.frombuffer(self.position_index, dtype=np.int64),
+        }, columns=FRAGMENT_SIZE_TABLE_COLUMNS)
+
+    @classmethod
+    def from_table(cls, table: pd.DataFrame) -> 'FragmentSizeRecords':
+        """
+        Records of a table written from `to_table`
+
+        :param table: pd.DataFrame - with `FRAGMENT_SIZE_TABLE_COLUMNS`
+        :return: FragmentSizeRecords
+        """
+        records = cls()
+        records.read_ids = [str(read_id) for read_id in table['read_id']]
+        records.variants = [str(variant) for variant in table['Var']]
+        records.sizes = array('q', table['Size'].to_numpy(dtype=np.int64).tolist())
+        records.chroms = [str(chrom) for chrom in table['Chr']]
+        records.positions = array('q', table['Pos'].to_numpy(dtype=np.int64).tolist())
+        records.alleles = [str(allele) for allele in table['geno_not_geno']]
+        records.position_index = array('q', table['position_index'].to_numpy(dtype=np.int64).tolist())
+        return records
+
+    def extend(self, records: 'FragmentSizeRecords', position_index: np.ndarray) -> None:
+        """
+        Add the read pairs of `records`, e.g. of another part of the noisy positions, after the pairs already added
+
+        :param records: FragmentSizeRecords
+        :param position_index: np.ndarray - new index of each noisy position of `records`, by its index in `records`
+        """
+        self.read_ids.extend(records.read_ids)
+        self.variants.extend(records.variants)
+        self.sizes.extend(records.sizes)
+        self.chroms.extend(records.chroms)
+        self.positions.extend(records.positions)
+        self.alleles.extend(records.alleles)
+        self.position_index.extend(position_index[np.frombuffer(records.position_index, dtype=np.int64)].tolist())
+
+
+class ReadPositionIndex:
+    """
+    Reference and query start of each aligned block of a read, built once from its CIGAR
+
+    Blocks are the M, = and X operations, so soft clips and insertions are skipped, and deleted or skipped
+    reference positions fall between blocks. The base of the read at any reference position is then found
+    with a binary search over the blocks, however many noisy positions the read is checked at.
+    """
+
+    __slots__ = ('block_starts', 'block_ends', 'query_starts', 'sequence')
+
+    def __init__(self, read):
+        """
+        :param read: pysam.AlignedSegment
+        """
+        self.block_starts = []
+        self.block_ends = []
+        self.query_starts = []
+        self.sequence = read.query_sequence
+        cigar = read.cigartuples
+        if not cigar or self.sequence is None or read.reference_start < 0:
+            return
+        reference_position = read.reference_start
+        query_position = 0
+        for op, length in cigar:
+            if op in _ALIGNED_OPS:
+                self.block_starts.append(reference_position)
+                self.query_starts.append(query_position)
+                reference_position += length
+                query_position += length
+                self.block_ends.append(reference_position)
+            elif op in _REFERENCE_ONLY_OPS:
+                reference_position += length
+            elif op in _QUERY_ONLY_OPS:
+                query_position += length
+
+    def base_at(self, pos: int):
+        """
+        :param pos: int - 0-based reference position
+        :return: str - base of the read aligned to `pos`, or None if `pos` is outside the read, deleted or skipped
+        """
+        block = bisect.bisect_right(self.block_starts, pos) - 1
+        if block < 0 or pos >= self.block_ends[block]:
+            return None
+        return self.sequence[self.query_starts[block] + pos - self.block_starts[block]]
+
+
+class ReadPairStats:
+    """
+    Counters for `read_pair_generator`, accumulated over every region it is called for
+    """
+
+    def __init__(self):
+        self.reads_fetched = 0
+        self.pairs_emitted = 0
+        self.orphans_evicted = 0
+        self.peak_buffer_size = 0
+
+
+def read_pair_generator(bam, region_string=None, stats=None):
     """
     Generate read pairs in a BAM file or within a region string.
 
-    Reads are added to read_dict until a pair is found.
+    Reads are added to read_dict until a pair is found. As the BAM is coordinate sorted,
+    a read is evicted from read_dict once the fetch has moved past the start of its mate
+    (plus MATE_POSITION_TOLERANCE), so mates outside of the region or removed by filtering
+    do not accumulate. Reads with a mate on another contig are not kept when fetching a region.
 
     :param: bam pysam.AlignmentFile
     :param: region str - region to search, with format chr:start-end
+    :param: stats ReadPairStats - optional counters to update
     """
+    if stats is None:
+        stats = ReadPairStats()
     read_dict = defaultdict(lambda: [None, None])
+    # Heap of (mate position, query name) for the reads in read_dict
+    pending_mates = []
     for read in bam.fetch(region=region_string):
+        stats.reads_fetched += 1
+        position = (read.reference_id, read.reference_start)
+        while pending_mates and pending_mates[0][0] < position:
+            mate_position, qname = heapq.heappop(pending_mates)
+            # Skip entries for reads that were already paired
+            if qname in read_dict and _mate_position(_pending_read(read_dict[qname])) == mate_position:
+                del read_dict[qname]
+                stats.orphans_evicted += 1
+
         qname = read.query_name
         if qname not in read_dict:
+            if region_string is not None and read.next_reference_id != read.reference_id:
+                # Mate can't be part of this fetch
+                stats.orphans_evicted += 1
+                continue
             if read.is_read1:
                 read_dict[qname][0] = read
             else:
                 read_dict[qname][1] = read
+            heapq.heappush(pending_mates, (_mate_position(read), qname))
+            stats.peak_buffer_size = max(stats.peak_buffer_size, len(read_dict))
         else:
             try:
                 if read.is_read1 and read.tlen == -read_dict[qname][1].tlen:
+                    stats.pairs_emitted += 1
                     yield read, read_dict[qname][1]
                 else:
                     if read.tlen == -read_dict[qname][0].tlen:
+                        stats.pairs_emitted += 1
                         yield read_dict[qname][0], read
             except AttributeError:
                 pass
             del read_dict[qname]
 
 
-def get_fragment_size_for_sample(sample_id, bam_file_path, tag, noise_df, mifs, mafs):
+def _pending_read(read_pair):
+    return read_pair[0] if read_pair[0] is not None else read_pair[1]
+
+
+def _mate_position(read):
+    return read.next_reference_id, read.next_reference_start + MATE_POSITION_TOLERANCE
+
+
+def get_fragment_size_for_sample(sample_id, bam_file_path, tag, noise_df, mifs, mafs, sweep=True, stats=None,
+                                 writer=INLINE_WRITER):
     """
     Search through positions in `noise_df` for reads from `bam_file_path`
     and write tlen information for reads that represent either noise or
@@ -46,103 +273,205 @@ def get_fragment_size_for_sample(sample_id, bam_file_path, tag, noise_df, mifs,
     :param: include_readname bool -
     :param: mifs int - Minimum tlen of reads to include in calculation
     :param: mafs int - Maximum tlen of reads to include in calculation
+    :param: sweep bool - Read each stretch of nearby noisy positions from the bam once, instead of once per position
+    :param: stats ReadPairStats - optional counters for the read pairing
+    :param: writer InlineWriter - writes the output file, in the background with a `BackgroundWriter`
+    :return: pd.DataFrame - the written records, with `TLEN_COLUMNS`, or None if `noise_df` is empty
     """
-    filename = sample_id + '_noise_by_tlen.tsv'
-    out_fh = open(filename, 'w')
-    bamfile = pysam.AlignmentFile(bam_file_path, "rb")
     if len(noise_df.index) == 0:
+        write_fragment_sizes(sample_id, None, writer)
         return
-    for i, noise_pos in enumerate(noise_df.itertuples()):
-        get_fragment_size_for_noisy_position(sample_id, bamfile, noise_pos, tag, out_fh, mifs, mafs)
-    out_fh.close()
-    # Read file back in so it can be returned for plotting
-    noisy_tlen_df = pd.read_csv(
-        filename,
-        sep="\t",
-        header=None,
-        names=["Sample", "Type", "read_id", "Var", "Size", "Chr", "Pos", "geno_not_geno"],
-        dtype="object",
-    )
+    records = collect_fragment_sizes(bam_file_path, noise_df, mifs, mafs, sweep=sweep, stats=stats)
+    noisy_tlen_df = records.to_frame(sample_id, tag)
+    write_fragment_sizes(sample_id, noisy_tlen_df, writer)
     return noisy_tlen_df
 
 
-def get_fragment_size_for_noisy_position(sample_id, bamfile, noise_pos, tag, out_fh, mifs, mafs):
+def collect_fragment_sizes(bam_file_path, noise_df, mifs, mafs, sweep=True, stats=None):
+    """
+    Classify the read pairs of every position in `noise_df`, see `get_fragment_size_for_sample`
+
+    :return: FragmentSizeRecords
+    """
+    records = FragmentSizeRecords()
+    with pysam.AlignmentFile(bam_file_path, "rb") as bamfile:
+        if sweep:
+            get_fragment_size_for_positions(bamfile, noise_df, records, mifs, mafs, stats=stats)
+        else:
+            for i, noise_pos in enumerate(noise_df.itertuples()):
+                get_fragment_size_for_noisy_position(bamfile, i, noise_pos, records, mifs, mafs, stats=stats)
+    return records
+
+
+def write_fragment_sizes(sample_id, noisy_tlen_df, writer=INLINE_WRITER):
+    """
+    Write the fragment sizes of noisy positions to `sample_id` + NOISE_BY_TLEN, without a header
+
+    :param: noisy_tlen_df pd.DataFrame - records with `TLEN_COLUMNS`, or None for an empty file
+    """
+    filename = sample_id + NOISE_BY_TLEN
+    if noisy_tlen_df is None:
+        writer.submit(_write_empty_file, filename)
+    else:
+        writer.submit(noisy_tlen_df.to_csv, filename, sep='\t', header=False, index=False)
+
+
+def _write_empty_file(filename):
+    open(filename, 'w').close()
+
+
+def read_fragment_sizes(sample_id):
+    """
+    Load the fragment sizes of noisy positions written by `write_fragment_sizes`
+
+    :return: pd.DataFrame - records with `TLEN_COLUMNS`, or None if there were no noisy positions
+    """
+    filename = sample_id + NOISE_BY_TLEN
+    if os.path.getsize(filename) == 0:
+        return None
+    return pd.read_csv(filename, sep='\t', header=None, names=TLEN_COLUMNS)
+
+
+def get_fragment_size_for_positions(bamfile, noise_df, records, mifs, mafs, stats=None):
+    """
+    Same output as calling `get_fragment_size_for_noisy_position` for each row of `noise_df`,
+    but reads each stretch of nearby positions from the bam in a single pass.
+
+    Positions are sorted, and their windows of +/- WINDOW_PADDING bases are merged into regions.
+    Each read pair from a region is assigned to every position whose window contains both reads,
+    which are the positions that would have seen that pair in their own window.
+
+    :param bamfile: pysam.AlignmentFile
+    :param noise_df: pd.DataFrame - Query positions, with 'chrom', 'pos' and base count columns
+    :param records: FragmentSizeRecords - buffers the pairs are added to, with the index of their position
+    :param mifs: int
+    :param mafs: int
+    :param stats: ReadPairStats - optional counters for the read pairing
+    """
+    noise_positions = list(noise_df.itertuples())
+
+    positions_by_chrom = defaultdict(list)
+    for i, noise_pos in enumerate(noise_positions):
+        positions_by_chrom[str(noise_pos.chrom)].append((int(noise_pos.pos), i))
+
+    for chrom, positions in positions_by_chrom.items():
+        positions.sort()
+        for region_positions in _merge_position_windows(positions):
+            pos_values = [pos for pos, _ in region_positions]
+            region_start = _position_window(pos_values[0])[0]
+            region_end = _position_window(pos_values[-1])[1]
+            region_string = '{}:{}-{}'.format(chrom, region_start + 1, region_end)
+
+            for read1, read2 in read_pair_generator(bamfile, region_string=region_string, stats=stats):
+                # Positions whose window overlaps both reads, as a bam.fetch of that window would require
+                first = bisect.bisect_left(pos_values, max(_read_start(read1), _read_start(read2)) - WINDOW_PADDING + 1)
+                last = bisect.bisect_right(pos_values, min(_read_end(read1), _read_end(read2)) + WINDOW_PADDING)
+                if first >= last or not mifs <= abs(read1.tlen) <= mafs:
+                    continue
+                # Built once per pair, and shared by all of its positions
+                read_indexes = ReadPositionIndex(read1), ReadPositionIndex(read2)
+                for _, i in region_positions[first:last]:
+                    record = _fragment_size_record(read1, read2, noise_positions[i], mifs, mafs, *read_indexes)
+                    if record:
+                        records.add(i, noise_positions[i], record)
+
+
+def _position_window(pos):
+    """
+    0-based, half-open window fetched around a noisy position, matching the region string
+    built in `get_fragment_size_for_noisy_position`
+
+    :param pos: int - 0-based position
+    :return: tuple - (start, end)
+    """
+    return max(pos - WINDOW_PADDING - 1, 0), pos + WINDOW_PADDING
+
+
+def _merge_position_windows(positions):
+    """
+    Group sorted positions into runs whose windows overlap
+
+    :param positions: list - sorted (pos, index) tuples
+    """
+    group = [positions[0]]
+    for position in positions[1:]:
+        if _position_window(position[0])[0] < _position_window(group[-1][0])[1]:
+            group.append(position)
+        else:
+            yield group
+            group = [position]
+    yield group
+
+
+def _read_start(read):
+    return read.reference_start
+
+
+def _read_end(read):
+    # bam.fetch treats reads without an aligned length as covering a single base
+    return read.reference_end if read.reference_end is not None else read.reference_start + 1
+
+
+def get_fragment_size_for_noisy_position(bamfile, index, noise_pos, records, mifs, mafs, stats=None):
     """
     The TLEN of each of the paired reads will count as either GENOTYPE or NOISE,
     depending on the base at the query position.
 
     Called once for each position.
 
-    :param sample_id: str
     :param bamfile: pysam.AlignmentFile
+    :param index: int - index of the position in the noisy positions
     :param noise_pos: pd.Series - Query position, with 'chrom' and 'pos' columns
-    :param tag: str
-    :param out_fh: filehandle
+    :param records: FragmentSizeRecords - buffers the pairs are added to
     :param mifs: int
     :param mafs: int
+    :param stats: ReadPairStats - optional counters for the read pairing
     """
-    start = int(noise_pos.pos) - 300
-    if start < 1:
-        start = '1'
-    start = str(start)
-    end = str(int(noise_pos.pos) + 300)
-    region_string = str(noise_pos.chrom) + ":" + start + "-" + end
-
-    for read1, read2 in read_pair_generator(bamfile, region_string=region_string):
-        base_counts = {'A': noise_pos.A, 'C': noise_pos.C, 'G': noise_pos.G, 'T': noise_pos.T}
-        genotype = max(base_counts, key=base_counts.get)
-        non_geno_bases = ['A', 'C', 'G', 'T']
-        non_geno_bases.remove(genotype)
-
-        geno_coordinate = "\t".join(
-            [str(noise_pos.chrom), str(noise_pos.pos), genotype])
-
-        non_geno_coordinate = "\t".join(
-            [str(noise_pos.chrom), str(noise_pos.pos), 'not_' + genotype])
-
-        try:
-            tlen_is_within_range = (mifs <= abs(read1.tlen) <= mafs)
-            if not tlen_is_within_range: continue
-
-            position_is_within_read_1 = (read1.pos <= int(noise_pos.pos) <= read1.aend)
-            position_is_within_read_2 = (read2.pos <= int(noise_pos.pos) <= read2.aend)
-
-            read_1_base = read1.seq[int(noise_pos.pos) - read1.pos]
-            read_2_base = read2.seq[int(noise_pos.pos) - read2.pos]
-            read_1_has_genotype_at_position = (read_1_base == genotype)
-            read_2_has_genotype_at_position = (read_2_base == genotype)
-            read_1_has_non_geno_at_position = (read_1_base in non_geno_bases)
-            read_2_has_non_geno_at_position = (read_2_base in non_geno_bases)
-            read_1_has_n_at_position = (read_1_base == 'N')
-            read_2_has_n_at_position = (read_2_base == 'N')
-
-            if ((position_is_within_read_1 and read_1_has_non_geno_at_position)
-                or
-                (position_is_within_read_2 and read_2_has_non_geno_at_position)):
-
-                # Todo: Handle overlapping reads with different bases
-                sub_type = genotype + '>' + (read_1_base if position_is_within_read_1 else read_2_base)
-                line = [sample_id, tag, read1.qname, sub_type, str(abs(read1.tlen)), non_geno_coordinate]
-                out_fh.write("\t".join(line) + "\n")
-                continue
+    start, end = _position_window(int(noise_pos.pos))
+    region_string = str(noise_pos.chrom) + ":" + str(start + 1) + "-" + str(end)
 
-            elif ((position_is_within_read_1 and read_1_has_genotype_at_position)
-                or
-                (position_is_within_read_2 and read_2_has_genotype_at_position)):
+    for read1, read2 in read_pair_generator(bamfile, region_string=region_string, stats=stats):
+        record = _fragment_size_record(read1, read2, noise_pos, mifs, mafs)
+        if record:
+            records.add(index, noise_pos, record)
 
-                line = [sample_id, tag, read1.qname, "GENOTYPE", str(abs(read1.tlen)), geno_coordinate]
-                out_fh.write("\t".join(line)+ "\n")
-                continue
 
-            elif ((position_is_within_read_1 and read_1_has_n_at_position)
-                or
-                (position_is_within_read_2 and read_2_has_n_at_position)):
+def _fragment_size_record(read1, read2, noise_pos, mifs, mafs, read1_index=None, read2_index=None):
+    """
+    Classify a read pair as GENOTYPE, noise, or N at the query position
 
-                line = [sample_id, tag, read1.qname, "N", str(abs(read1.tlen)), geno_coordinate]
-                out_fh.write("\t".join(line)+ "\n")
-                continue
+    The base of each read at the position is found from its CIGAR, so soft clips, insertions and deletions
+    are accounted for. Reads with a deletion or reference skip at the position do not have a base there.
+
+    :param read1: pysam.AlignedSegment
+    :param read2: pysam.AlignedSegment
+    :param noise_pos: pd.Series - Query position, with 'chrom', 'pos' and base count columns
+    :param mifs: int
+    :param mafs: int
+    :param read1_index: ReadPositionIndex - index of `read1`, built if not given
+    :param read2_index: ReadPositionIndex - index of `read2`, built if not given
+    :return: tuple - (read_id, variant, size, allele) for this pair, or None if the pair is not counted
+    """
+    tlen_is_within_range = (mifs <= abs(read1.tlen) <= mafs)
+    if not tlen_is_within_range:
+        return None
+
+    base_counts = {'A': noise_pos.A, 'C': noise_pos.C, 'G': noise_pos.G, 'T': noise_pos.T}
+    genotype = max(base_counts, key=base_counts.get)
+
+    pos = int(noise_pos.pos)
+    if read1_index is None:
+        read1_index = ReadPositionIndex(read1)
+    if read2_index is None:
+        read2_index = ReadPositionIndex(read2)
+    bases = (read1_index.base_at(pos), read2_index.base_at(pos))
 
-        except (IndexError, AttributeError, TypeError) as e:
-            # todo: investigate why TypeError is thrown and read1.aend is sometimes undefined
-            print(e)
-            pass
+    # Todo: Handle overlapping reads with different bases
+    for base in bases:
+        if base in _NON_GENOTYPE_BASES[genotype]:
+            return read1.query_name, genotype + '>' + base, abs(read1.tlen), 'not_' + genotype
+    if genotype in bases:
+        return read1.query_name, "GENOTYPE", abs(read1.tlen), genotype
+    if 'N' in bases:
+        return read1.query_name, "N", abs(read1.tlen), genotype
+    return None
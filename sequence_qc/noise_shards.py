@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import pandas as pd
+
+from sequence_qc.noise_by_tlen import FragmentSizeRecords
+from sequence_qc.tables import PARQUET, read_table, write_table
+
+
+NOISE_SHARD_NAME = '_noise_shard.json'
+# Tables of a shard, written as parquet next to its json file, which keeps their dtypes and categories
+SHARD_POSITIONS_NAME = '_noise_shard_positions.tsv'
+SHARD_FRAGMENT_SIZES_NAME = '_noise_shard_fragment_sizes.tsv'
+# Bump when the layout of the shard statistics changes, so that shards of different versions are not merged
+SHARD_VERSION = 2
+# Counts of the shard statistics, which are added up over the shards
+SHARD_COUNTS = ['alt_count', 'geno_count', 'del_count', 'del_total', 'n_count', 'acgt_total', 'del_sites', 'n_sites']
+
+
+def parse_shard(shard: str) -> tuple:
+    """
+    Parse a shard given as 'i/N', the i-th of N shards counting from 1
+
+    :param shard: str - e.g. '2/8'
+    :return: tuple - (i, N)
+    """
+    try:
+        index, n_shards = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise ValueError('Shard must be given as i/N, e.g. 2/8, got {}'.format(shard))
+    if not 1 <= index <= n_shards:
+        raise ValueError('Shard {} is out of range, i must be between 1 and N'.format(shard))
+    return index, n_shards
+
+
+def shard_prefix(sample_id: str, index: int, n_shards: int) -> str:
+    """
+    Prefix of the output files of a shard, so that the shards of a sample can be written to the same directory
+    """
+    return '{}_shard_{}_of_{}'.format(sample_id, index, n_shards)
+
+
+def intervals_checksum(intervals: list) -> str:
+    """
+    Checksum of all the intervals of a sample, identifying the run that a shard is a part of
+
+    :param intervals: list - (chrom, start, stop) tuples, from `bed_intervals`
+    :return: str
+    """
+    sha = hashlib.sha256()
+    for chrom, start, stop in intervals:
+        sha.update('{}\t{}\t{}\n'.format(chrom, start, stop).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def save_noise_shard(prefix: str, index: int, n_shards: int, settings: dict, statistics: dict) -> list:
+    """
+    Save the statistics of a shard, for `load_noise_shards`
+
+    The settings and counts are written to `prefix` + NOISE_SHARD_NAME, and the noisy positions and their fragment
+    sizes to parquet tables that it refers to. The json file is written last, so that it is only found complete.
+
+    :param prefix: str - prefix of the shard files, from `shard_prefix`
+    :param index: int - i of shard i/N
+    :param n_shards: int - N of shard i/N
+    :param settings: dict - settings that all shards of a run must share, e.g. the noise threshold
+    :param statistics: dict - counts, noisy positions and fragment sizes of the shard
+    :return: list - paths of the written files
+    """
+    noisy_positions = statistics['noisy_positions']
+    positions_path = write_table(noisy_positions, prefix, SHARD_POSITIONS_NAME, PARQUET)
+    fragment_sizes_path = write_table(statistics['fragment_sizes'].to_table(), prefix, SHARD_FRAGMENT_SIZES_NAME,
+                                      PARQUET)
+    # The parquet tables store narrower integers, and the categories of empty columns may be lost
+    columns = {}
+    for column, dtype in noisy_positions.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            columns[column] = {'categories': dtype.categories.tolist()}
+        else:
+            columns[column] = {'dtype': str(dtype)}
+
+    shard = {
+        'version': SHARD_VERSION,
+        'shard': [index, n_shards],
+        'settings': settings,
+        'counts': {key: int(statistics[key]) for key in SHARD_COUNTS},
+        'substitution': statistics['substitution'].to_dict(orient='split'),
+        'n_counts': statistics['n_counts'],
+        'noisy_positions': {'path': os.path.basename(positions_path), 'columns': columns},
+        'fragment_sizes': {'path': os.path.basename(fragment_sizes_path)},
+    }
+    path = prefix + NOISE_SHARD_NAME
+    with open(path, 'w') as f:
+        json.dump(shard, f)
+    return [positions_path, fragment_sizes_path, path]
+
+
+def load_noise_shards(paths: list) -> tuple:
+    """
+    Load the shard files of a run, checking that they are complete and were computed with the same settings
+
+    :param paths: list - paths of the json files of the shards, in any order
+    :return: tuple - (settings, list of shard statistics in shard order)
+    """
+    shards = []
+    for path in paths:
+        with open(path) as f:
+            shard = json.load(f)
+        if shard.get('version') != SHARD_VERSION:
+            raise ValueError('{} was written by an incompatible version of sequence_qc'.format(path))
+        shards.append((path, shard))
+    if not shards:
+        raise ValueError('No shard files to merge')
+
+    settings = shards[0][1]['settings']
+    n_shards = shards[0][1]['shard'][1]
+    for path, shard in shards:
+        if shard['settings'] != settings or shard['shard'][1] != n_shards:
+            raise ValueError('{} was computed with different settings than {}'.format(path, shards[0][0]))
+    indices = sorted(shard['shard'][0] for _, shard in shards)
+    if indices != list(range(1, n_shards + 1)):
+        raise ValueError('Expected each of the {} shards once, got shards {}'.format(n_shards, indices))
+    shards.sort(key=lambda path_shard: path_shard[1]['shard'][0])
+    return settings, [_shard_statistics(path, shard) for path, shard in shards]
+
+
+def _shard_statistics(path: str, shard: dict) -> dict:
+    """
+    Statistics of a shard as passed to `save_noise_shard`, from its json file and tables
+
+    :param path: str - path of the json file, next to which the tables are found
+    :param shard: dict - contents of the json file
+    :return: dict
+    """
+    directory = os.path.dirname(path)
+    noisy_positions = read_table(os.path.join(directory, shard['noisy_positions']['path']))
+    for column, column_type in shard['noisy_positions']['columns'].items():
+        if 'categories' in column_type:
+            noisy_positions[column] = pd.Categorical(noisy_positions[column].astype(object),
+                                                     categories=column_type['categories'])
+        else:
+            noisy_positions[column] = noisy_positions[column].astype(column_type['dtype'])
+    fragment_sizes = read_table(os.path.join(directory, shard['fragment_sizes']['path']))
+
+    statistics = dict(shard['counts'])
+    statistics['substitution'] = pd.DataFrame(**shard['substitution'])
+    statistics['n_counts'] = shard['n_counts']
+    statistics['noisy_positions'] = noisy_positions
+    statistics['fragment_sizes'] = FragmentSizeRecords.from_table(fragment_sizes)
+    return statistics
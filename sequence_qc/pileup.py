@@ -0,0 +1,533 @@
+import itertools
+import os
+import numpy as np
+import pandas as pd
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from numpy.lib import recfunctions
+from pysam import AlignmentFile, FastaFile
+from pysamstats import config, opt, util
+
+from sequence_qc.intervals import FETCH_WINDOW_GAP, fetch_windows
+from sequence_qc.pipeline import INLINE_WRITER, PIPELINE_SHARD_BASES, InlineWriter
+from sequence_qc.reference import ReferenceCache
+
+
+# Number of shards handed to the pool per worker, so that slow (deep) shards can be balanced by the pool
+SHARDS_PER_THREAD = 4
+
+# Bases preloaded on either side of each interval when reads are not truncated to the intervals, as columns
+# outside the intervals also need their reference base (fetches past the padding are read from the fasta file)
+REFERENCE_PADDING = 500
+
+# Reference fasta handles opened by `open_reference` in the open `reference_scope` of this process, by path. The
+# process id is kept so that forked worker processes start with no scope and never use the handles of their parent
+_references = {'pid': None, 'depth': 0, 'handles': {}}
+
+
+# `pileup_region` and `count_region` are built on internals of pysamstats (`opt.Variation`, `opt.TlenStrand`,
+# `opt.stat_pileup`, `opt.normalise_coords` and `util.load_stats`) rather than on `pysamstats.load_pileup`, so that
+# one fetch serves several intervals. These are not part of its public API, so the version is deliberately pinned
+# in requirements.txt, and `test_pysamstats_version` fails when another version is installed. Check that
+# `test_pileup_region` still passes before moving the pin.
+PYSAMSTATS_VERSION = '1.1.2'
+
+# Base count fields of the pysamstats 'variation' records that the noise calculation uses
+PILEUP_COUNT_COLUMNS = ['A', 'C', 'G', 'T', 'insertions', 'deletions', 'N']
+# Count fields of the pysamstats 'variation' records that are kept in memory after chrom, pos and ref, in record
+# order. These are all written to the noisy positions table, as they were before the pileup was compacted. The pysam
+# engine only counts `PILEUP_COUNT_COLUMNS`.
+VARIATION_COUNT_COLUMNS = ['reads_all', 'reads_pp', 'matches', 'matches_pp', 'mismatches', 'mismatches_pp',
+                           'deletions', 'deletions_pp', 'insertions', 'insertions_pp', 'A', 'A_pp', 'C', 'C_pp', 'T',
+                           'T_pp', 'G', 'G_pp', 'N', 'N_pp']
+
+# Pileup engines: the pysamstats 'variation' and 'tlen_strand' statistics, or only the base counts, from pysam
+PYSAMSTATS = 'pysamstats'
+PYSAM = 'pysam'
+ENGINES = [PYSAMSTATS, PYSAM]
+
+# Order of the counts of each pileup read category in `count_region`, the last being bases that are not counted
+_COUNT_CATEGORIES = ['A', 'C', 'G', 'T', 'N', 'deletions']
+# Category of each pileup read, from the first character of `PileupColumn.get_query_sequences`, which is the base
+# (lower case on the reverse strand), '*' for a deletion, or '>' and '<' for a reference skip
+_READ_CATEGORY = np.full(256, len(_COUNT_CATEGORIES), dtype=np.int64)
+for _i, _base in enumerate(b'ACGTN'):
+    _READ_CATEGORY[_base] = _READ_CATEGORY[ord(chr(_base).lower())] = _i
+_READ_CATEGORY[ord('*')] = _COUNT_CATEGORIES.index('deletions')
+_NOT_BASES = np.frombuffer(b'*><', dtype=np.uint8)
+
+
+class PileupAccumulator:
+    """
+    Collects the pileup of each region in a compact form, and builds the combined data frames at the end
+
+    Concatenating data frames inside the region loop copies everything accumulated so far on each iteration,
+    which is quadratic in the number of regions. Here the columns of each region are only kept in lists until
+    `to_frames`.
+
+    The chrom, pos and ref fields and the `VARIATION_COUNT_COLUMNS` of the records are kept, in record order. Counts
+    are stored as uint16 when they fit (uint32 otherwise), positions as uint32, chrom as integer codes and ref as
+    single bytes, which `to_frames` turns into categoricals.
+    """
+
+    def __init__(self):
+        self.pileups = []
+        self.tlens = []
+        self.chrom_codes = {}
+
+    def add(self, pileup: np.ndarray, tlen: np.ndarray) -> None:
+        """
+        Add the 'variation' and 'tlen_strand' record arrays of a single region
+
+        :param pileup: np.ndarray - 'variation' record array
+        :param tlen: np.ndarray - 'tlen_strand' record array
+        """
+        self.pileups.append(self._compact(pileup))
+        self.tlens.append(tlen)
+
+    def _compact(self, pileup: np.ndarray) -> dict:
+        """
+        Compact columns of a 'variation' record array, with chrom codes shared by all regions
+
+        :param pileup: np.ndarray - 'variation' record array
+        :return: dict - column name to np.ndarray
+        """
+        names, inverse = np.unique(pileup['chrom'], return_inverse=True)
+        codes = np.array([self.chrom_codes.setdefault(name, len(self.chrom_codes)) for name in names], dtype=np.int32)
+        columns = {
+            'chrom': codes[inverse],
+            'pos': pileup['pos'].astype(np.uint32),
+            'ref': pileup['ref'].view(np.uint8).copy(),
+        }
+        for field in _count_fields(pileup.dtype.names):
+            counts = pileup[field]
+            fits_uint16 = len(counts) == 0 or counts.max() <= np.iinfo(np.uint16).max
+            columns[field] = counts.astype(np.uint16 if fits_uint16 else np.uint32)
+        return columns
+
+    def _pileup_frame(self) -> pd.DataFrame:
+        """
+        Concatenate the compact columns of all regions, in the order they were added
+
+        :return: pd.DataFrame - with categorical chrom and ref columns
+        """
+        columns = {}
+        count_fields = _count_fields(PILEUP_COUNT_COLUMNS)
+        fields = list(self.pileups[0]) if self.pileups else ['chrom', 'pos', 'ref'] + count_fields
+        for field in fields:
+            arrays = [pileup[field] for pileup in self.pileups]
+            columns[field] = np.concatenate(arrays) if arrays else np.array([], dtype=np.uint16)
+
+        chrom_names = [name.decode('utf-8') for name in self.chrom_codes]
+        columns['chrom'] = pd.Categorical.from_codes(columns['chrom'].astype(np.int32), chrom_names)
+        ref_bytes, ref_codes = np.unique(columns['ref'], return_inverse=True)
+        columns['ref'] = pd.Categorical.from_codes(ref_codes, [chr(b) for b in ref_bytes])
+        return pd.DataFrame(columns)
+
+    def to_frames(self) -> tuple:
+        """
+        Concatenate all regions, in the order they were added
+
+        :return: tuple - (pileup, tlen) pd.DataFrames
+        """
+        return self._pileup_frame(), _decoded_frame(_concatenate(self.tlens), ['chrom'])
+
+
+def _count_fields(names) -> list:
+    """
+    The `VARIATION_COUNT_COLUMNS` among the field `names` of a record array, in record order
+    """
+    return [field for field in VARIATION_COUNT_COLUMNS if field in names]
+
+
+class StreamingPileupWriter(PileupAccumulator):
+    """
+    Writes the pileup and tlen rows of each region to their TSV files as soon as the region is added
+
+    Only the compact pileup columns are kept in memory for the noise calculation, and the tlen rows are not kept.
+    The files are identical to writing the complete data frames at the end. With a `BackgroundWriter`, the rows
+    are formatted and written on the writer thread, while the next regions are piled up and compacted.
+    """
+
+    def __init__(self, pileup_path: str, tlen_path: str, columns: list, writer: InlineWriter = INLINE_WRITER):
+        super().__init__()
+        self.columns = columns
+        self.writer = writer
+        self.pileup_fh = open(pileup_path, 'w')
+        self.tlen_fh = open(tlen_path, 'w')
+        self.header = True
+
+    def add(self, pileup: np.ndarray, tlen: np.ndarray) -> None:
+        """
+        Write the rows of a single region, and keep its compact pileup columns
+
+        :param pileup: np.ndarray - 'variation' record array
+        :param tlen: np.ndarray - 'tlen_strand' record array
+        """
+        self.writer.submit(self._write_region, pileup, tlen, self.header)
+        self.header = False
+        self.pileups.append(self._compact(pileup))
+
+    def _write_region(self, pileup: np.ndarray, tlen: np.ndarray, header: bool) -> None:
+        written = recfunctions.repack_fields(pileup[self.columns])
+        _decoded_frame(written, ['chrom', 'ref']).to_csv(self.pileup_fh, sep='\t', index=False, header=header)
+        _decoded_frame(tlen, ['chrom']).to_csv(self.tlen_fh, sep='\t', index=False, header=header)
+
+    def to_frames(self) -> tuple:
+        """
+        Close the output files once all regions are written, and return the kept pileup columns of all regions
+
+        :return: tuple - (pileup, tlen) pd.DataFrames, with an empty tlen frame
+        """
+        self.writer.submit(self.pileup_fh.close)
+        self.writer.submit(self.tlen_fh.close)
+        return self._pileup_frame(), pd.DataFrame()
+
+
+def _decoded_frame(records, fields: list) -> pd.DataFrame:
+    """
+    Data frame of a record array, with the byte string `fields` as categoricals of decoded strings
+
+    Each distinct value is only decoded once, instead of once per row.
+
+    :param records: np.ndarray or pd.DataFrame - records with byte string `fields`
+    :param fields: list - names of the byte string fields
+    :return: pd.DataFrame
+    """
+    df = pd.DataFrame(records)
+    for field in fields:
+        if field in df:
+            values, codes = np.unique(df[field].to_numpy(), return_inverse=True)
+            df[field] = pd.Categorical.from_codes(codes, [value.decode('utf-8') for value in values])
+    return df
+
+
+def _concatenate(record_arrays: list) -> pd.DataFrame:
+    if not record_arrays:
+        return pd.DataFrame()
+    return pd.DataFrame(np.concatenate(record_arrays))
+
+
+def pileup_region(bam: AlignmentFile, fasta: FastaFile, chrom: str, start: int, stop: int, truncate: bool = True,
+                  min_mapping_quality: int = 1, min_base_quality: int = 1, max_depth: int = 30000,
+                  include: list = None) -> tuple:
+    """
+    Compute the pysamstats 'variation' and 'tlen_strand' statistics over a single region
+
+    Both statistics are collected from the same pileup columns, so the reads of the region are decoded and piled up
+    once, instead of once for each `pysamstats.load_pileup` call. Records are identical to those from
+    `pysamstats.load_pileup` with the same arguments and stepper='nofilter'.
+
+    With `include`, only the columns inside those sub-intervals are kept, so that several nearby intervals are piled
+    up with a single fetch. With `truncate`, the records are the same as from piling up each sub-interval on its own.
+
+    :param bam: pysam.AlignmentFile - open BAM file
+    :param fasta: pysam.FastaFile - open reference fasta
+    :param chrom: str - contig name, as it appears in the BAM header
+    :param start: int - 0-based region start
+    :param stop: int - 0-based, exclusive region end
+    :param truncate: bool - whether to exclude reads that only partially overlap the region
+    :param min_mapping_quality: int - exclude reads with mapping qualities less than this threshold
+    :param min_base_quality: int - exclude bases with less than this base quality
+    :param max_depth: int - Maximum read depth for calculation
+    :param include: list - sorted, non-overlapping (start, stop) sub-intervals of the region to keep columns from
+    :return: tuple - (variation, tlen) numpy record arrays
+    """
+    variation_stat = opt.Variation()
+    tlen_stat = opt.TlenStrand()
+    variation_recs = []
+    tlen_recs = []
+    filters = dict(alignmentfile=bam, one_based=False, min_mapq=min_mapping_quality, min_baseq=min_base_quality,
+                   no_del=False, no_dup=False)
+
+    start, stop = opt.normalise_coords(bam, chrom, start, stop, False)
+    columns = bam.pileup(reference=chrom, start=start, end=stop, truncate=truncate, stepper='nofilter',
+                         max_depth=max_depth)
+    included = 0
+    for column in columns:
+        if include is not None:
+            pos = column.reference_pos
+            while included < len(include) - 1 and pos >= include[included][1]:
+                included += 1
+            if not include[included][0] <= pos < include[included][1]:
+                continue
+        variation_recs.append(opt.stat_pileup(variation_stat, column, fafile=fasta, **filters))
+        # The reference base is not used for template lengths
+        tlen_recs.append(opt.stat_pileup(tlen_stat, column, fafile=None, **filters))
+
+    pileup = _load_records(variation_recs, config.dtype_variation, bam)
+    tlen = _load_records(tlen_recs, config.dtype_tlen_strand, bam)
+    return pileup, tlen
+
+
+def _load_records(recs: list, default_dtype: list, bam: AlignmentFile) -> np.ndarray:
+    """
+    Convert pysamstats records to a record array, with the same dtype as `pysamstats.load_pileup`
+
+    :param recs: list - pysamstats record dicts
+    :param default_dtype: list - pysamstats dtype for this statistics type
+    :param bam: pysam.AlignmentFile - used to size the 'chrom' field
+    :return: np.ndarray
+    """
+    return util.load_stats(lambda **kwargs: iter(recs), default_dtype=default_dtype, user_dtype=None, user_fields=None,
+                           alignmentfile=bam)
+
+
+def count_region(bam: AlignmentFile, fasta: FastaFile, chrom: str, start: int, stop: int, truncate: bool = True,
+                 min_mapping_quality: int = 1, min_base_quality: int = 1, max_depth: int = 30000,
+                 include: list = None) -> tuple:
+    """
+    Count the bases, insertions and deletions of a single region, from pysam alone
+
+    Same arguments and base counts as `pileup_region`, from the same `AlignmentFile.pileup` columns, but the reads
+    of each column are read in bulk with the `PileupColumn` accessors and counted with numpy, instead of building
+    every pysamstats 'variation' field for each column. As in pysamstats, reads with a lower mapping quality are
+    skipped, and so are bases with a lower base quality, but not deletions.
+
+    :return: tuple - (counts, tlen) numpy record arrays, with the chrom, pos and ref fields and
+        `PILEUP_COUNT_COLUMNS` of the 'variation' statistics, and an empty 'tlen_strand' array
+    """
+    positions = []
+    depths = []
+    sequences = []
+    base_qualities = bytearray()
+    mapping_qualities = bytearray()
+
+    start, stop = opt.normalise_coords(bam, chrom, start, stop, False)
+    columns = bam.pileup(reference=chrom, start=start, end=stop, truncate=truncate, stepper='nofilter',
+                         max_depth=max_depth)
+    included = 0
+    for column in columns:
+        pos = column.reference_pos
+        if include is not None:
+            while included < len(include) - 1 and pos >= include[included][1]:
+                included += 1
+            if not include[included][0] <= pos < include[included][1]:
+                continue
+        # Base qualities are filtered below, as they do not apply to deletions
+        column.set_min_base_quality(0)
+        column_sequences = column.get_query_sequences(add_indels=True)
+        positions.append(pos)
+        depths.append(len(column_sequences))
+        sequences.extend(column_sequences)
+        if min_base_quality > 0:
+            base_qualities.extend(column.get_query_qualities())
+        if min_mapping_quality > 0:
+            mapping_qualities.extend(column.get_mapping_qualities())
+
+    # Each read is the base or deletion character, followed by '+' if an insertion follows the base
+    joined = np.frombuffer((' '.join(sequences) + '  ').encode('ascii'), dtype=np.uint8)
+    read_starts = np.concatenate([[0], np.flatnonzero(joined == ord(' '))[:-2] + 1])[:len(sequences)]
+    first = joined[read_starts]
+    category = _READ_CATEGORY[first]
+    is_base = ~np.isin(first, _NOT_BASES)
+    keep = np.ones(len(sequences), dtype=bool)
+    if min_mapping_quality > 0:
+        keep &= np.frombuffer(mapping_qualities, dtype=np.uint8) >= min_mapping_quality
+    if min_base_quality > 0:
+        keep &= ~is_base | (np.frombuffer(base_qualities, dtype=np.uint8) >= min_base_quality)
+
+    n_columns = len(positions)
+    column_index = np.repeat(np.arange(n_columns), depths)
+    n_categories = len(_COUNT_CATEGORIES) + 1
+    counts = np.bincount(column_index[keep] * n_categories + category[keep],
+                         minlength=n_columns * n_categories).reshape(n_columns, n_categories)
+    inserted = keep & is_base & (joined[read_starts + 1] == ord('+'))
+
+    records = np.zeros(n_columns, dtype=[('chrom', 'S{}'.format(max(len(chrom), 1))), ('pos', np.int32),
+                                         ('ref', 'S1')] + [(field, np.int32) for field in PILEUP_COUNT_COLUMNS])
+    records['chrom'] = chrom
+    records['pos'] = positions
+    records['ref'] = _reference_bases(fasta, chrom, records['pos'])
+    for i, field in enumerate(_COUNT_CATEGORIES):
+        records[field] = counts[:, i]
+    records['insertions'] = np.bincount(column_index[inserted], minlength=n_columns)
+    return records, _load_records([], config.dtype_tlen_strand, bam)
+
+
+def _reference_bases(fasta: FastaFile, chrom: str, positions: np.ndarray) -> np.ndarray:
+    """
+    Upper case reference base at each of the sorted `positions`, with one fetch for their whole span
+
+    :return: np.ndarray - 'S1' bases, empty past the end of the contig
+    """
+    if len(positions) == 0:
+        return np.array([], dtype='S1')
+    first = int(positions[0])
+    sequence = fasta.fetch(reference=chrom, start=first, end=int(positions[-1]) + 1).upper().encode('ascii')
+    bases = np.frombuffer(sequence, dtype='S1')
+    offsets = positions - first
+    return np.where(offsets < len(bases), bases[np.minimum(offsets, max(len(bases) - 1, 0))], b'')
+
+
+def shard_intervals(intervals: list, n_shards: int) -> list:
+    """
+    Split `intervals` into at most `n_shards` contiguous shards holding roughly the same number of bases
+
+    Shards are contiguous runs of the input so that concatenating the shards gives back the original order,
+    and each worker reads a compact stretch of the BAM.
+
+    :param intervals: list - (chrom, start, stop) tuples, in BED order
+    :param n_shards: int - maximum number of shards to create
+    :return: list - list of lists of (chrom, start, stop) tuples
+    """
+    total_bases = sum(stop - start for _, start, stop in intervals)
+    n_shards = max(1, min(n_shards, len(intervals)))
+    target = total_bases / n_shards
+
+    shards = []
+    current = []
+    bases = 0
+    for interval in intervals:
+        current.append(interval)
+        bases += interval[2] - interval[1]
+        # Close the shard once the running base count reaches its share of the total
+        if bases >= target * (len(shards) + 1) and len(shards) < n_shards - 1:
+            shards.append(current)
+            current = []
+    if current:
+        shards.append(current)
+    return shards
+
+
+def _process_references() -> dict:
+    """
+    Reference handles and scope depth of the current process, see `_references`
+    """
+    if _references['pid'] != os.getpid():
+        _references.update(pid=os.getpid(), depth=0, handles={})
+    return _references
+
+
+@contextmanager
+def reference_scope():
+    """
+    Share the reference handles of `open_reference`, and their preloaded regions, until the end of the block
+
+    Scopes can be nested, e.g. a pileup inside a `calculate_noise` run. The handles are closed when the outermost
+    scope of the process ends, so that the regions of a run do not stay in memory after it, and a fasta replaced at
+    the same path is opened again by the next run.
+    """
+    references = _process_references()
+    references['depth'] += 1
+    try:
+        yield
+    finally:
+        references['depth'] -= 1
+        if references['depth'] == 0:
+            for fasta in references['handles'].values():
+                fasta.close()
+            references['handles'] = {}
+
+
+def worker_reference_scope() -> None:
+    """
+    Initializer of worker processes, which keeps their reference handles open for the lifetime of the pool
+
+    The handles are closed when the worker process exits, at the end of the call that created the pool.
+    """
+    _process_references()['depth'] += 1
+
+
+def open_reference(ref_fasta: str) -> ReferenceCache:
+    """
+    Open the reference fasta once per `reference_scope`, and reuse the handle and its preloaded regions for every
+    pileup of the scope
+
+    :param ref_fasta: str - path to reference fasta
+    :return: ReferenceCache
+    """
+    references = _process_references()
+    if not references['depth']:
+        raise RuntimeError('open_reference must be called inside a reference_scope')
+    if ref_fasta not in references['handles']:
+        references['handles'][ref_fasta] = ReferenceCache(ref_fasta)
+    return references['handles'][ref_fasta]
+
+
+def _iter_pileup_regions(ref_fasta: str, bam_path: str, intervals: list, pileup_kwargs: dict,
+                         window_gap: int = FETCH_WINDOW_GAP, engine: str = PYSAMSTATS):
+    """
+    Pileup each interval in turn, using file handles private to the calling process
+
+    When reads are truncated to the intervals, nearby intervals are grouped into fetch windows, and the (variation,
+    tlen) record arrays are yielded per window instead of per interval.
+
+    :param ref_fasta: str - path to reference fasta
+    :param bam_path: str - path to bam
+    :param intervals: list - (chrom, start, stop) tuples
+    :param pileup_kwargs: dict - filtering arguments passed through to `pileup_region`
+    :param window_gap: int - largest distance between intervals piled up with a single fetch, -1 to never group
+    :param engine: str - `PYSAMSTATS` to pileup each window with `pileup_region`, or `PYSAM` for `count_region`
+    """
+    region_pileup = count_region if engine == PYSAM else pileup_region
+    truncate = pileup_kwargs.get('truncate', True)
+    # Without truncation, columns outside the intervals are kept, so each interval needs its own fetch
+    windows = fetch_windows(intervals, window_gap if truncate else -1)
+    with reference_scope(), AlignmentFile(bam_path) as bam:
+        fasta = open_reference(ref_fasta)
+        fasta.preload(intervals, padding=0 if truncate else REFERENCE_PADDING)
+        for chrom, start, stop, include in windows:
+            yield region_pileup(bam, fasta, chrom, start, stop, include=include if len(include) > 1 else None,
+                                **pileup_kwargs)
+
+
+def _pileup_shard(ref_fasta: str, bam_path: str, intervals: list, pileup_kwargs: dict, window_gap: int,
+                  engine: str) -> list:
+    """
+    Pileup every interval of a shard in a worker process
+
+    :return: list - (variation, tlen) record arrays for each fetch window, in input order
+    """
+    return list(_iter_pileup_regions(ref_fasta, bam_path, intervals, pileup_kwargs, window_gap, engine))
+
+
+def pileup_intervals(ref_fasta: str, bam_path: str, intervals: list, threads: int = 1,
+                     window_gap: int = FETCH_WINDOW_GAP, engine: str = PYSAMSTATS, max_pending_shards: int = None,
+                     **pileup_kwargs):
+    """
+    Pileup all `intervals`, optionally spreading the work over a pool of `threads` processes
+
+    Yields the (variation, tlen) record arrays of each fetch window, always in the order of `intervals`,
+    so the output does not depend on `threads`.
+
+    With `max_pending_shards`, the pileup is pipelined: it always runs in worker processes, even with a single
+    thread, so that the caller can reduce and write the regions already yielded while the next ones are piled up.
+    Intervals are split into shards of about `PIPELINE_SHARD_BASES` bases, and at most `max_pending_shards` shards
+    are piled up ahead of the caller, which bounds the memory held by results that were not consumed yet.
+
+    :param ref_fasta: str - path to reference fasta
+    :param bam_path: str - path to bam
+    :param intervals: list - (chrom, start, stop) tuples, in BED order
+    :param threads: int - number of worker processes, 1 to run in the current process
+    :param window_gap: int - largest distance between intervals piled up with a single fetch, -1 to never group
+    :param engine: str - `PYSAMSTATS` for the pysamstats statistics, or `PYSAM` for base counts only
+    :param max_pending_shards: int - pipeline the pileup, with at most this many shards piled up ahead of the caller
+    :param pileup_kwargs: dict - filtering arguments passed through to `pileup_region`
+    """
+    pipelined = max_pending_shards is not None
+    if not pipelined and (threads <= 1 or len(intervals) <= 1):
+        yield from _iter_pileup_regions(ref_fasta, bam_path, intervals, pileup_kwargs, window_gap, engine)
+        return
+
+    threads = max(threads, 1)
+    n_shards = threads * SHARDS_PER_THREAD
+    if pipelined:
+        total_bases = sum(stop - start for _, start, stop in intervals)
+        n_shards = max(n_shards, total_bases // PIPELINE_SHARD_BASES)
+        # Keep every worker busy, even when fewer pending shards were asked for
+        max_pending_shards = max(max_pending_shards, threads)
+    else:
+        max_pending_shards = n_shards
+    shards = iter(shard_intervals(intervals, n_shards))
+    with ProcessPoolExecutor(max_workers=threads, initializer=worker_reference_scope) as executor:
+        def submit(shard):
+            return executor.submit(_pileup_shard, ref_fasta, bam_path, shard, pileup_kwargs, window_gap, engine)
+
+        futures = deque(submit(shard) for shard in itertools.islice(shards, max_pending_shards))
+        # Collect in submission order, which is BED order, releasing each shard once it has been consumed
+        while futures:
+            regions = futures.popleft().result()
+            futures.extend(submit(shard) for shard in itertools.islice(shards, 1))
+            yield from regions
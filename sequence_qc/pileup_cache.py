@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import pandas as pd
+
+from sequence_qc.pileup import PYSAMSTATS
+from sequence_qc.tables import PARQUET, read_table, write_frame
+
+
+PILEUP_CACHE_NAME = '_pileup_cache.parquet'
+# Bump when the cached pileup layout changes, so that older artifacts are invalidated
+CACHE_VERSION = 4
+
+
+def _file_signature(path: str, checksum: bool = False) -> dict:
+    """
+    Identify the contents of a file, from its size and modification time or from a checksum of its contents
+
+    :param path: str - path to file
+    :param checksum: bool - use a sha256 of the contents instead of the modification time
+    :return: dict
+    """
+    stat = os.stat(path)
+    if not checksum:
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return {'size': stat.st_size, 'sha256': sha.hexdigest()}
+
+
+def pileup_cache_key(ref_fasta: str, bam_path: str, bed_file_path: str, truncate: bool = True,
+                     min_mapping_quality: int = 1, min_base_quality: int = 1, max_depth: int = 30000,
+                     bed_padding: int = 0, checksum: bool = False, engine: str = PYSAMSTATS) -> dict:
+    """
+    Key of all inputs that determine the pileup, so that a cached pileup can be matched to a new run
+
+    The BED file is small, and always keyed by its contents.
+
+    :param ref_fasta: str - path to reference fasta
+    :param bam_path: str - path to bam
+    :param bed_file_path: str - path to bed file
+    :param truncate: bool - whether reads that only partially overlap the bed file were excluded
+    :param min_mapping_quality: int - mapping quality threshold used for the pileup
+    :param min_base_quality: int - base quality threshold used for the pileup
+    :param max_depth: int - maximum read depth used for the pileup
+    :param bed_padding: int - padding added to the bed file regions
+    :param checksum: bool - key the bam and reference by checksums of their contents rather than modification times
+    :param engine: str - engine used for the pileup, as the pysam engine leaves the tlen table empty
+    :return: dict
+    """
+    return {
+        'version': CACHE_VERSION,
+        'bam': _file_signature(bam_path, checksum),
+        'bed': _file_signature(bed_file_path, checksum=True),
+        'ref_fasta': _file_signature(ref_fasta, checksum),
+        'truncate': bool(truncate),
+        'min_mapping_quality': int(min_mapping_quality),
+        'min_base_quality': int(min_base_quality),
+        'max_depth': int(max_depth),
+        'bed_padding': int(bed_padding),
+        'engine': engine,
+    }
+
+
+def pileup_cache_key_path(path: str) -> str:
+    """
+    Path of the JSON file holding the key of the cached pileup at `path`
+    """
+    return os.path.splitext(path)[0] + '.json'
+
+
+def save_pileup_cache(path: str, key: dict, pileup: pd.DataFrame) -> None:
+    """
+    Save the decoded pileup as a parquet table, and the key of the inputs it was computed from next to it
+
+    The key is written last, so that a pileup is only used once it was completely written.
+
+    :param path: str - path of the cached pileup, ending in .parquet
+    :param key: dict - from `pileup_cache_key`
+    :param pileup: pd.DataFrame - pileup, before any noise columns are added
+    """
+    write_frame(pileup, path, PARQUET)
+    with open(pileup_cache_key_path(path), 'w') as f:
+        json.dump(key, f)
+
+
+def load_pileup_cache(path: str, key: dict):
+    """
+    Load a cached pileup if it was computed from the same inputs as `key`
+
+    Artifacts that are unreadable, or whose key does not match, are deleted.
+
+    :param path: str - path of the cached pileup
+    :param key: dict - from `pileup_cache_key` for the current inputs
+    :return: tuple - (pileup pd.DataFrame or None, list of mismatched key fields, or None if there was no artifact)
+    """
+    if not os.path.exists(path) and not os.path.exists(pileup_cache_key_path(path)):
+        return None, None
+
+    try:
+        with open(pileup_cache_key_path(path)) as f:
+            cached_key = json.load(f)
+        mismatched = sorted(field for field in set(key) | set(cached_key) if key.get(field) != cached_key.get(field))
+        pileup = None if mismatched else read_table(path)
+    except Exception:
+        remove_pileup_cache(path)
+        return None, ['artifact']
+
+    if mismatched:
+        remove_pileup_cache(path)
+        return None, mismatched
+    return pileup, []
+
+
+def remove_pileup_cache(path: str) -> None:
+    for artifact in [path, pileup_cache_key_path(path)]:
+        if os.path.exists(artifact):
+            os.remove(artifact)
+
+
+def replace_pileup_cache(source: str, destination: str) -> None:
+    """
+    Move the cached pileup at `source`, and its key, to `destination`
+    """
+    os.replace(source, destination)
+    os.replace(pileup_cache_key_path(source), pileup_cache_key_path(destination))
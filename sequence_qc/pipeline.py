@@ -0,0 +1,116 @@
+import queue
+import threading
+
+from sequence_qc.metrics import NO_METRICS, Metrics
+
+
+# Number of pileup shards computed ahead of the reducers, and of writes waiting for the writer thread, when pipelined
+PIPELINE_QUEUE_SIZE = 8
+# Pipelined pileups are split into shards of about this many bases, so that results reach the reducers early
+PIPELINE_SHARD_BASES = 50000
+
+
+class InlineWriter:
+    """
+    Runs each write as soon as it is submitted, in the calling thread
+
+    Output steps take a writer, so that the same code runs sequentially or with a `BackgroundWriter`.
+    """
+
+    def submit(self, func, *args, **kwargs) -> None:
+        """
+        Run `func(*args, **kwargs)`, which writes an output and whose return value is ignored
+        """
+        func(*args, **kwargs)
+
+    def flush(self) -> None:
+        """
+        Wait until every submitted write has finished
+        """
+
+    def close(self) -> None:
+        """
+        Wait until every submitted write has finished, and stop accepting writes
+        """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+INLINE_WRITER = InlineWriter()
+
+
+class BackgroundWriter(InlineWriter):
+    """
+    Runs submitted writes in order on a single background thread, so that they overlap with the computation
+
+    At most `max_pending` writes wait in the queue, after which `submit` blocks until the writer catches up, so a
+    slow disk holds back the computation instead of letting unwritten data pile up in memory. The first error
+    raised by a write is raised again by the next `submit`, `flush` or `close`, and later writes are skipped.
+
+    Submitted arguments are used after `submit` returns, so they must not be modified by the caller.
+    """
+
+    def __init__(self, max_pending: int = PIPELINE_QUEUE_SIZE, metrics: Metrics = NO_METRICS):
+        """
+        :param max_pending: int - number of writes that can wait in the queue
+        :param metrics: Metrics - records the time spent in writes as 'background_writes', and the time the
+            computation waited for the writer as 'write_wait'
+        """
+        self.metrics = metrics
+        self.error = None
+        self.queue = queue.Queue(maxsize=max(max_pending, 1))
+        self.thread = threading.Thread(target=self._run, name='sequence_qc-writer', daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                if self.error is None:
+                    func, args, kwargs = job
+                    with self.metrics.stage('background_writes'):
+                        func(*args, **kwargs)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self) -> None:
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, func, *args, **kwargs) -> None:
+        self._raise_error()
+        if not self.thread.is_alive():
+            raise RuntimeError('The background writer has been closed')
+        with self.metrics.stage('write_wait'):
+            self.queue.put((func, args, kwargs))
+
+    def flush(self) -> None:
+        with self.metrics.stage('write_wait'):
+            self.queue.join()
+        self._raise_error()
+
+    def close(self) -> None:
+        if self.thread.is_alive():
+            with self.metrics.stage('write_wait'):
+                self.queue.put(None)
+                self.thread.join()
+        self._raise_error()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Stop the thread, without hiding the original error behind a write error
+            self.error = self.error or exc_value
+            if self.thread.is_alive():
+                self.queue.put(None)
+                self.thread.join()
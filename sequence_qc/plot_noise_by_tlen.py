@@ -1,8 +1,5 @@
-import numpy as np
 import pandas as pd
 
-import plotly.figure_factory as ff
-
 
 SUBSTITUTION_TYPES_COMBINED = [
     [["G>T", "C>A"], "C>A"],
@@ -39,56 +36,27 @@ def plot_data(frag_size_select_df):
     Select data for creating plot
 
     :param: frag_size_select_df - pd.DataFrame
-    :param:
+    :return: plotly Figure, or None if no group has enough fragments
     """
     frag_size_select_df["Size"] = pd.to_numeric(
         frag_size_select_df["Size"], downcast="integer"
     )
     frag = frag_size_select_df[(frag_size_select_df["Size"] > 0)]
-    # write_summary(frag, outfile)
     fig = plot_data_type(frag)
     return fig
 
 
 def plot_data_type(frag):
     """
-    Create the plot
+    Create the plot, from the binned fragment sizes of `report.summarize_fragment_sizes`
 
-    :param: frag pd.DataFrame -
-    :param:
+    :param: frag pd.DataFrame - with columns Var and Size
+    :return: plotly Figure, or None if no group has enough fragments
     """
-    data = []
-    labels = []
-    for st_pair, st in SUBSTITUTION_TYPES_COMBINED:
-        st_sizes = frag[frag['Var'].isin(st_pair)]['Size']
-        if len(st_sizes) > 1:
-            data.append(st_sizes)
-            labels.append(st)
-    geno_series = frag[frag['Var'] == 'GENOTYPE']['Size']
-    if len(geno_series) > 1:
-        data.append(geno_series)
-        labels.append('Genotype')
-    n_series = frag[frag['Var'] == 'N']['Size']
-    if len(n_series) > 1:
-        data.append(n_series)
-        labels.append('N')
+    # Imported here, as `report` imports this module and the plotting stack is only loaded for plots
+    from sequence_qc import plots, report
 
-    try:
-        fig = ff.create_distplot(
-            data,
-            labels,
-            # colors=COLORS,
-            # bin_size=.2,
-            show_rug=False,
-        )
-        fig.update_layout(
-            title='Insert size distribution for noisy positions',
-            xaxis_title="Insert Size",
-        )
-    except (np.linalg.LinAlgError, AttributeError) as e:
-        # Not enough data for plot
-        return None
-    return fig
+    return plots.fragment_sizes_figure(report.summarize_fragment_sizes(frag))
 
 
 def create_noisy_tlen_plot(noisy_tlen_df):
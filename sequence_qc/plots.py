@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 import plotly
 import plotly.express as px
@@ -5,13 +6,14 @@ import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 
-from sequence_qc.plot_noise_by_tlen import create_noisy_tlen_plot
+from sequence_qc import report
+from sequence_qc.metrics import NO_METRICS, Metrics
 
 # from sequence_qc.noise import NOISE_FRACTION
 
 
 def all_plots(pileup_df: pd.DataFrame, noisy_positions: pd.DataFrame, st_df: pd.DataFrame, noisy_tlen_df: pd.DataFrame,
-              sample_id: str = '') -> None:
+              sample_id: str = '', metrics: Metrics = NO_METRICS) -> None:
     """
     Create all plots in a single HTML report
 
@@ -20,20 +22,38 @@ def all_plots(pileup_df: pd.DataFrame, noisy_positions: pd.DataFrame, st_df: pd.
     :param st_df: pd.DataFrame - Substitution types data frame
     :param noisy_tlen_df: pd.DataFrame -
     :param sample_id:
+    :param metrics: Metrics - records the time taken by each plot, including its HTML
     :return:
     """
-    with open(sample_id + '_noise.html', 'w') as f:
-        f.write('<h1 style=\'font-family: sans-serif\'>Noise Report for sample {}</h1>'.format(sample_id))
+    data = report.report_data(pileup_df, noisy_positions, st_df, noisy_tlen_df, sample_id)
+    render_report([data], sample_id + report.NOISE_REPORT, metrics)
 
-        fig = plot_noise_by_substitution(st_df)
-        f.write(fig.to_html(full_html=False, include_plotlyjs='cdn'))
-        fig = plot_noisy_positions(noisy_positions)
-        f.write(fig.to_html(full_html=False, include_plotlyjs='cdn'))
-        fig = create_noisy_tlen_plot(noisy_tlen_df)
-        if fig:
-            f.write(fig.to_html(full_html=False, include_plotlyjs='cdn'))
-        fig = plot_n_counts(pileup_df)
-        f.write(fig.to_html(full_html=False, include_plotlyjs='cdn'))
+
+def render_report(reports: list, path: str, metrics: Metrics = NO_METRICS) -> None:
+    """
+    Write the HTML report of each sample to a single file
+
+    :param reports: list - report aggregates of each sample, from `report.report_data`
+    :param path: str - output HTML file
+    :param metrics: Metrics - records the time taken by each plot, including its HTML
+    """
+    with open(path, 'w') as f:
+        for data in reports:
+            f.write('<h1 style=\'font-family: sans-serif\'>Noise Report for sample {}</h1>'.format(data['sample_id']))
+
+            with metrics.stage('plots.noise_by_substitution'):
+                fig = noise_by_substitution_figure(data['noise_by_substitution'])
+                f.write(fig.to_html(full_html=False, include_plotlyjs='cdn'))
+            with metrics.stage('plots.noisy_positions'):
+                fig = noisy_positions_figure(data['noisy_positions'])
+                f.write(fig.to_html(full_html=False, include_plotlyjs='cdn'))
+            with metrics.stage('plots.noisy_tlen'):
+                fig = fragment_sizes_figure(data['fragment_sizes'])
+                if fig:
+                    f.write(fig.to_html(full_html=False, include_plotlyjs='cdn'))
+            with metrics.stage('plots.n_counts'):
+                fig = n_counts_figure(data['n_counts'])
+                f.write(fig.to_html(full_html=False, include_plotlyjs='cdn'))
 
 
 def plot_noise_by_substitution(st_df: pd.DataFrame) -> plotly.graph_objects.Figure:
@@ -43,11 +63,21 @@ def plot_noise_by_substitution(st_df: pd.DataFrame) -> plotly.graph_objects.Figu
     :param st_df: pd.DataFrame - Data frame with rows for each substitution type, and column 'NOISE_FRACTION'
     :return:
     """
+    return noise_by_substitution_figure(report.summarize_noise_by_substitution(st_df))
+
+
+def noise_by_substitution_figure(summary: dict) -> plotly.graph_objects.Figure:
+    """
+    Barplot for noise fraction of each substitution type
+
+    :param summary: dict - from `report.summarize_noise_by_substitution`
+    :return:
+    """
     title = 'Noise By Substitution'
     fig = px.bar(
-        x=st_df.index,
+        x=summary['substitution'],
         # Making units easier to display by raising to 10^6
-        y=st_df['noise_fraction'] * (10**6),
+        y=pd.Series(summary['noise_fraction'], dtype=float) * (10**6),
         title=title,
         labels={'x': 'Substitution', 'y': 'Alt Count / (Alt Count + Ref Count) x 10^6'}
     )
@@ -62,13 +92,21 @@ def plot_noise_by_substitution(st_df: pd.DataFrame) -> plotly.graph_objects.Figu
 
 def plot_noisy_positions(noisy_pileup_df: pd.DataFrame) -> plotly.graph_objects.Figure:
     """
-    Barplot and violin plot of positions with most noise, as defined by calculate_noise module
+    Barplot of positions with most noise, as defined by calculate_noise module, and box plot of all noisy positions
 
     :param noisy_pileup_df:
     :return:
     """
-    noisy_pileup_df = noisy_pileup_df.sort_values('noise_acgt', ascending=False)
-    noisy_pileup_df['chrom_pos'] = noisy_pileup_df['chrom'] + ':' + noisy_pileup_df['pos'].astype(str)
+    return noisy_positions_figure(report.summarize_noisy_positions(noisy_pileup_df))
+
+
+def noisy_positions_figure(summary: dict) -> plotly.graph_objects.Figure:
+    """
+    Barplot of positions with most noise, and box plot of the quantiles of all noisy positions
+
+    :param summary: dict - from `report.summarize_noisy_positions`
+    :return:
+    """
     bar_title = 'Top 100 Noisy Positions'
     box_title = 'All positions'
 
@@ -82,27 +120,59 @@ def plot_noisy_positions(noisy_pileup_df: pd.DataFrame) -> plotly.graph_objects.
     fig.update_yaxes(title_text="Alt Count / Total Count", range=[0, 0.2], row=1, col=1)
     fig.update_xaxes(title_text="Genomic Position", row=1, col=1, showticklabels=False)
 
-    noise_subset = noisy_pileup_df[:100]
-
     fig.add_trace(
         go.Bar(
-            x=noise_subset['chrom_pos'],
-            y=noise_subset['noise_acgt'],
-            text=noise_subset['minor_allele_count']
+            x=summary['chrom_pos'],
+            y=summary['noise_acgt'],
+            text=summary['minor_allele_count']
         ),
         row=1, col=1
     )
 
-    fig.add_trace(
-        go.Violin(
-            y=noisy_pileup_df['noise_acgt'],
-        ),
-        row=1, col=4
-    )
+    quantiles = summary['all_noise_acgt']
+    if quantiles['count']:
+        fig.add_trace(
+            go.Box(
+                x=['noise_acgt'],
+                **{stat: [quantiles[stat]] for stat in list(report.QUANTILES) + ['mean']}
+            ),
+            row=1, col=4
+        )
     fig.update_xaxes(title_text="", row=1, col=4, showticklabels=False)
     return fig
 
 
+def fragment_sizes_figure(summary: dict) -> plotly.graph_objects.Figure:
+    """
+    Histograms of fragment sizes of each substitution type, genotype and N reads at noisy positions
+
+    Each histogram is normalized to a probability density, so that groups of different sizes can be compared.
+
+    :param summary: dict - from `report.summarize_fragment_sizes`
+    :return: None if there are no fragments to plot
+    """
+    if not summary['counts']:
+        return None
+    bin_edges = np.array(summary['bin_edges'])
+    bin_widths = np.diff(bin_edges)
+    fig = go.Figure()
+    for label, counts in summary['counts'].items():
+        counts = np.array(counts)
+        fig.add_trace(go.Bar(
+            x=bin_edges[:-1] + bin_widths / 2,
+            y=counts / (counts.sum() * bin_widths),
+            width=bin_widths,
+            name=label,
+            opacity=0.7,
+        ))
+    fig.update_layout(
+        barmode='overlay',
+        title='Insert size distribution for noisy positions',
+        xaxis_title="Insert Size",
+    )
+    return fig
+
+
 def plot_noise_by_tlen(avg_tlen_noise: pd.DataFrame) -> px.bar:
     """
     Barplot of average template length at noisy sites
@@ -128,11 +198,20 @@ def plot_n_counts(pileup_df: pd.DataFrame) -> px.bar:
     :param pileup_df:
     :return:
     """
-    n_counts = pileup_df['N'].value_counts()
+    return n_counts_figure(report.summarize_n_counts(pileup_df))
+
+
+def n_counts_figure(summary: dict) -> px.bar:
+    """
+    Barplot of number of sites with each discrete N count
+
+    :param summary: dict - from `report.summarize_n_counts`, with counts up to `report.N_COUNT_MAX`
+    :return:
+    """
     title = 'Positions with each N count'
     fig = px.bar(
-        x=n_counts.index,
-        y=n_counts,
+        x=np.arange(len(summary['counts'])),
+        y=summary['counts'],
         title=title,
         labels={'x': 'N count', 'y': 'Number of positions'}
     )
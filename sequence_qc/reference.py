@@ -0,0 +1,84 @@
+from bisect import bisect_right
+from pysam import FastaFile
+
+
+class ReferenceCache(FastaFile):
+    """
+    Reference fasta that serves the bases of preloaded regions from memory
+
+    pysamstats fetches the reference base of every pileup column separately. After `preload`, fetches that fall
+    inside a preloaded region are sliced from an in-memory copy of the region, and all other fetches are read from
+    the fasta file as usual, so results are the same as from `pysam.FastaFile`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        # contig name -> sorted region starts, and the (start, end, bases) of each region
+        self._starts = {}
+        self._regions = {}
+        # Pileup columns are fetched in order, so the region of the previous fetch is checked first
+        self._last = (None, 0, 0, b'')
+
+    def preload(self, intervals: list, padding: int = 0) -> None:
+        """
+        Read the bases of `intervals` into memory, merging overlapping and abutting intervals
+
+        This can be called again for more samples. Intervals already covered by a preloaded region are skipped, and
+        those that overlap or abut one are merged with it, so that every fetch inside the union is served from memory.
+
+        :param intervals: list - (chrom, start, stop) tuples
+        :param padding: int - number of bases to also load on either side of each interval
+        """
+        lengths = dict(zip(self.references, self.lengths))
+        by_chrom = {}
+        for chrom, start, stop in intervals:
+            if chrom not in lengths or start - padding >= lengths[chrom]:
+                continue
+            by_chrom.setdefault(chrom, []).append((max(start - padding, 0), min(stop + padding, lengths[chrom])))
+
+        for chrom, chrom_intervals in by_chrom.items():
+            loaded = {(start, stop): bases for start, stop, bases in self._regions.get(chrom, [])}
+            merged = []
+            for start, stop in sorted(chrom_intervals + list(loaded)):
+                if merged and start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], stop)
+                else:
+                    merged.append([start, stop])
+
+            regions = []
+            for start, stop in merged:
+                # Regions that were not extended keep their bases, and the others are read again as a whole
+                bases = loaded.get((start, stop))
+                if bases is None:
+                    bases = super().fetch(reference=chrom, start=start, end=stop).encode('ascii')
+                regions.append((start, stop, bases))
+            self._regions[chrom] = regions
+            self._starts[chrom] = [region[0] for region in regions]
+
+    def _cached_region(self, chrom: str, start: int, end: int):
+        """
+        Preloaded region containing all of [`start`, `end`) of `chrom`, or None
+        """
+        starts = self._starts.get(chrom)
+        if not starts:
+            return None
+        i = bisect_right(starts, start) - 1
+        if i < 0:
+            return None
+        region = self._regions[chrom][i]
+        return region if end <= region[1] else None
+
+    def fetch(self, reference=None, start=None, end=None, region=None):
+        """
+        Same as `pysam.FastaFile.fetch`, served from memory for regions inside a preloaded interval
+        """
+        if region is None and start is not None and end is not None and 0 <= start <= end:
+            last_chrom, offset, stop, bases = self._last
+            if reference != last_chrom or start < offset or end > stop:
+                cached = self._cached_region(reference, start, end)
+                if cached is None:
+                    return super().fetch(reference=reference, start=start, end=end)
+                offset, stop, bases = cached
+                self._last = (reference, offset, stop, bases)
+            return bases[start - offset:end - offset].decode('ascii')
+        return super().fetch(reference=reference, start=start, end=end, region=region)
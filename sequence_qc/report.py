@@ -0,0 +1,132 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from sequence_qc.plot_noise_by_tlen import SUBSTITUTION_TYPES_COMBINED
+
+
+REPORT_DATA = '_report_data.json'
+NOISE_REPORT = '_noise.html'
+TOP_NOISY_POSITIONS = 100
+# Fragment sizes are collected between 0 and 500, larger sizes are counted in the last bin
+FRAGMENT_SIZE_MAX = 500
+FRAGMENT_SIZE_BIN_WIDTH = 5
+# N counts are plotted up to this count, larger counts are only summed
+N_COUNT_MAX = 50
+QUANTILES = {'lowerfence': 0, 'q1': 0.25, 'median': 0.5, 'q3': 0.75, 'upperfence': 1}
+
+
+def report_data(pileup_df: pd.DataFrame, noisy_positions: pd.DataFrame, st_df: pd.DataFrame,
+                noisy_tlen_df: pd.DataFrame, sample_id: str = '', n_counts: dict = None) -> dict:
+    """
+    Compact aggregates of a sample, from which the HTML report can be rendered without the pileup
+
+    The aggregates only need numpy and pandas, so they can be written at compute time, and rendered later
+    with `render_report`, possibly for many samples at once. Distributions are kept as quantiles and fixed-size
+    histograms, so the size of the aggregates does not grow with the number of positions or read pairs.
+
+    :param pileup_df: pd.DataFrame - All positions from bed file as data frame
+    :param noisy_positions: pd.DataFrame - Noisy positions data frame
+    :param st_df: pd.DataFrame - Substitution types data frame
+    :param noisy_tlen_df: pd.DataFrame - Fragment sizes of noisy positions, or None if there were none
+    :param sample_id: str - sample ID, used as the title of the report
+    :param n_counts: dict - `summarize_n_counts` of the pileup, which is then not needed
+    :return: dict
+    """
+    return {
+        'sample_id': sample_id,
+        'noise_by_substitution': summarize_noise_by_substitution(st_df),
+        'noisy_positions': summarize_noisy_positions(noisy_positions),
+        'fragment_sizes': summarize_fragment_sizes(noisy_tlen_df),
+        'n_counts': summarize_n_counts(pileup_df) if n_counts is None else n_counts,
+    }
+
+
+def summarize_noise_by_substitution(st_df: pd.DataFrame) -> dict:
+    return {
+        'substitution': st_df.index.tolist(),
+        'noise_fraction': st_df['noise_fraction'].tolist(),
+    }
+
+
+def summarize_noisy_positions(noisy_positions: pd.DataFrame) -> dict:
+    """
+    Top noisy positions, and quantiles of the noise over all noisy positions
+
+    :param noisy_positions: pd.DataFrame - with columns chrom, pos, noise_acgt and minor_allele_count
+    :return: dict
+    """
+    top = noisy_positions.nlargest(TOP_NOISY_POSITIONS, 'noise_acgt', keep='first')
+    return {
+        'chrom_pos': (top['chrom'].astype(str) + ':' + top['pos'].astype(str)).tolist(),
+        'noise_acgt': top['noise_acgt'].tolist(),
+        'minor_allele_count': top['minor_allele_count'].tolist(),
+        'all_noise_acgt': quantile_summary(noisy_positions['noise_acgt'].to_numpy(dtype=float)),
+    }
+
+
+def summarize_fragment_sizes(noisy_tlen_df: pd.DataFrame) -> dict:
+    """
+    Histograms of the fragment sizes of each substitution type, genotype and N reads at noisy positions
+
+    Groups with fewer than two fragments are left out, as they can not be plotted.
+
+    :param noisy_tlen_df: pd.DataFrame - with columns Var and Size, or None
+    :return: dict - 'bin_edges' shared by all histograms, and the 'counts' of each bin keyed by group label
+    """
+    bin_edges = np.arange(0, FRAGMENT_SIZE_MAX + FRAGMENT_SIZE_BIN_WIDTH, FRAGMENT_SIZE_BIN_WIDTH)
+    summary = {'bin_edges': bin_edges.tolist(), 'counts': {}}
+    if noisy_tlen_df is None:
+        return summary
+    sizes = pd.to_numeric(noisy_tlen_df['Size'], downcast='integer')
+    var = noisy_tlen_df['Var'][sizes > 0]
+    sizes = sizes[sizes > 0].to_numpy()
+
+    groups = [(st_pair, st) for st_pair, st in SUBSTITUTION_TYPES_COMBINED] + [(['GENOTYPE'], 'Genotype'), (['N'], 'N')]
+    for values, label in groups:
+        group_sizes = sizes[var.isin(values).to_numpy()]
+        if len(group_sizes) > 1:
+            counts, _ = np.histogram(np.minimum(group_sizes, FRAGMENT_SIZE_MAX), bins=bin_edges)
+            summary['counts'][label] = counts.tolist()
+    return summary
+
+
+def summarize_n_counts(pileup_df: pd.DataFrame) -> dict:
+    """
+    Number of positions with each N count up to `N_COUNT_MAX`, and the number of positions with more
+    """
+    n = pileup_df['N'].to_numpy(dtype=np.int64)
+    counts = np.bincount(np.minimum(n, N_COUNT_MAX + 1), minlength=N_COUNT_MAX + 2)
+    return {'counts': counts[:N_COUNT_MAX + 1].tolist(), 'above_max': int(counts[N_COUNT_MAX + 1])}
+
+
+def quantile_summary(values: np.ndarray) -> dict:
+    """
+    Quantiles, mean and count of `values`, as used for a box plot
+
+    :return: dict - with keys of `QUANTILES`, 'mean' and 'count', or only 'count' if `values` is empty
+    """
+    if len(values) == 0:
+        return {'count': 0}
+    summary = dict(zip(QUANTILES, np.quantile(values, list(QUANTILES.values())).tolist()))
+    summary.update(mean=float(values.mean()), count=len(values))
+    return summary
+
+
+def write_report_data(data: dict, sample_id: str = '') -> str:
+    """
+    Write the report aggregates of a sample to `<sample_id>_report_data.json`
+
+    :return: str - path of the written file
+    """
+    path = sample_id + REPORT_DATA
+    with open(path, 'w') as f:
+        json.dump(data, f)
+        f.write('\n')
+    return path
+
+
+def read_report_data(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
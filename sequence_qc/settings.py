@@ -0,0 +1,116 @@
+from dataclasses import dataclass
+
+from sequence_qc.pileup import ENGINES, PYSAMSTATS
+from sequence_qc.pileup_cache import pileup_cache_key
+from sequence_qc.pipeline import PIPELINE_QUEUE_SIZE
+from sequence_qc.tables import TSV, check_output_format
+
+
+@dataclass(frozen=True)
+class NoiseSettings:
+    """
+    Pileup filters and run options of a noise calculation, shared by all samples of a batch
+
+    Settings are checked when they are created, so that a run does not fail after its pileup. Use
+    `dataclasses.replace` to change some of them.
+
+    :param truncate: bool - whether to exclude reads that only partially overlap the bedfile
+    :param min_mapping_quality: int - exclude reads with mapping qualities less than this threshold
+    :param min_base_quality: int - exclude bases with less than this base quality
+    :param max_depth: int - Maximum read depth for calculation
+    :param engine: str - 'pysamstats' for the pysamstats pileup statistics, or 'pysam' to only count bases, insertions
+        and deletions from pysam, which is faster but leaves the tlen table empty
+    :param bed_padding: int - Number of bases added on either side of each region of the bed file
+    :param threads: int - Number of processes to use for the pileup
+    :param output_format: str - 'tsv', 'parquet' or 'feather', format of the pileup, tlen and noisy positions tables
+    :param stream_output: bool - Write pileup and tlen rows as each region is processed, instead of building the
+        complete tlen data frame in memory
+    :param pipelined: bool - Overlap the pileup, the noise calculation and the writing of output files
+    :param queue_size: int - In pipelined mode, number of pileup shards computed ahead of the noise calculation,
+        and of outputs waiting to be written, after which the faster step waits for the slower one
+    :param make_plots: bool - Write the HTML report, which is the only step that needs the plotting libraries
+    :param cache_pileup: bool - Save the pileup to `sample_id` + PILEUP_CACHE_NAME, for use by `recompute_noise`
+    :param cache_checksum: bool - Key the cached pileup by checksums of the bam and reference, instead of their
+        modification times
+    :param cohort_store: str - Directory of a cohort store to add the base counts of each sample to, see `CohortStore`
+    :param subsample_fraction: float - Fraction of read names to keep, 1 to use every read
+    :param target_precision: float - Choose the fraction of read names to keep, so that the half width of the
+        confidence interval of the acgt noise is about this fraction of the noise, e.g. 0.1 for +/- 10%
+    :param subsample_seed: int - Seed of the read name hash, a different seed keeps a different set of reads
+    """
+    truncate: bool = True
+    min_mapping_quality: int = 1
+    min_base_quality: int = 1
+    max_depth: int = 30000
+    engine: str = PYSAMSTATS
+    bed_padding: int = 0
+    threads: int = 1
+    output_format: str = TSV
+    stream_output: bool = False
+    pipelined: bool = False
+    queue_size: int = PIPELINE_QUEUE_SIZE
+    make_plots: bool = True
+    cache_pileup: bool = False
+    cache_checksum: bool = False
+    cohort_store: str = None
+    subsample_fraction: float = 1.0
+    target_precision: float = None
+    subsample_seed: int = 0
+
+    def __post_init__(self):
+        check_output_format(self.output_format)
+        if self.engine not in ENGINES:
+            raise ValueError('Unknown engine {}, expected one of {}'.format(self.engine, ', '.join(ENGINES)))
+        if self.stream_output and self.output_format != TSV:
+            raise ValueError('stream_output is only supported with the tsv output format')
+        self._check_subsampling()
+
+    def _check_subsampling(self):
+        if not 0 < self.subsample_fraction <= 1:
+            raise ValueError('subsample_fraction must be in (0, 1], got {}'.format(self.subsample_fraction))
+        if self.target_precision is not None and self.target_precision <= 0:
+            raise ValueError('target_precision must be positive, got {}'.format(self.target_precision))
+        if self.target_precision is not None and self.subsample_fraction < 1:
+            raise ValueError('subsample_fraction and target_precision are exclusive, as target_precision chooses the '
+                             'fraction')
+        if self.subsampling and (self.cache_pileup or self.cohort_store):
+            raise ValueError('cache_pileup and cohort_store are not supported with subsampling, as they keep the '
+                             'pileup for later runs that would not know the reads were subsampled')
+        if self.subsampling and not self.truncate:
+            raise ValueError('Subsampling needs truncate, as only the reads near the intervals are kept, and the '
+                             'pileup would otherwise include positions outside of them')
+
+    @property
+    def subsampling(self) -> bool:
+        return self.target_precision is not None or self.subsample_fraction < 1
+
+    @property
+    def streams_output(self) -> bool:
+        """
+        Whether the pileup and tlen tables are written region by region as they are piled up, which pipelined runs
+        do for tsv tables, leaving only the compact columns in memory
+        """
+        return self.stream_output or (self.pipelined and self.output_format == TSV)
+
+    def pileup_filters(self) -> dict:
+        """
+        Filtering arguments of `pileup_intervals`, which also key the pileup cache and the cohort store
+
+        :return: dict
+        """
+        return {
+            'truncate': self.truncate,
+            'min_mapping_quality': self.min_mapping_quality,
+            'min_base_quality': self.min_base_quality,
+            'max_depth': self.max_depth,
+        }
+
+    def pileup_cache_key(self, ref_fasta: str, bam_path: str, bed_file_path: str) -> dict:
+        """
+        Key of the cached pileup of a sample run with these settings, see `pileup_cache_key`
+        """
+        return pileup_cache_key(ref_fasta, bam_path, bed_file_path, bed_padding=self.bed_padding,
+                                checksum=self.cache_checksum, engine=self.engine, **self.pileup_filters())
+
+
+DEFAULT_SETTINGS = NoiseSettings()
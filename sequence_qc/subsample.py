@@ -0,0 +1,131 @@
+import math
+import os
+
+import pysam
+
+from sequence_qc.intervals import merge_intervals
+from sequence_qc.noise_by_tlen import WINDOW_PADDING
+
+
+# Every this many intervals are piled up with all reads, to estimate the noise and depth of a sample before choosing
+# the subsampling fraction. The pilot keeps the full depth, as the noise threshold excludes more noisy positions at
+# low depth, which would bias the estimate down
+PILOT_INTERVAL_STEP = 20
+# Subsampled reads keep at least this mean depth, so that the noise threshold is not reached by chance at noisy sites
+MIN_SUBSAMPLED_DEPTH = 1000
+# Normal quantile of the two-sided 95% confidence intervals of the noise
+NOISE_CI_Z = 1.959964
+# Fractions are rounded up to this many decimals, well above the resolution of the samtools hash
+FRACTION_DECIMALS = 4
+
+
+def subsample_bam(bam_path: str, output_path: str, fraction: float, intervals: list, seed: int = 0) -> str:
+    """
+    Write the reads of `bam_path` near `intervals` whose hashed query name falls below `fraction`, and index them
+
+    Reads are selected by `samtools view -s`, which hashes the query name, so both reads of a pair are kept
+    or dropped together, the same reads are kept on every run, and the reads kept at a fraction are also kept at
+    any larger fraction with the same `seed`. Intervals are padded by the fetch window of `noise_by_tlen`, so that
+    the fragment sizes of noisy positions see every kept mate that they would see in the full bam. Noisy positions
+    must be inside the intervals, as they are when the pileup is truncated to them.
+
+    :param bam_path: str - path to indexed bam
+    :param output_path: str - path of the subsampled bam
+    :param fraction: float - fraction of read names to keep, between 0 and 1
+    :param intervals: list - (chrom, start, stop) tuples, from `bed_intervals`
+    :param seed: int - seed of the name hash, a different seed keeps a different set of reads
+    :return: str - `output_path`
+    """
+    if not 0 < fraction <= 1:
+        raise ValueError('Subsampling fraction must be in (0, 1], got {}'.format(fraction))
+    if seed < 0:
+        raise ValueError('Subsampling seed must not be negative, got {}'.format(seed))
+    # The fetch window of a position starts WINDOW_PADDING + 1 bases before it, see `_position_window`
+    regions, _ = merge_intervals(intervals, padding=WINDOW_PADDING + 1)
+    # The fraction is only given as the decimals of -s, so a fraction of 1 keeps every read without -s
+    subsample = ['-s', subsample_argument(fraction, seed)] if fraction < 1 else []
+    pysam.view(*subsample, '-M', '-b', '-o', output_path, bam_path,
+               *['{}:{}-{}'.format(chrom, start + 1, stop) for chrom, start, stop in regions], catch_stdout=False)
+    pysam.index(output_path)
+    return output_path
+
+
+def subsample_argument(fraction: float, seed: int = 0) -> str:
+    """
+    Seed and fraction as the `samtools view -s INT.FRAC` argument, which unlike --subsample is supported by the
+    samtools of every pysam version
+
+    :param fraction: float - fraction of read names to keep, between 0 and 1 exclusive
+    :param seed: int - non-negative seed of the name hash
+    :return: str - e.g. '3.25' for seed 3 and fraction 0.25
+    """
+    return '{:d}{}'.format(seed, '{:.12f}'.format(fraction).rstrip('0')[1:])
+
+
+def subsampled_bam_path(directory: str, fraction: float, seed: int = 0) -> str:
+    return os.path.join(directory, 'subsample_{}_{}.bam'.format(seed, fraction))
+
+
+def wilson_interval(successes: int, trials: int, z: float = NOISE_CI_Z) -> tuple:
+    """
+    Wilson score interval of a binomial proportion
+
+    Unlike the normal approximation, the interval stays within [0, 1] and is not empty when there are no successes,
+    which matters for noise fractions of 1e-4 and below.
+
+    :param successes: int - e.g. the minor allele count
+    :param trials: int - e.g. the minor and major allele counts
+    :param z: float - normal quantile of the confidence level
+    :return: tuple - (lower, upper) bounds, (0, 1) without trials
+    """
+    if trials <= 0:
+        return 0.0, 1.0
+    p = successes / trials
+    denominator = 1 + z ** 2 / trials
+    center = (p + z ** 2 / (2 * trials)) / denominator
+    half_width = z * math.sqrt(p * (1 - p) / trials + z ** 2 / (4 * trials ** 2)) / denominator
+    # The bounds are exact without successes or failures, which rounding would move by a few ulps
+    lower = 0.0 if successes <= 0 else max(center - half_width, 0.0)
+    upper = 1.0 if successes >= trials else min(center + half_width, 1.0)
+    return lower, upper
+
+
+def pilot_intervals(intervals: list) -> tuple:
+    """
+    Every `PILOT_INTERVAL_STEP`th interval, spread over all contigs, and the fraction of bases they cover
+
+    :param intervals: list - (chrom, start, stop) tuples, from `bed_intervals`
+    :return: tuple - (list of (chrom, start, stop) tuples, fraction of the bases of `intervals`)
+    """
+    pilot = intervals[::PILOT_INTERVAL_STEP]
+    total_bases = sum(stop - start for _, start, stop in intervals)
+    pilot_bases = sum(stop - start for _, start, stop in pilot)
+    return pilot, pilot_bases / total_bases if total_bases else 1.0
+
+
+def fraction_for_precision(alt_count: int, total_count: int, positions: int, counted_fraction: float,
+                           target_precision: float, z: float = NOISE_CI_Z) -> float:
+    """
+    Smallest fraction of reads whose noise estimate has a confidence interval within `target_precision` of the noise
+
+    The noise and the number of bases of the full sample are estimated from pilot counts over `counted_fraction` of
+    the positions, and the number of bases needed for the binomial interval to reach a half width of
+    `target_precision` times the noise is z^2 (1 - p) / (p target_precision^2). The interval only accounts for the
+    sampling of bases, not for differences in noise between positions. The fraction keeps a mean depth of at least
+    `MIN_SUBSAMPLED_DEPTH`.
+
+    :param alt_count: int - minor allele count of the pilot positions below the noise threshold
+    :param total_count: int - minor and major allele counts of the same positions
+    :param positions: int - number of pilot positions below the noise threshold
+    :param counted_fraction: float - fraction of the positions of the sample covered by the pilot
+    :param target_precision: float - half width of the confidence interval, relative to the noise
+    :param z: float - normal quantile of the confidence level
+    :return: float - fraction of reads between 0 and 1, or 1 if there was no noise to estimate the precision from
+    """
+    if alt_count <= 0 or total_count <= 0:
+        return 1.0
+    p = alt_count / total_count
+    needed_bases = z ** 2 * (1 - p) / (p * target_precision ** 2)
+    needed = max(needed_bases / (total_count / counted_fraction), MIN_SUBSAMPLED_DEPTH * positions / total_count)
+    scale = 10 ** FRACTION_DECIMALS
+    return min(math.ceil(needed * scale) / scale, 1.0)
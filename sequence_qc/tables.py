@@ -0,0 +1,118 @@
+import os
+import pandas as pd
+
+
+TSV = 'tsv'
+PARQUET = 'parquet'
+FEATHER = 'feather'
+OUTPUT_FORMATS = [TSV, PARQUET, FEATHER]
+
+# Low-cardinality string columns, stored as categoricals in the columnar formats
+CATEGORICAL_COLUMNS = ['chrom', 'ref']
+
+
+def check_output_format(output_format: str) -> None:
+    """
+    Fail early for unknown formats, or for columnar formats when pyarrow is not installed
+
+    :param output_format: str - one of `OUTPUT_FORMATS`
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError('Unknown output format {}, expected one of {}'.format(output_format, OUTPUT_FORMATS))
+    if output_format != TSV:
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError('The {} output format requires pyarrow, which can be installed with '
+                              '`pip install sequence_qc[columnar]`'.format(output_format))
+
+
+def table_path(prefix: str, tsv_name: str, output_format: str) -> str:
+    """
+    Output path of a table, given the name of its TSV version
+
+    :param prefix: str - sample ID used as the file name prefix
+    :param tsv_name: str - file name suffix ending in .tsv, e.g. '_pileup.tsv'
+    :param output_format: str - one of `OUTPUT_FORMATS`
+    :return: str
+    """
+    return prefix + os.path.splitext(tsv_name)[0] + '.' + output_format
+
+
+def compact_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Copy of `df` with categorical string columns and the narrowest integer type for each integer column
+
+    :param df: pd.DataFrame
+    :return: pd.DataFrame
+    """
+    df = df.copy()
+    for column in df.columns:
+        if column in CATEGORICAL_COLUMNS:
+            df[column] = df[column].astype('category')
+        elif pd.api.types.is_integer_dtype(df[column]):
+            downcast = 'unsigned' if len(df) == 0 or df[column].min() >= 0 else 'integer'
+            df[column] = pd.to_numeric(df[column], downcast=downcast)
+    return df
+
+
+def write_table(df: pd.DataFrame, prefix: str, tsv_name: str, output_format: str = TSV) -> str:
+    """
+    Write one of the per-position tables in `output_format`
+
+    TSV output is unchanged from writing `df` directly. The columnar formats store a compacted copy of `df`.
+
+    :param df: pd.DataFrame
+    :param prefix: str - sample ID used as the file name prefix
+    :param tsv_name: str - file name suffix ending in .tsv, e.g. '_pileup.tsv'
+    :param output_format: str - one of `OUTPUT_FORMATS`
+    :return: str - path of the written file
+    """
+    return write_frame(df, table_path(prefix, tsv_name, output_format), output_format)
+
+
+def write_frame(df: pd.DataFrame, path: str, output_format: str = TSV) -> str:
+    """
+    Write a table to `path` in `output_format`, see `write_table`
+
+    :param df: pd.DataFrame
+    :param path: str - path of the table, which `read_table` reads in the format of its extension
+    :param output_format: str - one of `OUTPUT_FORMATS`
+    :return: str - `path`
+    """
+    if output_format == TSV:
+        df.to_csv(path, sep='\t', index=False)
+    elif output_format == PARQUET:
+        compact_frame(df).to_parquet(path, index=False)
+    elif output_format == FEATHER:
+        compact_frame(df.reset_index(drop=True)).to_feather(path)
+    else:
+        raise ValueError('Unknown output format {}, expected one of {}'.format(output_format, OUTPUT_FORMATS))
+    return path
+
+
+def read_table(path: str) -> pd.DataFrame:
+    """
+    Load a table written by `write_table`, using the file extension to pick the format
+
+    :param path: str - path to a .tsv, .parquet or .feather file
+    :return: pd.DataFrame
+    """
+    extension = os.path.splitext(path)[1].lstrip('.')
+    if extension == PARQUET:
+        return pd.read_parquet(path)
+    if extension == FEATHER:
+        return pd.read_feather(path)
+    return pd.read_csv(path, sep='\t', float_precision='round_trip')
+
+
+def load_table(prefix: str, tsv_name: str, output_format: str = TSV) -> pd.DataFrame:
+    """
+    Load a per-position table of a sample, e.g. to plot it
+
+    :param prefix: str - sample ID used as the file name prefix
+    :param tsv_name: str - file name suffix of the TSV version, e.g. '_noise_positions.tsv'
+    :param output_format: str - one of `OUTPUT_FORMATS`
+    :return: pd.DataFrame
+    """
+    return read_table(table_path(prefix, tsv_name, output_format))
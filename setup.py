@@ -59,9 +59,17 @@ setup(
     entry_points={
         'console_scripts': [
             'calculate_noise=sequence_qc.cli:calculate_noise',
+            'merge_noise=sequence_qc.cli:merge_noise',
+            'recompute_noise=sequence_qc.cli:recompute_noise',
+            'calculate_noise_batch=sequence_qc.cli:calculate_noise_batch',
+            'render_report=sequence_qc.cli:render_report',
+            'cohort_noise=sequence_qc.cli:cohort_noise',
         ],
     },
     install_requires=req_file("requirements.txt"),
+    extras_require={
+        'columnar': ['pyarrow'],
+    },
     license="Apache Software License 2.0",
     long_description=readme,
     include_package_data=True,
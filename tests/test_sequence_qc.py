@@ -1,23 +1,47 @@
 #!/usr/bin/env python
 
+import json
 import os
 import pytest
+import subprocess
+import sys
+from click.testing import CliRunner
+from dataclasses import replace
+from types import SimpleNamespace
 from pytest import approx
+import numpy as np
 import pandas as pd
+import pysam
+import pysamstats
 
+from sequence_qc import noise
 from sequence_qc.noise import calculate_noise, OUTPUT_NOISE_FILENAME, OUTPUT_PILEUP_NAME
-from sequence_qc import plots
-from sequence_qc.noise_by_tlen import get_fragment_size_for_sample
+from sequence_qc import cli, plot_noise_by_tlen, plots, report
+from sequence_qc.pileup import (PILEUP_COUNT_COLUMNS, PYSAM, PYSAMSTATS_VERSION, VARIATION_COUNT_COLUMNS,
+                                 PileupAccumulator, count_region, open_reference, pileup_region, reference_scope,
+                                 shard_intervals)
+from sequence_qc.noise_by_tlen import (
+    get_fragment_size_for_sample, read_pair_generator, ReadPairStats, ReadPositionIndex, _fragment_size_record
+)
+from sequence_qc.tables import load_table
+from sequence_qc.reference import ReferenceCache
+from sequence_qc.intervals import fetch_windows, merge_intervals
+from sequence_qc.pileup_cache import PILEUP_CACHE_NAME, load_pileup_cache, pileup_cache_key
+from sequence_qc.pipeline import BackgroundWriter
+from sequence_qc.subsample import fraction_for_precision, subsample_argument, subsample_bam, wilson_interval
+from sequence_qc.cohort_store import CohortStore, append_sample, pileup_settings, position_offsets
+from sequence_qc.settings import NoiseSettings
 
 CUR_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
-def test_calculate_noise():
+def test_calculate_noise(tmp_path, monkeypatch):
     """
     Test noise calculation from pysamstats
 
     :return:
     """
+    monkeypatch.chdir(tmp_path)
     noise = calculate_noise(
         os.path.join(CUR_DIR, 'test_data/ref_nochr.fa'),
         os.path.join(CUR_DIR, 'test_data/SeraCare_0-5_tmp.bam'),
@@ -39,14 +63,837 @@ def test_calculate_noise():
             'test__noise_acgt.tsv',
             'test__noise_del.tsv',
             'test__noise_n.tsv',
+            'test__noise_by_substitution.tsv',
+            'test__noise_by_tlen.tsv',
+            'test__report_data.json',
+            'test__noise.html',
     ]:
         assert os.path.exists(filename)
-        os.unlink(filename)
+    # The noisy positions keep the columns of the fixture, which have every pysamstats 'variation' field
+    expected_columns = pd.read_csv(os.path.join(CUR_DIR, 'test_data/test_noise_positions.tsv'), sep='\t', nrows=0)
+    assert list(pd.read_csv('test_' + OUTPUT_NOISE_FILENAME, sep='\t', nrows=0).columns) == list(expected_columns)
 
 
-def test_noise_by_tlen():
+def test_calculate_noise_threads(tmp_path, monkeypatch):
     """
+    Test that the process pool produces the same outputs as the serial pileup
+
+    :return:
+    """
+    monkeypatch.chdir(tmp_path)
+    bed_path = str(tmp_path / 'multi.bed')
+    with open(bed_path, 'w') as f:
+        f.write('1\t0\t30\n1\t30\t60\n1\t60\t92\n')
+
+    noise = {}
+    for threads in [1, 2]:
+        noise[threads] = calculate_noise(
+            os.path.join(CUR_DIR, 'test_data/ref_nochr.fa'),
+            os.path.join(CUR_DIR, 'test_data/SeraCare_0-5_tmp.bam'),
+            bed_path,
+            0.2,
+            sample_id='threads_{}_'.format(threads),
+            settings=NoiseSettings(threads=threads)
+        )
+    assert noise[1] == noise[2]
+    for filename in [OUTPUT_PILEUP_NAME, OUTPUT_NOISE_FILENAME, '_tlen.tsv']:
+        with open('threads_1_' + filename) as serial, open('threads_2_' + filename) as parallel:
+            assert serial.read() == parallel.read()
+
+
+def test_calculate_noise_engine(tmp_path, monkeypatch):
+    """
+    Test that the pysam engine gives the same pileup and noise as pysamstats, with an empty tlen table
+
+    :return:
+    """
+    monkeypatch.chdir(tmp_path)
+    noise = {}
+    for engine in ['pysamstats', 'pysam']:
+        noise[engine] = calculate_noise(
+            os.path.join(CUR_DIR, 'test_data/ref_nochr.fa'),
+            os.path.join(CUR_DIR, 'test_data/SeraCare_0-5_tmp.bam'),
+            os.path.join(CUR_DIR, 'test_data/test.bed'),
+            0.2,
+            sample_id=engine + '_',
+            settings=NoiseSettings(engine=engine, make_plots=False),
+        )
+    assert noise['pysamstats'] == noise['pysam']
+    for filename in [OUTPUT_PILEUP_NAME, '_noise_acgt.tsv', '_noise_by_tlen.tsv']:
+        with open('pysamstats_' + filename) as expected, open('pysam_' + filename) as f:
+            assert f.read() == expected.read().replace('pysamstats_', 'pysam_')
+    # The pysam engine only writes the base counts of the noisy positions
+    positions = {engine: pd.read_csv(engine + '_' + OUTPUT_NOISE_FILENAME, sep='\t') for engine in noise}
+    pd.testing.assert_frame_equal(positions['pysam'], positions['pysamstats'][positions['pysam'].columns])
+    assert 'reads_all' not in positions['pysam'] and 'reads_all' in positions['pysamstats']
+    assert len(pd.read_csv('pysam__tlen.tsv', sep='\t')) == 0
+
+    with pytest.raises(ValueError):
+        NoiseSettings(engine='samtools')
+
+
+def test_calculate_noise_stream_output(tmp_path, monkeypatch):
+    """
+    Test that streaming the pileup writes the same files and gives the same noise
+
+    :return:
+    """
+    monkeypatch.chdir(tmp_path)
+    bed_path = str(tmp_path / 'multi.bed')
+    with open(bed_path, 'w') as f:
+        f.write('1\t0\t30\n1\t30\t60\n1\t60\t92\n')
+
+    noise = {}
+    for stream_output in [False, True]:
+        noise[stream_output] = calculate_noise(
+            os.path.join(CUR_DIR, 'test_data/ref_nochr.fa'),
+            os.path.join(CUR_DIR, 'test_data/SeraCare_0-5_tmp.bam'),
+            bed_path,
+            0.2,
+            sample_id='stream_{}_'.format(stream_output),
+            settings=NoiseSettings(stream_output=stream_output)
+        )
+    assert noise[False] == noise[True]
+    for filename in [OUTPUT_PILEUP_NAME, '_tlen.tsv', '_noise_del.tsv', '_noise_by_substitution.tsv']:
+        with open('stream_False_' + filename) as in_memory, open('stream_True_' + filename) as streamed:
+            assert in_memory.read().replace('stream_False_', '') == streamed.read().replace('stream_True_', '')
+
+
+def test_calculate_noise_pipelined(tmp_path, monkeypatch):
+    """
+    Test that the pipelined mode writes the same files and gives the same noise, with the smallest queues
+
+    :return:
+    """
+    monkeypatch.chdir(tmp_path)
+    bed_path = str(tmp_path / 'multi.bed')
+    with open(bed_path, 'w') as f:
+        f.write('1\t0\t30\n1\t30\t60\n1\t60\t92\n')
+
+    noise = {}
+    for pipelined in [False, True]:
+        noise[pipelined] = calculate_noise(
+            os.path.join(CUR_DIR, 'test_data/ref_nochr.fa'),
+            os.path.join(CUR_DIR, 'test_data/SeraCare_0-5_tmp.bam'),
+            bed_path,
+            0.2,
+            sample_id='pipelined_{}_'.format(pipelined),
+            settings=NoiseSettings(make_plots=False, pipelined=pipelined, queue_size=1),
+        )
+    assert noise[False] == noise[True]
+    for filename in [OUTPUT_PILEUP_NAME, '_tlen.tsv', OUTPUT_NOISE_FILENAME, '_noise_acgt.tsv', '_noise_del.tsv',
+                     '_noise_n.tsv', '_noise_by_substitution.tsv', '_noise_by_tlen.tsv', '_report_data.json']:
+        with open('pipelined_False_' + filename) as sequential, open('pipelined_True_' + filename) as pipelined:
+            assert sequential.read().replace('pipelined_False_', '') == pipelined.read().replace('pipelined_True_', '')
+
+
+def test_calculate_noise_shards(tmp_path, monkeypatch):
+    """
+    Test that merging the shards of a run writes the same noise outputs and gives the same noise as a single run,
+    including with more shards than intervals
+
+    :return:
+    """
+    pytest.importorskip('pyarrow')
+    monkeypatch.chdir(tmp_path)
+    bed_path = str(tmp_path / 'multi.bed')
+    with open(bed_path, 'w') as f:
+        f.write('1\t0\t30\n1\t35\t60\n1\t65\t92\n')
+    kwargs = {'sample_id': 'shards_', 'settings': NoiseSettings(make_plots=False)}
+    args = [os.path.join(CUR_DIR, 'test_data/ref_nochr.fa'), os.path.join(CUR_DIR, 'test_data/SeraCare_0-5_tmp.bam'),
+            bed_path, 0.2]
+
+    single = calculate_noise(*args, sample_id='single_', settings=NoiseSettings(make_plots=False))
+    for n_shards in [2, 4]:
+        paths = []
+        for i in range(n_shards, 0, -1):
+            noise.calculate_noise_shard(*args, '{}/{}'.format(i, n_shards), **kwargs)
+            paths.append('shards__shard_{}_of_{}_noise_shard.json'.format(i, n_shards))
+        result = CliRunner().invoke(cli.merge_noise, sum([['--shard_file', path] for path in paths], []) +
+                                    ['--sample_id', 'merged_{}_'.format(n_shards), '--no_plots'])
+        assert result.exit_code == 0, result.output
+        assert float(result.output) == single
+        assert noise.merge_noise(paths, make_plots=False) == single
+        for filename in [OUTPUT_NOISE_FILENAME, '_noise_acgt.tsv', '_noise_del.tsv', '_noise_n.tsv',
+                         '_noise_by_substitution.tsv', '_noise_by_tlen.tsv', '_report_data.json']:
+            with open('single_' + filename) as single_file, open('merged_{}_'.format(n_shards) + filename) as f:
+                assert f.read().replace('merged_{}_'.format(n_shards), '') == single_file.read().replace('single_', '')
+
+        with pytest.raises(ValueError):
+            noise.merge_noise(paths[1:])
+    with pytest.raises(ValueError):
+        noise.merge_noise(['shards__shard_1_of_2_noise_shard.json', 'shards__shard_2_of_4_noise_shard.json'])
+    for shard in ['0/2', '3/2', '2']:
+        with pytest.raises(ValueError):
+            noise.calculate_noise_shard(*args, shard)
+    with pytest.raises(ValueError):
+        noise.calculate_noise_shard(*args, '1/2', settings=NoiseSettings(target_precision=0.1))
+
+
+def test_calculate_noise_subsample(tmp_path, monkeypatch):
+    """
+    Test that subsampling keeps whole read pairs, the same reads on every run, and reports the fraction used
+    with a confidence interval around the noise
+
+    :return:
+    """
+    monkeypatch.chdir(tmp_path)
+    bam_path = os.path.join(CUR_DIR, 'test_data/SeraCare_0-5_tmp.bam')
+    intervals = noise.bed_intervals(os.path.join(CUR_DIR, 'test_data/test.bed'))
+    names = {}
+    for fraction in [0.25, 0.75]:
+        with pysam.AlignmentFile(subsample_bam(bam_path, 'sub_{}.bam'.format(fraction), fraction, intervals)) as bam:
+            names[fraction] = pd.Series([read.query_name for read in bam.fetch()]).value_counts()
+    assert 0 < len(names[0.25]) < len(names[0.75])
+    assert set(names[0.25].index) <= set(names[0.75].index)
+    with pysam.AlignmentFile(bam_path) as bam:
+        full = pd.Series([read.query_name for read in bam.fetch()]).value_counts()
+    assert (names[0.75] == full[names[0.75].index]).all()
+    assert subsample_argument(0.25) == '0.25' and subsample_argument(0.0001, 12) == '12.0001'
+
+    for sample_id, fraction in [('full_', 1.0), ('run1_', 0.5), ('run2_', 0.5)]:
+        calculate_noise(
+            os.path.join(CUR_DIR, 'test_data/ref_nochr.fa'),
+            bam_path,
+            os.path.join(CUR_DIR, 'test_data/test.bed'),
+            0.2,
+            sample_id=sample_id,
+            settings=NoiseSettings(make_plots=False, subsample_fraction=fraction),
+        )
+    for filename in [OUTPUT_PILEUP_NAME, '_noise_acgt.tsv', '_noise_by_tlen.tsv']:
+        with open('run1_' + filename) as run1, open('run2_' + filename) as run2:
+            assert run1.read().replace('run1_', '') == run2.read().replace('run2_', '')
+    acgt = pd.read_csv('run1__noise_acgt.tsv', sep='\t').iloc[0]
+    assert acgt['subsample_fraction'] == 0.5
+    assert acgt['noise_fraction_ci_lower'] <= acgt['noise_fraction'] < acgt['noise_fraction_ci_upper']
+    depth = {sample_id: pd.read_csv(sample_id + OUTPUT_PILEUP_NAME, sep='\t')[['A', 'C', 'G', 'T']].sum().sum()
+             for sample_id in ['full_', 'run1_']}
+    assert 0 < depth['run1_'] < depth['full_']
+
+    with pytest.raises(ValueError):
+        NoiseSettings(subsample_fraction=0.5, cache_pileup=True)
+    with pytest.raises(ValueError):
+        NoiseSettings(subsample_fraction=1.5)
+    with pytest.raises(ValueError):
+        NoiseSettings(subsample_fraction=0.5, truncate=False)
+    with pytest.raises(ValueError):
+        NoiseSettings(subsample_fraction=0.5, target_precision=0.1)
+
+
+def test_subsample_precision():
+    lower, upper = wilson_interval(5, 100)
+    assert lower == approx(0.02154, abs=1e-5)
+    assert upper == approx(0.11175, abs=1e-5)
+    assert wilson_interval(0, 100)[0] == 0
+    assert wilson_interval(0, 0) == (0, 1)
+
+    # 1e-4 noise over 1M pilot bases, from 5% of 2000 positions at a depth of 10,000
+    needed_bases = 1.959964 ** 2 * (1 - 1e-4) / (1e-4 * 0.1 ** 2)
+    assert fraction_for_precision(100, 1000000, 100, 0.05, 0.1) == approx(needed_bases / 20000000, abs=1e-4)
+    # The mean depth is kept above the minimum, and more precision than the full sample has needs every read
+    assert fraction_for_precision(100, 1000000, 100, 0.05, 0.5) == 0.1
+    assert fraction_for_precision(100, 1000000, 100, 0.05, 0.01) == 1
+    assert fraction_for_precision(0, 1000000, 100, 0.05, 0.1) == 1
+
+
+@pytest.mark.parametrize('output_format', ['parquet', 'feather'])
+def test_calculate_noise_output_format(tmp_path, monkeypatch, output_format):
+    """
+    Test that the columnar tables hold the same values as the TSV tables, with compact types
+
+    :return:
+    """
+    pytest.importorskip('pyarrow')
+    monkeypatch.chdir(tmp_path)
+    for fmt in ['tsv', output_format]:
+        calculate_noise(
+            os.path.join(CUR_DIR, 'test_data/ref_nochr.fa'),
+            os.path.join(CUR_DIR, 'test_data/SeraCare_0-5_tmp.bam'),
+            os.path.join(CUR_DIR, 'test_data/test.bed'),
+            0.2,
+            sample_id=fmt + '_',
+            settings=NoiseSettings(output_format=fmt)
+        )
+    for filename in [OUTPUT_PILEUP_NAME, OUTPUT_NOISE_FILENAME, '_tlen.tsv']:
+        expected = load_table('tsv_', filename)
+        columnar = load_table(output_format + '_', filename, output_format)
+        assert columnar['chrom'].dtype == 'category'
+        pd.testing.assert_frame_equal(columnar.astype(expected.dtypes.to_dict()), expected)
+
+    pileup = load_table(output_format + '_', OUTPUT_PILEUP_NAME, output_format)
+    assert pileup['A'].dtype.itemsize < 4
+
+    # The report computed from the columnar tables is the one written by the run
+    with open(output_format + '__report_data.json') as f:
+        assert noise.load_report_data(output_format + '_', output_format) == json.load(f)
+    os.remove(output_format + '__noise.html')
+    result = CliRunner().invoke(cli.render_report, ['--sample_id', output_format + '_', '--output_format', output_format])
+    assert result.exit_code == 0, result.output
+    assert os.path.getsize(output_format + '__noise.html') > 0
+
+
+def test_recompute_noise(tmp_path, monkeypatch):
+    """
+    Test that recompute_noise reuses a matching cached pileup, and invalidates a stale one
+
+    :return:
+    """
+    pytest.importorskip('pyarrow')
+    monkeypatch.chdir(tmp_path)
+    inputs = [
+        os.path.join(CUR_DIR, 'test_data/ref_nochr.fa'),
+        os.path.join(CUR_DIR, 'test_data/SeraCare_0-5_tmp.bam'),
+        os.path.join(CUR_DIR, 'test_data/test.bed'),
+    ]
+    expected = calculate_noise(*inputs, 0.02, sample_id='full_')
+    calculate_noise(*inputs, 0.2, sample_id='cached_', settings=NoiseSettings(cache_pileup=True))
+    assert os.path.exists('cached_' + PILEUP_CACHE_NAME)
+
+    def no_pileup(*args, **kwargs):
+        raise AssertionError('pileup should be read from the cache')
+
+    with monkeypatch.context() as m:
+        m.setattr(noise, 'pileup_intervals', no_pileup)
+        assert noise.recompute_noise(*inputs, 0.02, sample_id='cached_') == expected
+    for filename in [OUTPUT_NOISE_FILENAME, '_noise_acgt.tsv', '_noise_by_substitution.tsv']:
+        with open('full_' + filename) as full, open('cached_' + filename) as cached:
+            assert full.read().replace('full_', '') == cached.read().replace('cached_', '')
+
+    # The pysam engine leaves the tlen table empty, so its cache is not used for the pysamstats engine
+    key = pileup_cache_key(*inputs, engine=PYSAM)
+    assert load_pileup_cache('cached_' + PILEUP_CACHE_NAME, key) == (None, ['engine'])
+    assert not os.path.exists('cached_' + PILEUP_CACHE_NAME)
+    calculate_noise(*inputs, 0.2, sample_id='cached_', settings=NoiseSettings(cache_pileup=True))
+
+    # A different mapping quality filter invalidates the cache, which is rebuilt with the new key
+    key = pileup_cache_key(*inputs, min_mapping_quality=20)
+    assert load_pileup_cache('cached_' + PILEUP_CACHE_NAME, key) == (None, ['min_mapping_quality'])
+    assert not os.path.exists('cached_' + PILEUP_CACHE_NAME)
+    noise.recompute_noise(*inputs, 0.02, sample_id='cached_', settings=NoiseSettings(min_mapping_quality=20))
+    pileup, mismatched = load_pileup_cache('cached_' + PILEUP_CACHE_NAME, key)
+    assert mismatched == [] and len(pileup) > 0
+
+    # The rebuilt cache is used, and --metrics_json records reading it instead of the pileup
+    result = CliRunner().invoke(cli.recompute_noise, [
+        '--ref_fasta', inputs[0], '--bam_file', inputs[1], '--bed_file', inputs[2], '--sample_id', 'cached_',
+        '--min_mapq', '20', '--metrics_json', 'metrics.json', '--profile', 'noise.prof', '--no_plots',
+    ])
+    assert result.exit_code == 0, result.output
+    with open('metrics.json') as f:
+        metrics = json.load(f)
+    assert 'load_pileup_cache' in metrics['stages'] and 'pileup' not in metrics['stages']
+    assert metrics['counters']['positions'] == len(pileup)
+    assert os.path.getsize('noise.prof') > 0
+
+
+def test_calculate_noise_batch(tmp_path, monkeypatch):
+    """
+    Test that batch mode matches single-sample runs, and combines the sample noise into a cohort summary
+
+    :return:
+    """
+    monkeypatch.chdir(tmp_path)
+    bam_path = os.path.join(CUR_DIR, 'test_data/SeraCare_0-5_tmp.bam')
+    pd.DataFrame({'sample_id': ['s1', 's2'], 'bam_file': [bam_path, bam_path]}).to_csv(
+        'manifest.tsv', sep='\t', index=False)
+    expected = calculate_noise(
+        os.path.join(CUR_DIR, 'test_data/ref_nochr.fa'),
+        bam_path,
+        os.path.join(CUR_DIR, 'test_data/test.bed'),
+        0.2,
+        sample_id='single'
+    )
+
+    summary = noise.calculate_noise_batch(
+        os.path.join(CUR_DIR, 'test_data/ref_nochr.fa'),
+        'manifest.tsv',
+        os.path.join(CUR_DIR, 'test_data/test.bed'),
+        0.2,
+        workers=2
+    )
+    assert summary['sample_id'].tolist() == ['s1', 's2']
+    assert summary['acgt_noise_fraction'].tolist() == approx([expected, expected])
+    assert pd.read_csv('cohort_noise_summary.tsv', sep='\t').shape == (2, 16)
+    for filename in ['_noise_acgt.tsv', '_noise_del.tsv', '_noise_n.tsv', OUTPUT_NOISE_FILENAME]:
+        with open('single' + filename) as single, open('s2' + filename) as batch:
+            assert single.read().replace('single', '') == batch.read().replace('s2', '')
+
+
+def test_calculate_noise_metrics(tmp_path, monkeypatch):
+    """
+    Test that --metrics_json records each stage and the counters, and that --profile writes profiler stats
+
+    :return:
+    """
+    monkeypatch.chdir(tmp_path)
+    result = CliRunner().invoke(cli.calculate_noise, [
+        '--ref_fasta', os.path.join(CUR_DIR, 'test_data/ref_nochr.fa'),
+        '--bam_file', os.path.join(CUR_DIR, 'test_data/SeraCare_0-5_tmp.bam'),
+        '--bed_file', os.path.join(CUR_DIR, 'test_data/test.bed'),
+        '--sample_id', 'metrics_',
+        '--threshold', '0.2',
+        '--metrics_json', 'metrics.json',
+        '--profile', 'noise.prof',
+    ])
+    assert result.exit_code == 0, result.output
+    with open('metrics.json') as f:
+        metrics = json.load(f)
+
+    for stage in ['bed_intervals', 'pileup', 'write_tables', 'alt_and_geno', 'threshold_filter', 'substitution',
+                  'fragment_sizes', 'plots', 'plots.n_counts']:
+        assert metrics['stages'][stage] >= 0
+    counters = metrics['counters']
+    assert counters['intervals'] == 1
+    assert counters['positions'] == len(pd.read_csv('metrics_' + OUTPUT_PILEUP_NAME, sep='\t'))
+    assert counters['reads_fetched'] >= counters['pairs_emitted'] * 2 > 0
+    assert counters['bytes_written'] == sum(os.path.getsize(path) for path in metrics['files'])
+    assert os.path.getsize('noise.prof') > 0
+
+
+def test_cohort_store(tmp_path, monkeypatch):
+    """
+    Test that calculate_noise adds the counts of each sample to the cohort store, at the offset of each position
+
+    :return:
+    """
+    monkeypatch.chdir(tmp_path)
+    kwargs = dict(
+        ref_fasta=os.path.join(CUR_DIR, 'test_data/ref_nochr.fa'),
+        bam_path=os.path.join(CUR_DIR, 'test_data/SeraCare_0-5_tmp.bam'),
+        bed_file_path=os.path.join(CUR_DIR, 'test_data/test.bed'),
+        noise_threshold=0.2,
+    )
+    settings = NoiseSettings(make_plots=False, cohort_store='store')
+    calculate_noise(sample_id='a_', settings=settings, **kwargs)
+    calculate_noise(sample_id='b_', settings=settings, **kwargs)
+    with pytest.raises(ValueError, match='already in cohort store'):
+        calculate_noise(sample_id='a_', settings=settings, **kwargs)
+    with pytest.raises(ValueError, match='Pileup settings'):
+        calculate_noise(sample_id='c_', settings=replace(settings, min_base_quality=20), **kwargs)
+
+    store = CohortStore('store')
+    assert store.samples == ['a_', 'b_']
+    assert store.n_positions == sum(stop - start for _, start, stop in noise.bed_intervals(kwargs['bed_file_path']))
+    pileup = pd.read_csv('a__pileup.tsv', sep='\t', dtype={'chrom': str})
+    counts = store.sample_counts('a_')
+    stored = pileup[['chrom', 'pos']].merge(counts, on=['chrom', 'pos'], how='left')
+    assert (stored[PILEUP_COUNT_COLUMNS].to_numpy() == pileup[PILEUP_COUNT_COLUMNS].to_numpy()).all()
+    # Positions without a pileup column are stored as 0
+    assert counts[PILEUP_COUNT_COLUMNS].to_numpy().sum() == pileup[PILEUP_COUNT_COLUMNS].to_numpy().sum()
+
+    result = CliRunner().invoke(cli.cohort_noise, ['--cohort_store', 'store', '--min_depth', '1', '--sample_id', 'a_'])
+    assert result.exit_code == 0, result.output
+    cohort = pd.read_csv('cohort_cohort_noise.tsv', sep='\t')
+    assert len(cohort) == store.n_positions
+    # Both samples are identical, so none of their positions is an outlier
+    assert len(pd.read_csv('a__site_outliers.tsv', sep='\t')) == 0
+
+
+def test_cohort_store_queries(tmp_path):
+    """
+    Test that the cohort queries give the same results whatever the number of positions read at once
+
+    :return:
+    """
+    intervals = [('1', 100, 110), ('1', 200, 205), ('2', 50, 60)]
+    assert position_offsets(intervals, np.array(['1', '1', '2', '1', '3']), np.array([100, 204, 59, 150, 100])).tolist() \
+        == [0, 14, 24, -1, -1]
+
+    rng = np.random.default_rng(0)
+    store_path = str(tmp_path / 'store')
+    positions = pd.DataFrame({'chrom': ['1'] * 15 + ['2'] * 10, 'pos': list(range(100, 110)) + list(range(200, 205))
+                              + list(range(50, 60))})
+    for sample in range(9):
+        # Background of up to two reads of each other base at a depth of 500
+        counts = rng.integers(0, 3, size=(25, len(PILEUP_COUNT_COLUMNS)))
+        counts[:, 0] += 500
+        if sample == 0:
+            # A noisy site of the first sample, and a shallow position
+            counts[3, 1] += 100
+            counts[7, :4] = [5, 0, 0, 0]
+        pileup = pd.concat([positions, pd.DataFrame(counts, columns=PILEUP_COUNT_COLUMNS)], axis=1)
+        append_sample(store_path, 'sample{}'.format(sample), pileup, intervals, pileup_settings())
+
+    with CohortStore(store_path) as store:
+        median = store.median_noise(min_depth=100)
+        assert median.equals(store.median_noise(min_depth=100, chunk_values=7))
+        assert median['samples'].tolist()[7] == 8
+        assert median['samples'].tolist()[:7] == [9] * 7
+
+        outliers = store.site_outliers('sample0', min_depth=100)
+        assert outliers[['chrom', 'pos']].values.tolist() == [['1', 103]]
+        assert outliers['score'].iloc[0] > 5
+        assert outliers.equals(store.site_outliers('sample0', min_depth=100, chunk_values=7))
+        counts = store.sample_counts('sample0')
+    assert store.counts is None and store._mmap is None
+    assert counts[PILEUP_COUNT_COLUMNS].to_numpy().sum() > 0
+
+
+def test_calculate_noise_no_plots(tmp_path, monkeypatch):
+    """
+    Test that the CLI does not import the plotting libraries, that --no_plots only writes the report data,
+    and that render_report renders it
+
+    :return:
+    """
+    loaded = subprocess.run(
+        [sys.executable, '-c', 'import sys, sequence_qc.cli; print("plotly" in sys.modules, "scipy" in sys.modules)'],
+        capture_output=True, text=True, check=True, cwd=os.path.dirname(CUR_DIR),
+    )
+    assert loaded.stdout.split() == ['False', 'False']
+
+    monkeypatch.chdir(tmp_path)
+    result = CliRunner().invoke(cli.calculate_noise, [
+        '--ref_fasta', os.path.join(CUR_DIR, 'test_data/ref_nochr.fa'),
+        '--bam_file', os.path.join(CUR_DIR, 'test_data/SeraCare_0-5_tmp.bam'),
+        '--bed_file', os.path.join(CUR_DIR, 'test_data/test.bed'),
+        '--sample_id', 'no_plots_',
+        '--threshold', '0.2',
+        '--no_plots',
+    ])
+    assert result.exit_code == 0, result.output
+    assert not os.path.exists('no_plots__noise.html')
+    assert os.path.exists('no_plots__noise_by_tlen.tsv')
+    assert os.path.exists('no_plots_' + OUTPUT_NOISE_FILENAME)
+
+    # The report is rendered later from the aggregates, for one or many samples
+    with open('no_plots__report_data.json') as f:
+        data = json.load(f)
+    assert data['sample_id'] == 'no_plots_'
+    assert sum(data['n_counts']['counts']) == len(pd.read_csv('no_plots__pileup.tsv', sep='\t'))
+    assert len(data['noisy_positions']['chrom_pos']) <= 100
+
+    result = CliRunner().invoke(cli.render_report, ['--report_data', 'no_plots__report_data.json'])
+    assert result.exit_code == 0, result.output
+    assert os.path.getsize('no_plots__noise.html') > 0
+    result = CliRunner().invoke(cli.render_report, [
+        '--report_data', 'no_plots__report_data.json', '--report_data', 'no_plots__report_data.json',
+        '--combined', 'cohort_noise.html',
+    ])
+    assert result.exit_code == 0, result.output
+    with open('cohort_noise.html') as f:
+        assert f.read().count('Noise Report for sample no_plots_') == 2
+
+
+def _write_indel_bam(path: str, ref: str) -> None:
+    """
+    Reads with deletions, insertions, a reference skip, soft clips, N bases, low qualities and overlapping mates
+    """
+    def read(name, start, cigar, seq, flag=0, mapq=60, quals=None, tlen=0, mate_start=0):
+        segment = pysam.AlignedSegment()
+        segment.query_name = name
+        segment.query_sequence = seq
+        segment.flag = flag
+        segment.reference_id = 0
+        segment.reference_start = start
+        segment.mapping_quality = mapq
+        segment.cigarstring = cigar
+        segment.next_reference_id = 0
+        segment.next_reference_start = mate_start
+        segment.template_length = tlen
+        segment.query_qualities = pysam.qualitystring_to_array(quals or 'I' * len(seq))
+        return segment
+
+    mismatch = 'A' if ref[125] != 'A' else 'C'
+    reads = [
+        read('del', 100, '20M3D20M', ref[100:120] + ref[123:143], quals='I' * 19 + '#' + 'I' * 20),
+        read('ins', 100, '20M2I20M', ref[100:120] + 'GG' + ref[120:140]),
+        read('clip', 105, '5S30M', 'TTTTT' + ref[105:135]),
+        read('skip', 110, '10M50N10M', ref[110:120] + ref[170:180]),
+        read('n', 100, '30M', ref[100:110] + 'N' + ref[111:130]),
+        read('low_mapq', 100, '30M', ref[100:130], mapq=0),
+        read('ins_del', 100, '10M1I2D19M', ref[100:110] + 'A' + ref[112:131]),
+        read('pair', 100, '40M', ref[100:140], flag=99, tlen=60, mate_start=120),
+        read('pair', 120, '40M', ref[120:125] + mismatch + ref[126:160], flag=147, tlen=-60, mate_start=100,
+             quals='I' * 5 + '5' + 'I' * 34),
+        read('dup', 100, '30M', ref[100:130], flag=1024),
+    ]
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': '1', 'LN': len(ref)}]}
+    with pysam.AlignmentFile(path + '.unsorted', 'wb', header=header) as bam:
+        for segment in reads:
+            bam.write(segment)
+    pysam.sort('-o', path, path + '.unsorted')
+    pysam.index(path)
+
+
+@pytest.mark.parametrize('kwargs', [
+    {},
+    {'truncate': False},
+    {'min_mapping_quality': 0, 'min_base_quality': 0},
+    {'min_mapping_quality': 30, 'min_base_quality': 35},
+    {'max_depth': 3},
+])
+def test_count_region_parity(tmp_path, kwargs):
+    """
+    Test that the pysam engine counts the same bases, insertions and deletions as pysamstats
+
+    :return:
+    """
+    fasta = pysam.FastaFile(os.path.join(CUR_DIR, 'test_data/ref_nochr.fa'))
+    ref = fasta.fetch('1', 0, 300).upper()
+    bam_path = str(tmp_path / 'indels.bam')
+    _write_indel_bam(bam_path, ref)
+
+    cases = [
+        (bam_path, 100, 180, None),
+        (bam_path, 100, 180, [(100, 115), (125, 180)]),
+        (os.path.join(CUR_DIR, 'test_data/SeraCare_0-5_tmp.bam'), 0, 92, None),
+    ]
+    for path, start, stop, include in cases:
+        with pysam.AlignmentFile(path) as bam:
+            expected, _ = pileup_region(bam, fasta, '1', start, stop, include=include, **kwargs)
+            counts, tlen = count_region(bam, fasta, '1', start, stop, include=include, **kwargs)
+        assert len(counts) > 0
+        assert len(tlen) == 0
+        for field in ['chrom', 'pos', 'ref'] + PILEUP_COUNT_COLUMNS:
+            np.testing.assert_array_equal(counts[field], expected[field], err_msg=field)
+
+
+def test_background_writer():
+    """
+    Test that writes run in submission order, and that the first error is raised in the calling thread
+    """
+    written = []
+    with BackgroundWriter(max_pending=1) as writer:
+        for i in range(20):
+            writer.submit(written.append, i)
+        writer.flush()
+        assert written == list(range(20))
+
+    def fail():
+        raise OSError('disk full')
+
+    writer = BackgroundWriter(max_pending=1)
+    writer.submit(fail)
+    with pytest.raises(OSError, match='disk full'):
+        writer.close()
+    with pytest.raises(OSError):
+        writer.submit(written.append, 20)
+    assert written == list(range(20))
+
+
+def test_shard_intervals():
+    """
+    Test that shards are balanced by base count and preserve BED order
+
+    :return:
+    """
+    intervals = [('1', 0, 100), ('1', 100, 150), ('1', 150, 200), ('2', 0, 100), ('2', 200, 300)]
+    shards = shard_intervals(intervals, 3)
+    assert [i for shard in shards for i in shard] == intervals
+    assert [sum(stop - start for _, start, stop in shard) for shard in shards] == [150, 150, 100]
+    assert all(shard_intervals(intervals, 10))
+
+
+def test_pysamstats_version():
+    """
+    Test that the installed pysamstats is the version whose internals `pileup_region` is built on
+
+    :return:
+    """
+    assert pysamstats.__version__ == PYSAMSTATS_VERSION, (
+        'pileup_region uses pysamstats internals that were checked against version {}, but {} is installed. '
+        'Check that test_pileup_region passes before updating PYSAMSTATS_VERSION'.format(PYSAMSTATS_VERSION,
+                                                                                          pysamstats.__version__))
+
+
+def test_pileup_region():
+    """
+    Test that the combined pileup gives the same records as separate pysamstats pileups
+
+    :return:
+    """
+    bam = pysam.AlignmentFile(os.path.join(CUR_DIR, 'test_data/SeraCare_0-5_tmp.bam'))
+    fasta = pysam.FastaFile(os.path.join(CUR_DIR, 'test_data/ref_nochr.fa'))
+    for truncate in [True, False]:
+        pileup, tlen = pileup_region(bam, fasta, '1', 5, 80, truncate=truncate, min_base_quality=20)
+        for stat_type, records in [('variation', pileup), ('tlen_strand', tlen)]:
+            expected = pysamstats.load_pileup(stat_type, bam, chrom='1', start=5, end=80, fafile=fasta,
+                                              truncate=truncate, max_depth=30000, min_baseq=20, min_mapq=1,
+                                              stepper='nofilter')
+            assert records.dtype == expected.dtype
+            assert (records == expected).all()
+
+
+def test_pileup_accumulator_compact():
+    """
+    Test that the compact pileup frame holds the same values as the decoded pysamstats records
+
+    :return:
+    """
+    accumulator = PileupAccumulator()
+    records = []
+    with pysam.AlignmentFile(os.path.join(CUR_DIR, 'test_data/SeraCare_0-5_tmp.bam')) as bam, \
+            pysam.FastaFile(os.path.join(CUR_DIR, 'test_data/ref_nochr.fa')) as fasta:
+        for start, stop in [(0, 40), (40, 92)]:
+            pileup, tlen = pileup_region(bam, fasta, '1', start, stop)
+            accumulator.add(pileup, tlen)
+            records.append(pileup)
+    pileup_df, tlen_df = accumulator.to_frames()
+
+    expected = pd.DataFrame(np.concatenate(records))
+    for field in ['chrom', 'ref']:
+        expected[field] = expected[field].str.decode('utf-8')
+    assert pileup_df['chrom'].dtype == 'category' and pileup_df['ref'].dtype == 'category'
+    assert pileup_df['A'].dtype == np.uint16 and pileup_df['pos'].dtype == np.uint32
+    assert list(pileup_df.columns) == ['chrom', 'pos', 'ref'] + VARIATION_COUNT_COLUMNS
+    pd.testing.assert_frame_equal(pileup_df.astype(object), expected.astype(object))
+    assert tlen_df['chrom'].astype(str).tolist() == ['1'] * len(tlen_df)
+
+
+def test_merge_intervals():
+    """
+    Test that overlapping and abutting intervals are merged, and grouped into fetch windows
+
+    :return:
+    """
+    intervals = [('2', 5, 10), ('1', 50, 60), ('1', 0, 20), ('1', 10, 30), ('1', 30, 40), ('2', 0, 3)]
+    merged, duplicate_bases = merge_intervals(intervals)
+    assert merged == [('2', 0, 3), ('2', 5, 10), ('1', 0, 40), ('1', 50, 60)]
+    assert duplicate_bases == 10
+
+    merged, duplicate_bases = merge_intervals(intervals, padding=2)
+    assert merged == [('2', 0, 12), ('1', 0, 42), ('1', 48, 62)]
+    assert duplicate_bases == 20
+
+    assert fetch_windows([('1', 0, 40), ('1', 50, 60), ('1', 100, 110), ('2', 0, 10)], max_gap=10) == [
+        ('1', 0, 60, [(0, 40), (50, 60)]),
+        ('1', 100, 110, [(100, 110)]),
+        ('2', 0, 10, [(0, 10)]),
+    ]
+
+
+def test_pileup_region_include(tmp_path, monkeypatch):
+    """
+    Test that piling up a fetch window gives the same records as piling up each of its intervals
+
+    :return:
+    """
+    monkeypatch.chdir(tmp_path)
+    include = [(0, 20), (40, 60), (70, 92)]
+    with pysam.AlignmentFile(os.path.join(CUR_DIR, 'test_data/SeraCare_0-5_tmp.bam')) as bam, \
+            pysam.FastaFile(os.path.join(CUR_DIR, 'test_data/ref_nochr.fa')) as fasta:
+        window = pileup_region(bam, fasta, '1', 0, 92, include=include)
+        separate = [pileup_region(bam, fasta, '1', start, stop) for start, stop in include]
+
+    for i in range(2):
+        assert window[i].tolist() == np.concatenate([records[i] for records in separate]).tolist()
+    assert len(window[0]) == 62
+
+    noise_windows = calculate_noise(
+        os.path.join(CUR_DIR, 'test_data/ref_nochr.fa'),
+        os.path.join(CUR_DIR, 'test_data/SeraCare_0-5_tmp.bam'),
+        os.path.join(CUR_DIR, 'test_data/test.bed'),
+        0.2,
+        sample_id='test_windows_'
+    )
+    assert noise_windows == approx(0.0048899755501162715, rel=1e-6)
+
+
+def test_reference_cache():
+    """
+    Test that bases served from the preloaded regions match fasta lookups, inside and outside of the regions
+
+    :return:
+    """
+    ref_path = os.path.join(CUR_DIR, 'test_data/ref_nochr.fa')
+    fasta = pysam.FastaFile(ref_path)
+    cache = ReferenceCache(ref_path)
+    cache.preload([('1', 20, 40), ('1', 35, 60), ('1', 100, 120), ('2', 0, 10)], padding=2)
+    assert [(start, stop) for start, stop, _ in cache._regions['1']] == [(18, 62), (98, 122)]
+
+    length = fasta.get_reference_length('1')
+    for pos in range(length):
+        assert cache.fetch(reference='1', start=pos, end=pos + 1) == fasta.fetch(reference='1', start=pos, end=pos + 1)
+        assert pysamstats.opt.get_refbase(cache, '1', pos) == pysamstats.opt.get_refbase(fasta, '1', pos)
+    assert cache.fetch('1', 10, 70) == fasta.fetch('1', 10, 70)
+    assert cache.fetch(region='1:20-40') == fasta.fetch(region='1:20-40')
+
+    # Regions preloaded later are merged with the regions they overlap or abut
+    cache.preload([('1', 60, 80), ('1', 140, 150), ('1', 300, 310)])
+    cache.preload([('1', 145, 160)])
+    assert [(start, stop) for start, stop, _ in cache._regions['1']] == [(18, 80), (98, 122), (140, 160)]
+    assert cache._cached_region('1', 40, 75) is not None
+    assert cache.fetch('1', 15, 170) == fasta.fetch('1', 15, 170)
+    for pos in range(135, 165):
+        assert cache.fetch(reference='1', start=pos, end=pos + 1) == fasta.fetch(reference='1', start=pos, end=pos + 1)
+
+
+def test_reference_scope():
+    """
+    Test that reference handles are shared inside a scope, and closed at the end of the outermost scope
+
+    :return:
+    """
+    ref_path = os.path.join(CUR_DIR, 'test_data/ref_nochr.fa')
+    with pytest.raises(RuntimeError):
+        open_reference(ref_path)
+    with reference_scope():
+        fasta = open_reference(ref_path)
+        with reference_scope():
+            assert open_reference(ref_path) is fasta
+        assert not fasta.closed
+    assert fasta.closed
+    with reference_scope():
+        assert open_reference(ref_path) is not fasta
+
+
+def test_threshold_masks():
+    """
+    Test vectorized threshold filtering against the row-wise definition, including ties for the genotype
+
+    :return:
+    """
+    rng = np.random.default_rng(0)
+    pileup = pd.DataFrame(rng.integers(0, 6, size=(2000, 5)), columns=['A', 'C', 'G', 'T', 'deletions'])
+    pileup['total_acgt'] = pileup[['A', 'C', 'G', 'T']].sum(axis=1)
+
+    def row_threshold(row, thresh):
+        base_counts = {'A': row['A'], 'C': row['C'], 'G': row['G'], 'T': row['T']}
+        genotype = max(base_counts, key=base_counts.get)
+        tot = row['A'] + row['C'] + row['G'] + row['T']
+        return not any([row[r] / (tot + noise.EPSILON) > thresh for r in 'ACGT' if r != genotype])
+
+    for thresh in [0.0, 0.2, 0.25, 0.5]:
+        expected = pileup.apply(row_threshold, axis=1, thresh=thresh).to_numpy()
+        assert (noise._threshold_mask(pileup, thresh) == expected).all()
+
+        expected_del = pileup.apply(
+            lambda row: row['deletions'] / (row['total_acgt'] + row['deletions'] + noise.EPSILON) < thresh, axis=1)
+        assert (noise._deletion_threshold_mask(pileup, thresh) == expected_del.to_numpy()).all()
+
+
+def test_noise_by_substitution():
+    """
+    Test substitution type aggregation against per-position counting
+
+    :return:
     """
+    rng = np.random.default_rng(1)
+    pileup = pd.DataFrame(rng.integers(0, 4, size=(500, 4)), columns=['A', 'C', 'G', 'T'])
+    st_df = noise._calculate_noise_by_substitution(pileup, 'test')
+
+    expected_alt = dict.fromkeys(noise.SUBSTITUTION_TYPES, 0)
+    expected_geno = dict.fromkeys(noise.SUBSTITUTION_TYPES, 0)
+    expected_sites = dict.fromkeys(noise.SUBSTITUTION_TYPES, 0)
+    for row in pileup.itertuples():
+        counts = {'A': row.A, 'C': row.C, 'G': row.G, 'T': row.T}
+        genotype = max(counts, key=counts.get)
+        for alt in 'ACGT'.replace(genotype, ''):
+            expected_alt[genotype + '>' + alt] += counts[alt]
+            expected_geno[genotype + '>' + alt] += counts[genotype]
+            expected_sites[genotype + '>' + alt] += counts[alt] > 0
+
+    assert list(st_df.index) == noise.SUBSTITUTION_TYPES
+    assert st_df[noise.ALT_COUNT].to_dict() == expected_alt
+    assert st_df[noise.GENO_COUNT].to_dict() == expected_geno
+    assert st_df[noise.CONTRIBUTING_SITES].to_dict() == expected_sites
+
+
+def test_noise_by_tlen(tmp_path, monkeypatch):
+    """
+    """
+    monkeypatch.chdir(tmp_path)
     noisy_positions = pd.read_csv(os.path.join(CUR_DIR, 'test_data/SeraCare_noise_positions.tsv'), sep='\t')
     get_fragment_size_for_sample(
         'test',
@@ -55,6 +902,147 @@ def test_noise_by_tlen():
         noisy_positions, 0, 500
     )
 
+    # Without noisy positions, the empty file is also written by the writer, in order with the other outputs
+    submitted = []
+    writer = SimpleNamespace(submit=lambda *args, **kwargs: submitted.append(args))
+    assert get_fragment_size_for_sample('empty_', os.path.join(CUR_DIR, 'test_data/SeraCare_0-5_tmp.bam'), 'empty_',
+                                        noisy_positions.iloc[:0], 0, 500, writer=writer) is None
+    assert len(submitted) == 1 and not os.path.exists('empty__noise_by_tlen.tsv')
+    submitted[0][0](*submitted[0][1:])
+    assert os.path.getsize('empty__noise_by_tlen.tsv') == 0
+
+
+def test_noise_by_tlen_sweep(tmp_path, monkeypatch):
+    """
+    Test that the single pass over merged regions writes the same lines as fetching each position separately
+
+    :return:
+    """
+    monkeypatch.chdir(tmp_path)
+    noisy_positions = pd.read_csv(os.path.join(CUR_DIR, 'test_data/SeraCare_noise_positions.tsv'), sep='\t')
+    bam_path = os.path.join(CUR_DIR, 'test_data/SeraCare_0-5_tmp.bam')
+
+    sweep_df = get_fragment_size_for_sample('test', bam_path, 'test', noisy_positions, 0, 500, sweep=True)
+    with open('test_noise_by_tlen.tsv') as f:
+        sweep_lines = f.read()
+    position_df = get_fragment_size_for_sample('test', bam_path, 'test', noisy_positions, 0, 500, sweep=False)
+    with open('test_noise_by_tlen.tsv') as f:
+        position_lines = f.read()
+
+    assert len(sweep_lines.splitlines()) == 6
+    assert sweep_lines == position_lines
+    assert sweep_df.equals(position_df)
+    # Records are returned typed, without reading the file back
+    assert sweep_df['Size'].dtype == np.int64
+    assert isinstance(sweep_df['Var'].dtype, pd.CategoricalDtype)
+
+
+def test_fragment_size_record_cigar():
+    """
+    Test that the base of each read at a noisy position is found from its CIGAR
+
+    :return:
+    """
+    header = pysam.AlignmentHeader.from_dict({'SQ': [{'SN': '1', 'LN': 1000}]})
+
+    def read(start, cigar, seq, tlen=100):
+        segment = pysam.AlignedSegment(header)
+        segment.query_name = 'pair'
+        segment.reference_id = 0
+        segment.reference_start = start
+        segment.cigarstring = cigar
+        segment.query_sequence = seq
+        segment.template_length = tlen
+        return segment
+
+    reads = [read(100, '3S4M2I3M2D3M1N2M', 'TTTACGTGGCATGCANN'), read(100, '10M', 'ACGTACGTAC')]
+    for segment in reads:
+        index = ReadPositionIndex(segment)
+        aligned = {ref: segment.query_sequence[query] for query, ref in segment.get_aligned_pairs(matches_only=True)}
+        for pos in range(95, 125):
+            assert index.base_at(pos) == aligned.get(pos)
+
+    def position(pos, genotype='A'):
+        counts = {base: 100 if base == genotype else 0 for base in 'ACGT'}
+        return SimpleNamespace(chrom='1', pos=pos, **counts)
+
+    # Soft clipped bases are skipped, so read1 has C at 101 and read2 has the genotype A at 104
+    read1, read2 = read(100, '3S4M2I3M2D3M', 'TTTACGTGGCATGCA'), read(104, '10M', 'A' * 10, tlen=-100)
+    assert _fragment_size_record(read1, read2, position(101), 0, 500) == ('pair', 'A>C', 100, 'not_A')
+    # The insertion is skipped, and the deletion gives read1 no base at 107, where read2 has the genotype
+    assert _fragment_size_record(read1, read2, position(104), 0, 500) == ('pair', 'A>C', 100, 'not_A')
+    assert _fragment_size_record(read1, read2, position(107), 0, 500) == ('pair', 'GENOTYPE', 100, 'A')
+    # Past the end of read1, where only read2 has a base, and past the end of both reads
+    assert _fragment_size_record(read1, read2, position(112), 0, 500) == ('pair', 'GENOTYPE', 100, 'A')
+    assert _fragment_size_record(read1, read2, position(114), 0, 500) is None
+    assert _fragment_size_record(read1, read2, position(101), 0, 50) is None
+
+
+def test_read_pair_generator_eviction():
+    """
+    Test that reads whose mate is never fetched are evicted once the mate position is passed
+
+    :return:
+    """
+    def read(name, start, mate_start, is_read1, tlen):
+        return SimpleNamespace(query_name=name, reference_id=0, reference_start=start, next_reference_id=0,
+                               next_reference_start=mate_start, is_read1=is_read1, tlen=tlen)
+
+    reads = [
+        read('orphan', 90, 10, False, -100),
+        read('pair_1', 2000, 2050, True, 100),
+        read('late_orphan', 2010, 5000, True, 3100),
+        read('pair_1', 2050, 2000, False, -100),
+        read('pair_2', 2200, 2250, True, 100),
+        read('pair_2', 2250, 2200, False, -100),
+    ]
+    bam = SimpleNamespace(fetch=lambda region=None: iter(reads))
+    stats = ReadPairStats()
+    pairs = [(read1.query_name, read1.reference_start) for read1, read2 in read_pair_generator(bam, stats=stats)]
+
+    assert pairs == [('pair_1', 2000), ('pair_2', 2200)]
+    assert stats.pairs_emitted == 2
+    # 'orphan' is evicted past 10 + MATE_POSITION_TOLERANCE, 'late_orphan' is still waiting when the fetch ends
+    assert stats.orphans_evicted == 1
+    assert stats.peak_buffer_size == 2
+
+
+def test_report_data_fixed_size():
+    """
+    Test that the report aggregates have the same size however many positions and fragments they summarize
+
+    :return:
+    """
+    rng = np.random.default_rng(0)
+    sizes = []
+    for n in [1000, 100000]:
+        noisy_positions = pd.DataFrame({
+            'chrom': '1',
+            'pos': np.arange(n),
+            'noise_acgt': rng.random(n) * 0.02,
+            'minor_allele_count': rng.integers(1, 10, n),
+            'N': rng.integers(0, 80, n),
+        })
+        noisy_tlen_df = pd.DataFrame({
+            'Var': rng.choice(['C>T', 'G>A', 'GENOTYPE', 'N'], n),
+            'Size': rng.integers(-10, 700, n).astype(str),
+        })
+        st_df = pd.DataFrame({'noise_fraction': [1e-5, 2e-5]}, index=['C>T', 'G>A'])
+        data = report.report_data(noisy_positions, noisy_positions, st_df, noisy_tlen_df, 'fixed_size')
+        sizes.append(len(json.dumps(data)))
+
+        quantiles = data['noisy_positions']['all_noise_acgt']
+        assert quantiles['count'] == n
+        assert quantiles['median'] == approx(np.median(noisy_positions['noise_acgt']))
+        assert data['noisy_positions']['noise_acgt'][0] == noisy_positions['noise_acgt'].max()
+        assert len(data['noisy_positions']['chrom_pos']) == min(n, report.TOP_NOISY_POSITIONS)
+        assert sum(data['n_counts']['counts']) + data['n_counts']['above_max'] == n
+        genotype = pd.to_numeric(noisy_tlen_df['Size'])[noisy_tlen_df['Var'] == 'GENOTYPE']
+        assert sum(data['fragment_sizes']['counts']['Genotype']) == (genotype > 0).sum()
+
+    # Only the number of digits can grow
+    assert sizes[1] < sizes[0] * 1.5
+
 
 def test_noisy_positions_plot():
     """
@@ -76,12 +1064,33 @@ def test_n_counts_plot():
     plots.plot_n_counts(noise_df)
 
 
-def test_all_plots():
+def test_noisy_tlen_plot():
+    """
+    Test that the fragment size plot is built from the binned sizes, with the same bars as the report
+
+    :return:
+    """
+    noisy_tlen_df = pd.DataFrame({
+        'Var': ['C>A', 'G>T', 'C>A', 'GENOTYPE', 'GENOTYPE', 'N'],
+        'Size': ['150', '162', '-150', '170', '600', '140'],
+        'Chr': ['1'] * 6,
+        'Pos': ['10'] * 6,
+    })
+    fig = plot_noise_by_tlen.create_noisy_tlen_plot(noisy_tlen_df)
+    expected = plots.fragment_sizes_figure(report.summarize_fragment_sizes(noisy_tlen_df))
+    assert [trace.name for trace in fig.data] == ['C>A', 'Genotype']
+    assert fig.to_json() == expected.to_json()
+    assert plot_noise_by_tlen.create_noisy_tlen_plot(None) is None
+    assert plot_noise_by_tlen.create_noisy_tlen_plot(noisy_tlen_df.iloc[:1]) is None
+
+
+def test_all_plots(tmp_path, monkeypatch):
     """
     Test combined HTML plot
 
     :return:
     """
+    monkeypatch.chdir(tmp_path)
     noise_df = pd.read_csv(os.path.join(CUR_DIR, 'test_data/test_noise_positions.tsv'), sep='\t')
     noise_by_substitution = pd.read_csv(
         os.path.join(CUR_DIR, 'test_data/test_noise_by_substitution.tsv'), sep='\t')